@@ -0,0 +1,245 @@
+""" Benchmarks for the per-request overhead of pyramid_zodbconn.
+
+Each scenario opens a connection with ``get_connection``, touches the root
+object and runs the request's finished callbacks, the way a Pyramid request
+does.  Scenarios are run against a ``MappingStorage`` (``memory://``) and a
+``FileStorage`` in a temporary directory, by one thread and by ``--threads``
+threads at once.
+
+Run it from a checkout with pyramid_zodbconn installed::
+
+  python benchmarks/bench_zodbconn.py
+  python benchmarks/bench_zodbconn.py --json --label $(git rev-parse HEAD) \\
+      >> bench.jsonl
+
+With ``--json`` every result is written as one JSON object per line, so the
+results of different commits can be collected in one file and compared.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import transaction
+from pyramid.config import Configurator
+from pyramid.request import Request
+
+from pyramid_zodbconn import (
+    ZODBConnectionClosed,
+    ZODBConnectionOpened,
+    ZODBConnectionWillClose,
+    get_connection,
+    )
+
+STORAGES = ('mapping', 'file')
+
+def make_uri(storage, tmpdir, name, pool_size):
+    if storage == 'mapping':
+        return 'memory://%s?connection_pool_size=%d' % (name, pool_size)
+    path = os.path.join(tmpdir, '%s.fs' % name)
+    return 'file://%s?connection_pool_size=%d' % (path, pool_size)
+
+def make_config(storage, tmpdir, pool_size, settings=None):
+    all_settings = {
+        'zodbconn.uri': make_uri(storage, tmpdir, 'main', pool_size),
+        }
+    all_settings.update(settings or {})
+    config = Configurator(settings=all_settings)
+    config.include('pyramid_zodbconn')
+    config.commit()
+    return config
+
+def close_databases(registry):
+    for db in set(registry._zodb_databases.values()):
+        db.close()
+
+def make_request(registry, tm):
+    request = Request.blank('/bench?x=1')
+    request.registry = registry
+    request.tm = tm
+    return request
+
+def request_primary(registry, tm):
+    request = make_request(registry, tm)
+    get_connection(request).root()
+    request._process_finished_callbacks()
+
+def request_secondary(registry, tm):
+    request = make_request(registry, tm)
+    get_connection(request).root()
+    get_connection(request, 'secondary').root()
+    request._process_finished_callbacks()
+
+def noop_subscriber(event):
+    pass
+
+def setup_open_close(storage, tmpdir, pool_size):
+    return make_config(storage, tmpdir, pool_size), request_primary
+
+def setup_secondary(storage, tmpdir, pool_size):
+    config = make_config(storage, tmpdir, pool_size, {
+        'zodbconn.uri.secondary': make_uri(
+            storage, tmpdir, 'secondary', pool_size),
+        })
+    return config, request_secondary
+
+def setup_transferlog(storage, tmpdir, pool_size):
+    config = make_config(storage, tmpdir, pool_size, {
+        'zodbconn.transferlog': os.path.join(tmpdir, 'transfer.log'),
+        })
+    return config, request_primary
+
+def setup_transferlog_threshold(storage, tmpdir, pool_size):
+    # a threshold no request reaches, so only the bookkeeping is measured
+    config = make_config(storage, tmpdir, pool_size, {
+        'zodbconn.transferlog': os.path.join(tmpdir, 'transfer.log'),
+        'zodbconn.transferlog_threshhold': '3600',
+        })
+    return config, request_primary
+
+def setup_events(storage, tmpdir, pool_size, subscribers=10):
+    config = make_config(storage, tmpdir, pool_size)
+    for event_type in (ZODBConnectionOpened, ZODBConnectionWillClose,
+                       ZODBConnectionClosed):
+        for i in range(subscribers):
+            config.add_subscriber(noop_subscriber, event_type)
+    config.commit()
+    return config, request_primary
+
+SCENARIOS = (
+    ('open_close', setup_open_close),
+    ('secondary', setup_secondary),
+    ('transferlog', setup_transferlog),
+    ('transferlog_threshold', setup_transferlog_threshold),
+    ('events', setup_events),
+    )
+
+def measure(func, registry, threads, iterations, warmup):
+    """ Call ``func(registry, tm)`` ``iterations`` times in each of
+    ``threads`` threads (after ``warmup`` untimed calls per thread) and
+    return the wall time in seconds the timed calls took. """
+    tms = [transaction.TransactionManager() for i in range(threads)]
+    for tm in tms:
+        for i in range(warmup):
+            func(registry, tm)
+    if threads == 1:
+        tm = tms[0]
+        start = time.time()
+        for i in range(iterations):
+            func(registry, tm)
+        return time.time() - start
+
+    go = threading.Event()
+    errors = []
+
+    def run(tm):
+        go.wait()
+        try:
+            for i in range(iterations):
+                func(registry, tm)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=run, args=(tm,)) for tm in tms]
+    for worker in workers:
+        worker.start()
+    start = time.time()
+    go.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - start
+    if errors:
+        raise errors[0]
+    return elapsed
+
+def run_scenario(name, setup, storage, threads, iterations, warmup,
+                 repeat=1):
+    """ Run a scenario ``repeat`` times and report the fastest run. """
+    tmpdir = tempfile.mkdtemp(prefix='pyramid_zodbconn-bench-')
+    try:
+        config, func = setup(storage, tmpdir, max(threads, 1))
+        try:
+            elapsed = min(
+                measure(func, config.registry, threads, iterations, warmup)
+                for i in range(repeat))
+        finally:
+            close_databases(config.registry)
+    finally:
+        shutil.rmtree(tmpdir)
+    ops = threads * iterations
+    return dict(
+        scenario=name,
+        storage=storage,
+        threads=threads,
+        ops=ops,
+        repeat=repeat,
+        seconds=elapsed,
+        ops_per_second=ops / elapsed if elapsed else None,
+        usec_per_op=elapsed * 1e6 / ops,
+        )
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        '-n', '--iterations', type=int, default=2000,
+        help='requests per thread (default: %(default)s)')
+    parser.add_argument(
+        '-w', '--warmup', type=int, default=100,
+        help='untimed requests per thread (default: %(default)s)')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='runs per scenario, the fastest is reported '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=4,
+        help='concurrency of the threaded runs (default: %(default)s)')
+    parser.add_argument(
+        '-s', '--scenario', action='append',
+        choices=[name for name, setup in SCENARIOS],
+        help='run only this scenario (may be repeated)')
+    parser.add_argument(
+        '--storage', action='append', choices=STORAGES,
+        help='use only this storage (may be repeated)')
+    parser.add_argument(
+        '--json', action='store_true',
+        help='write one JSON object per result')
+    parser.add_argument(
+        '--label', default='',
+        help='added to every JSON result, e.g. a commit id')
+    return parser.parse_args(argv)
+
+def main(argv=None, out=sys.stdout):
+    args = parse_args(argv)
+    scenarios = [(name, setup) for name, setup in SCENARIOS
+                 if not args.scenario or name in args.scenario]
+    storages = args.storage or STORAGES
+    concurrency = sorted(set([1, args.threads]))
+    if not args.json:
+        out.write('%-22s %-8s %7s %12s %10s\n' % (
+            'scenario', 'storage', 'threads', 'ops/s', 'usec/op'))
+    for name, setup in scenarios:
+        for storage in storages:
+            for threads in concurrency:
+                result = run_scenario(
+                    name, setup, storage, threads, args.iterations,
+                    args.warmup, args.repeat)
+                if args.json:
+                    result.update(
+                        label=args.label,
+                        python=platform.python_version(),
+                        implementation=platform.python_implementation(),
+                        )
+                    out.write(json.dumps(result, sort_keys=True) + '\n')
+                else:
+                    out.write('%-22s %-8s %7d %12.0f %10.1f\n' % (
+                        name, storage, threads, result['ops_per_second'],
+                        result['usec_per_op']))
+                out.flush()
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,75 @@
-import datetime
+import atexit
+import collections
+import os
+import random
 import sys
+import threading
 import time
 
 from zodburi import resolve_uri
 from ZODB import DB
 from ZODB.ActivityMonitor import ActivityMonitor
+from ZODB.POSException import ReadOnlyError
+from pyramid.events import ApplicationCreated
 from pyramid.exceptions import ConfigurationError
-from .compat import text_
+from pyramid.interfaces import PHASE3_CONFIG
+from pyramid.settings import asbool
+from pyramid.threadlocal import manager as threadlocal_manager
+from zope.interface import implementedBy
+from .budget import (
+    MemoryGovernor,
+    parse_size,
+    )
+from .classstats import (
+    ClassStats,
+    class_stats_view,
+    )
+from .cleanup import (
+    CleanupExecutor,
+    can_defer,
+    )
+from .compat import (
+    PY35,
+    reraise,
+    )
+from .hotoids import (
+    HotOidProfile,
+    HotOidProfiler,
+    )
+from .idle import IdleTrimmer
+from .metrics import (
+    StatsdPusher,
+    metrics_view,
+    parse_address,
+    )
+from .pool import ConnectionLimiter
+from .prefetching import prefetch
+from .readahead import ReadAhead
+from .routestats import (
+    RouteStats,
+    route_stats_view,
+    )
+from .sharedcache import shared_cache_factory
+from .stats import StatsCollector
+from .trace import (
+    LoadTracer,
+    trace_loads,
+    )
+from .transferlog import (
+    FORMATS as TRANSFERLOG_FORMATS,
+    BufferedTransferLogWriter,
+    )
+from .warmup import (
+    CacheWarmer,
+    parse_entries,
+    read_entries,
+    )
+
+if PY35: # pragma: no cover
+    from .aio import (
+        aclose_connection,
+        aget_connection,
+        )
 
 try:
     from transaction.interfaces import NoTransaction
@@ -15,6 +78,67 @@ except ImportError:  # pragma: no cover
     class NoTransaction(Exception):
         pass
 
+class ReadOnlyTransaction(object):
+    """ The transaction returned by :class:`ReadOnlyTransactionManager`.
+    Joining it (which is what a connection does when one of its objects is
+    first modified) flags the connection, so that the object can be
+    discarded from its cache when the request ends, and raises
+    ``ZODB.POSException.ReadOnlyError``. """
+    flag = '_pyramid_zodbconn_readonly_violated'
+
+    def join(self, resource):
+        setattr(resource, self.flag, True)
+        raise ReadOnlyError(
+            'Cannot modify persistent objects in a read-only request')
+
+class ReadOnlyTransactionManager(object):
+    """ The transaction manager of read-only connections (see
+    ``zodbconn.readonly_methods``).  A connection using it never joins a
+    transaction and needs no abort when it is closed; modifying a
+    persistent object raises ``ZODB.POSException.ReadOnlyError`` instead.
+    It is stateless, so a single instance is shared by all read-only
+    connections.
+
+    It is not an explicit transaction manager, so that ZODB starts a new
+    transaction of every connection it opens (including the connections to
+    other databases it opens to follow cross-database references); as the
+    connections never join a transaction, that is the only time they are
+    synchronized. """
+
+    transaction = ReadOnlyTransaction()
+
+    def get(self):
+        return self.transaction
+
+    def begin(self):
+        raise ReadOnlyError('Cannot begin a transaction in a read-only request')
+
+    commit = begin
+
+    def abort(self):
+        pass
+
+    def registerSynch(self, synch):
+        pass
+
+    def unregisterSynch(self, synch):
+        pass
+
+READONLY_TM = ReadOnlyTransactionManager()
+
+def readonly_policy(methods=(), predicate=None):
+    """ Return a callable which tells whether a request should use
+    read-only connections: either its method is in ``methods`` or
+    ``predicate(request)`` is true.  Return ``None`` if neither is given. """
+    methods = frozenset(method.upper() for method in methods)
+    if not methods and predicate is None:
+        return None
+    def policy(request):
+        if request.method in methods:
+            return True
+        return predicate is not None and bool(predicate(request))
+    return policy
+
 def get_connection(request, dbname=None):
     """
     ``request`` must be a Pyramid request object.
@@ -26,7 +150,44 @@ def get_connection(request, dbname=None):
     If you're using named databases, you can obtain a connection to a named
     database by passing its name as ``dbname``.  It must be the name of a
     database (e.g. if you've added ``zodbconn.uri.foo`` to the configuration,
-    it should be ``foo``).
+    it should be ``foo``).  The first time a request asks for a connection
+    to a given named database, a :class:`ZODBSecondaryConnectionOpened`
+    event is sent.
+
+    If ``request.zodb_readonly`` is true, or it is not set and the request
+    matches ``zodbconn.readonly_methods`` or
+    ``zodbconn.readonly_predicate``, the connections are opened read-only:
+    they use :data:`READONLY_TM` instead of ``request.tm``, never join a
+    transaction, and raise ``ZODB.POSException.ReadOnlyError`` when a
+    persistent object is modified.
+
+    If ``zodbconn.pool_limit`` is set and that many connections to the
+    primary database are already open, wait for one of them to be closed;
+    :class:`pyramid_zodbconn.pool.PoolTimeoutError` is raised if that takes
+    longer than ``zodbconn.pool_timeout`` seconds.  A request which holds a
+    connection and invokes a sub-request which asks for one of its own
+    (without ``zodbconn.subrequest_reuse``) waits for itself when every
+    connection is in use: it hangs forever unless ``zodbconn.pool_timeout``
+    is set.
+
+    If ``zodbconn.subrequest_reuse`` is set, a sub-request (invoked with
+    ``request.invoke_subrequest``) uses the connections and transaction
+    manager of the request which invoked it instead of opening connections
+    of its own (of the nearest enclosing request which has connections, if
+    sub-requests are nested; see :func:`find_parent_request`); they are
+    closed when that request is finished, and the connection events are only
+    sent for that request.
+
+    The connections are closed when the request is finished, after their
+    transaction is aborted.  If ``zodbconn.background_cleanup`` is set, the
+    abort and close are done by a
+    :class:`pyramid_zodbconn.cleanup.CleanupExecutor` thread after the
+    :class:`ZODBConnectionWillClose` event has been sent by the request
+    thread, and the :class:`ZODBConnectionClosed` event is sent by that
+    thread once the connection has been returned to the pool; this is only
+    done for connections whose transaction manager belongs to the request
+    (``request.tm`` is set, and is neither ``transaction.manager`` nor the
+    manager it uses for the request thread).
     """
     # not a tween.  rationale: tweens don't get called until the router accepts
     # a request.  during paster shell, paster ptweens, etc, the router is
@@ -39,6 +200,25 @@ def get_connection(request, dbname=None):
 
     primary_conn = getattr(request, '_primary_zodb_conn', None)
 
+    parent = getattr(request, '_zodb_parent', None)
+    if (parent is None and primary_conn is None and
+            getattr(registry, '_zodb_subrequest_reuse', False)):
+        parent = find_parent_request(request)
+        if parent is not None:
+            request._zodb_parent = parent
+
+    if parent is not None:
+        # the parent opens, tracks and closes the connections
+        conn = get_connection(parent, dbname)
+        if primary_conn is None:
+            # only now, as a nested parent takes the transaction manager of
+            # its own parent
+            request._primary_zodb_conn = parent._primary_zodb_conn
+            parent_tm = getattr(parent, 'tm', None)
+            if parent_tm is not None:
+                request.tm = parent_tm
+        return conn
+
     if primary_conn is None:
 
         zodb_dbs = getattr(registry, '_zodb_databases', None)
@@ -53,22 +233,69 @@ def get_connection(request, dbname=None):
             raise ConfigurationError(
                 'No zodbconn.uri defined in Pyramid settings')
 
-        tm = getattr(request, 'tm', None)
-        primary_conn = primary_db.open(transaction_manager=tm)
+        readonly = getattr(request, 'zodb_readonly', None)
+        if readonly is None:
+            policy = getattr(registry, '_zodb_readonly_policy', None)
+            readonly = policy is not None and policy(request)
 
-        registry.notify(ZODBConnectionOpened(primary_conn, request))
+        limiter = getattr(registry, '_zodb_limiter', None)
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            if readonly:
+                primary_conn = primary_db.open(transaction_manager=READONLY_TM)
+            else:
+                tm = getattr(request, 'tm', None)
+                primary_conn = primary_db.open(transaction_manager=tm)
+        except:
+            if limiter is not None:
+                limiter.release()
+            raise
 
-        def finished(request):
+        notifier = get_notifier(registry)
+
+        def release():
             # closing the primary also closes any secondaries opened
-            registry.notify(ZODBConnectionWillClose(primary_conn, request))
             try:
-                primary_conn.transaction_manager.abort()
-            except NoTransaction:
-                pass
-            primary_conn.close()
-            registry.notify(ZODBConnectionClosed(primary_conn, request))
+                if readonly:
+                    discard_readonly_violations(primary_conn)
+                else:
+                    try:
+                        primary_conn.transaction_manager.abort()
+                    except NoTransaction:
+                        pass
+                primary_conn.close()
+            finally:
+                if limiter is not None:
+                    limiter.release()
+
+        def close():
+            release()
+            notifier.closed(primary_conn, request)
+
+        def finished(request):
+            try:
+                notifier.will_close(primary_conn, request)
+            finally:
+                cleanup = getattr(registry, '_zodb_cleanup', None)
+                if cleanup is not None and can_defer(primary_conn):
+                    # the connection is returned to the pool (and the
+                    # limiter released) by the cleanup thread once it is
+                    # closed
+                    cleanup.submit(request, close)
+                else:
+                    close()
+
+        try:
+            notifier.opened(primary_conn, request)
+        except:
+            # the request doesn't know about the connection yet, nothing
+            # else would close it
+            release()
+            raise
 
         request.add_finished_callback(finished)
+        request._zodb_finished = finished # for aclose_connection
         request._primary_zodb_conn = primary_conn
 
     if dbname is None:
@@ -80,8 +307,64 @@ def get_connection(request, dbname=None):
         raise ConfigurationError(
             'No zodbconn.uri.%s defined in Pyramid settings' % dbname)
 
+    secondaries = getattr(request, '_zodb_secondary_conns', None)
+    if secondaries is None:
+        secondaries = request._zodb_secondary_conns = {}
+    if dbname not in secondaries:
+        secondaries[dbname] = conn
+        get_notifier(registry).secondary_opened(conn, request, dbname)
+
     return conn
 
+def find_parent_request(request):
+    """ Return the request which invoked ``request`` as a sub-request
+    (through ``request.invoke_subrequest``), or ``None`` if ``request`` is
+    not being processed as a sub-request of another request.
+
+    The requests enclosing ``request`` are searched outward from its own
+    entry of the threadlocal stack (the innermost one, if it was pushed
+    more than once), so that ``request`` needn't be the current request.
+    With nested sub-requests, the nearest of them which holds a connection
+    is returned, else the one which invoked ``request``."""
+    stack = threadlocal_manager.stack
+    found = False
+    nearest = None
+    for info in reversed(stack):
+        other = info.get('request')
+        if not found:
+            found = other is request
+            continue
+        if other is None or other is request:
+            continue
+        if getattr(other, '_primary_zodb_conn', None) is not None:
+            return other
+        if nearest is None:
+            nearest = other
+    return nearest
+
+def discard_readonly_violations(primary_conn):
+    """ Some persistent containers change their data before telling their
+    connection, so an object whose modification was refused by a read-only
+    connection can still hold the change.  Ghostify every unmodified object
+    in the caches of ``primary_conn`` and its secondaries if that happened,
+    so that the change is not seen by later requests. """
+    flag = ReadOnlyTransaction.flag
+    violated = False
+    for conn in primary_conn.connections.values():
+        if getattr(conn, flag, False):
+            delattr(conn, flag)
+            violated = True
+    if violated:
+        primary_conn.cacheMinimize()
+
+def get_secondary_connections(request):
+    """ Return a dictionary mapping the names of the named databases
+    ``request`` asked for through :func:`get_connection` to their
+    connections.  A sub-request which shares the connections of its parent
+    request shares these too. """
+    request = getattr(request, '_zodb_parent', request)
+    return dict(getattr(request, '_zodb_secondary_conns', {}))
+
 class ConnectionEvent(object):
     """ Base class for ZODB connection events.  A connection event has two
     attributes: ``conn``, and ``request``.  ``conn`` is the ZODB connection
@@ -99,48 +382,237 @@ class ZODBConnectionWillClose(ConnectionEvent):
 class ZODBConnectionClosed(ConnectionEvent):
     """ An event sent when a ZODB connection is about to be closed """
 
+class ZODBSecondaryConnectionOpened(ConnectionEvent):
+    """ An event sent the first time a request obtains a connection to a
+    named database through :func:`get_connection`.  In addition to ``conn``
+    and ``request``, it has a ``dbname`` attribute.  The connection is
+    closed along with the primary connection, so there are no matching
+    close events. """
+    def __init__(self, conn, request, dbname):
+        ConnectionEvent.__init__(self, conn, request)
+        self.dbname = dbname
+
+CONNECTION_EVENTS = (
+    ZODBConnectionOpened,
+    ZODBConnectionWillClose,
+    ZODBConnectionClosed,
+    ZODBSecondaryConnectionOpened,
+    )
+
+class ConnectionLifecycleHook(object):
+    """ Base class for connection lifecycle hooks, added with the
+    ``add_zodbconn_lifecycle_hook`` configurator directive.  A hook gets
+    every stage of a request's connections through plain method calls, with
+    no event objects created and no subscriber lookup.  ``opened``,
+    ``will_close`` and ``closed`` are called for the primary connection at
+    the same points as the corresponding events, ``secondary_opened`` the
+    first time a request asks for a named database.  The methods of this
+    class do nothing. """
+
+    def opened(self, conn, request):
+        pass
+
+    def secondary_opened(self, conn, request, dbname):
+        pass
+
+    def will_close(self, conn, request):
+        pass
+
+    def closed(self, conn, request):
+        pass
+
+class ConnectionNotifier(object):
+    """ Sends the connection events of :func:`get_connection` and calls
+    the lifecycle hooks.  Which of the events have subscribers is computed
+    when the configuration is committed, and again whenever the
+    subscriptions of the registry change; events nobody subscribed to are
+    neither created nor dispatched. """
+
+    def __init__(self, registry):
+        self.registry = registry
+        self.hooks = ()
+        self.subscribed = frozenset(CONNECTION_EVENTS)
+        self.generation = None
+
+    def add_hook(self, hook):
+        # replace rather than mutate, so that requests in progress keep
+        # iterating over a consistent tuple
+        self.hooks = self.hooks + (hook,)
+
+    def update(self):
+        adapters = self.registry.adapters
+        generation = getattr(adapters, '_generation', None)
+        self.subscribed = frozenset(
+            event_type for event_type in CONNECTION_EVENTS
+            if adapters.subscriptions([implementedBy(event_type)], None))
+        self.generation = generation
+
+    def wants(self, event_type):
+        """ Return true if ``event_type`` has subscribers. """
+        generation = getattr(self.registry.adapters, '_generation', None)
+        if generation is None:
+            # no way to tell whether subscriptions changed
+            return True
+        if generation != self.generation:
+            self.update()
+        return event_type in self.subscribed
+
+    def opened(self, conn, request):
+        if self.wants(ZODBConnectionOpened):
+            self.registry.notify(ZODBConnectionOpened(conn, request))
+        for hook in self.hooks:
+            hook.opened(conn, request)
+
+    def secondary_opened(self, conn, request, dbname):
+        if self.wants(ZODBSecondaryConnectionOpened):
+            self.registry.notify(
+                ZODBSecondaryConnectionOpened(conn, request, dbname))
+        for hook in self.hooks:
+            hook.secondary_opened(conn, request, dbname)
+
+    def will_close(self, conn, request):
+        if self.wants(ZODBConnectionWillClose):
+            self.registry.notify(ZODBConnectionWillClose(conn, request))
+        for hook in self.hooks:
+            hook.will_close(conn, request)
+
+    def closed(self, conn, request):
+        if self.wants(ZODBConnectionClosed):
+            self.registry.notify(ZODBConnectionClosed(conn, request))
+        for hook in self.hooks:
+            hook.closed(conn, request)
+
+def get_notifier(registry):
+    notifier = getattr(registry, '_zodb_notifier', None)
+    if notifier is None:
+        notifier = registry._zodb_notifier = ConnectionNotifier(registry)
+    return notifier
+
+def add_lifecycle_hook(config, hook):
+    """ Configurator directive (``config.add_zodbconn_lifecycle_hook``)
+    which adds ``hook`` (a :class:`ConnectionLifecycleHook` or a dotted name
+    of one) to the hooks called for every request's connections. """
+    hook = config.maybe_dotted(hook)
+    notifier = get_notifier(config.registry)
+    config.action(None, notifier.add_hook, args=(hook,))
+
 class TransferLog(object):
+    """ Writes a line with the ZODB loads and stores of each request to
+    ``stream``.  With a ``threshhold`` (in seconds), only requests which
+    took at least that long are logged.  With a ``sample_rate`` (between 0
+    and 1), requests are also logged if they are picked at random with that
+    probability.  Whether a request is sampled is decided when its
+    connection is opened, so requests which can't be logged cost nothing
+    more.  ``max_rate`` caps the number of lines written per second; lines
+    over the cap are counted in ``suppressed``.
+
+    ``format`` is the name of one of the formats of
+    :mod:`pyramid_zodbconn.transferlog`; ``stream`` must accept bytes for
+    the ``binary`` format."""
     key = '_pyramid_zodbconn_txlog_info'
-    def __init__(self, stream, threshhold):
+    def __init__(self, stream, threshhold, sample_rate=None, max_rate=None,
+                 format='csv', random=random.random):
+        # XXX random is parameterized only for testing
+        if format not in TRANSFERLOG_FORMATS:
+            raise ConfigurationError(
+                'Unknown transfer log format %r (expected one of %s)'
+                % (format, ', '.join(sorted(TRANSFERLOG_FORMATS))))
         self.stream = stream
+        self.format = format
+        self.formatter, self.binary = TRANSFERLOG_FORMATS[format]
         self.threshhold = threshhold
+        self.sample_rate = sample_rate
+        self.max_rate = max_rate
+        self.random = random
+        self.suppressed = 0
+        # a line takes a whole token, so the bucket holds at least one even
+        # when less than a line per second is allowed
+        self._capacity = None
+        if max_rate is not None:
+            self._capacity = max(max_rate, 1)
+        self._tokens = self._capacity
+        self._last = None
+        self._lock = threading.Lock()
 
     def start(self, event, time=time):
         # XXX time is parameterized only for testing
+        if self.sample_rate is not None:
+            sampled = self.random() < self.sample_rate
+        else:
+            sampled = self.threshhold is None
+        if not sampled and self.threshhold is None:
+            return
         xfercounts = event.conn.getTransferCounts()
         info = dict(
             start=time.time(),
             loads=xfercounts[0],
             stores=xfercounts[1],
+            sampled=sampled,
             )
+        conn = event.conn
+        if len(conn.connections) > 1:
+            # secondaries stay attached to a pooled primary connection
+            info['databases'] = dict(
+                (name, c.getTransferCounts())
+                for name, c in conn.connections.items() if c is not conn)
         setattr(event.request, self.key, info)
 
+    def allow(self, now):
+        """ Take a line from the ``max_rate`` token bucket, return false if
+        there is none left. """
+        with self._lock:
+            if self._last is not None:
+                self._tokens = min(
+                    self._capacity,
+                    self._tokens + (now - self._last) * self.max_rate)
+            self._last = now
+            if self._tokens < 1:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def secondaries(self, event, info):
+        """ Return ``(dbname, loads, stores)`` tuples for the secondary
+        connections of the primary connection of ``event`` which the request
+        asked for or which loaded or stored objects. """
+        conn = event.conn
+        requested = getattr(event.request, '_zodb_secondary_conns', {})
+        before = info.get('databases', {})
+        result = []
+        for name, c in sorted(conn.connections.items()):
+            if c is conn:
+                continue
+            loads_before, stores_before = before.get(name, (0, 0))
+            loads_after, stores_after = c.getTransferCounts()
+            loads = loads_after - loads_before
+            stores = stores_after - stores_before
+            if loads or stores or name in requested:
+                result.append((name, loads, stores))
+        return result
+
     def end(self,  event, time=time):
         # XXX time is parameterized only for testing
         info = getattr(event.request, self.key, None)
         if info is not None:
             now = time.time()
             elapsed = now - info['start']
-            if self.threshhold is not None:
+            if self.threshhold is not None and not info.get('sampled'):
                 if elapsed < self.threshhold:
                     return
+            if self.max_rate is not None and not self.allow(now):
+                return
             loads_after, stores_after = event.conn.getTransferCounts()
-            loads = loads_after - info['loads']
-            stores = stores_after - info['stores']
-            request_method = event.request.method
-            url = event.request.path_qs
-            ts = datetime.datetime.fromtimestamp(now).strftime(
-                "%Y-%m-%d %H:%M:%S"
-                )
-            value = '"%s", "%s", "%s", %.2f, %d, %d\n'  % (
-                ts,
-                request_method,
-                url,
+            value = self.formatter(
+                now,
+                event.request.method,
+                event.request.path_qs,
                 elapsed,
-                loads,
-                stores
+                loads_after - info['loads'],
+                stores_after - info['stores'],
+                self.secondaries(event, info),
                 )
-            self.stream.write(text_(value))
+            self.stream.write(value)
             self.stream.flush()
 
 def db_from_uri(uri, dbname, dbmap, resolve_uri=resolve_uri):
@@ -149,6 +621,105 @@ def db_from_uri(uri, dbname, dbmap, resolve_uri=resolve_uri):
     storage = storage_factory()
     return DB(storage, databases=dbmap, **dbkw)
 
+class LazyDB(object):
+    """ Stands in for a database in ``registry._zodb_databases`` until a
+    connection to it is first opened.  The first call to ``open`` constructs
+    the storage and database (exactly once, even when several threads race
+    to open it) and replaces this placeholder with the real database in the
+    multi-database map, so that subsequent connections do not go through the
+    placeholder at all.  Any other attribute is looked up on the real
+    database, which is constructed first if necessary."""
+
+    loaded = False
+
+    def __init__(self, uri, database_name, databases, db_from_uri=db_from_uri):
+        self.uri = uri
+        self.database_name = database_name
+        self.databases = databases
+        self.db_from_uri = db_from_uri
+        self.db = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ Return the real database, constructing it if necessary. """
+        db = self.db
+        if db is None:
+            with self._lock:
+                db = self.db
+                if db is None:
+                    # build the database against a private map: DB refuses
+                    # to register a name which is already in its map, and
+                    # other threads may be reading the shared one
+                    db = self.db_from_uri(self.uri, self.database_name, {})
+                    db.setActivityMonitor(ActivityMonitor())
+                    db.databases = self.databases
+                    self.databases[self.database_name] = db
+                    self.db = db
+                    self.loaded = True
+        return db
+
+    def open(self, *arg, **kw):
+        return self.load().open(*arg, **kw)
+
+    def close(self):
+        # a database which was never opened has nothing to close
+        if self.db is not None:
+            self.db.close()
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            # protocol lookups (copy, pickle, ...) don't open the database
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+def is_loaded(db):
+    """ Return false if ``db`` is a :class:`LazyDB` which no connection has
+    been opened to yet, true otherwise. """
+    # a real database has no ``loaded`` attribute
+    return getattr(db, 'loaded', True)
+
+def open_databases(uris, databases, db_from_uri=db_from_uri, threads=4):
+    """ Construct a database for each ``(name, uri)`` pair in ``uris``,
+    using up to ``threads`` threads, and add them to the multi-database map
+    ``databases``.  Each database is built against a private map and only
+    joined to ``databases`` once all of them have been built, in the order
+    of ``uris``.  If any of them fails, the ones which were built are closed
+    and the exception raised for the first failing URI (in the order of
+    ``uris``, not of completion) is re-raised."""
+    uris = list(uris)
+    results = [None] * len(uris)
+    pending = collections.deque(enumerate(uris))
+
+    def work():
+        while True:
+            try:
+                index, (name, uri) = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = (db_from_uri(uri, name, {}), None)
+            except Exception:
+                results[index] = (None, sys.exc_info())
+
+    workers = [threading.Thread(target=work, name='pyramid_zodbconn-open')
+               for i in range(min(threads, len(uris)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for db, exc_info in results:
+        if exc_info is not None:
+            for db, ignored in results:
+                if db is not None:
+                    db.close()
+            reraise(*exc_info)
+
+    for (name, uri), (db, ignored) in zip(uris, results):
+        db.databases = databases
+        databases[name] = db
+        db.setActivityMonitor(ActivityMonitor())
+
 NAMED = 'zodbconn.uri.'
 
 def get_uris(settings):
@@ -185,24 +756,394 @@ def includeme(config, db_from_uri=db_from_uri, open=open):
 
     Use the key ``zodbconn.transferlog`` in the deployment settings to specify
     a filename to write ZODB load/store information to, or leave key's value
-    blank to send to stdout.
+    blank to send to stdout.  ``zodbconn.transferlog_threshhold`` (in
+    seconds), ``zodbconn.transferlog_sample_rate`` (the fraction of requests
+    to log) and ``zodbconn.transferlog_max_rate`` (lines per second) reduce
+    the number of lines logged (see :class:`TransferLog`).
+    ``zodbconn.transferlog_format`` is ``csv`` (the default), ``json`` or
+    ``binary`` (see :mod:`pyramid_zodbconn.transferlog`).
+
+    Set ``zodbconn.transferlog_buffered`` to a true value to write transfer
+    log lines from a background thread instead of the request thread (see
+    :class:`BufferedTransferLogWriter`).  The ring size, batching and
+    overflow behavior are tuned with ``zodbconn.transferlog_buffer_size``,
+    ``zodbconn.transferlog_flush_lines``,
+    ``zodbconn.transferlog_flush_interval`` and
+    ``zodbconn.transferlog_overflow``.
+
+    Set ``zodbconn.stats`` to a true value to collect per-request ZODB cache
+    and load statistics as ``request.zodb_stats``.  The statistics object is
+    created by ``zodbconn.stats_factory`` (a dotted name, defaulting to
+    :class:`pyramid_zodbconn.stats.ConnectionStats`).
+
+    Set ``zodbconn.metrics_path`` to a URL path to serve the activity, pool
+    and cache metrics of every database in the Prometheus text format from
+    that path (protected by ``zodbconn.metrics_permission``, if set).  Set
+    ``zodbconn.statsd`` to a ``host:port`` to push the same metrics as StatsD
+    gauges every ``zodbconn.metrics_interval`` seconds.
+
+    Set ``zodbconn.pool_limit`` to the maximum number of primary database
+    connections which may be open at the same time; further requests wait
+    for a connection to be closed, for at most ``zodbconn.pool_timeout``
+    seconds if that is set (see :mod:`pyramid_zodbconn.pool`).  The wait and
+    rejection counters are included in the metrics.
+
+    Set ``zodbconn.memory_budget`` to a size in bytes (``KB``, ``MB`` and
+    ``GB`` suffixes are understood) to have a background thread share that
+    budget among the object caches of all connections of all databases
+    every ``zodbconn.memory_budget_interval`` seconds, instead of using the
+    fixed cache sizes of the database URIs (see
+    :class:`pyramid_zodbconn.budget.MemoryGovernor`).
+
+    Set ``zodbconn.shared_cache_size`` to a size in bytes to give each
+    database a cache of object records shared by all its connections (see
+    :class:`pyramid_zodbconn.sharedcache.SharedStateCache`).
+
+    Set ``zodbconn.idle_trim`` to a number of seconds to have a background
+    thread minimize the object caches of pooled connections which have been
+    idle for longer (see :class:`pyramid_zodbconn.idle.IdleTrimmer`).
+    ``zodbconn.idle_trim_interval`` and ``zodbconn.idle_trim_batch`` set
+    how often that happens and how many connections are trimmed each time,
+    ``zodbconn.idle_keep`` the number of connections per pool beyond which
+    idle connections are closed.
+
+    Set ``zodbconn.prefetch_threads`` to the number of threads which load
+    objects for :func:`pyramid_zodbconn.prefetch` when the storage
+    can't prefetch them itself (4 by default).
+
+    Set ``zodbconn.background_cleanup`` to a true value to abort the
+    transaction of a finished request and close its connections in
+    ``zodbconn.cleanup_threads`` background threads (1 by default) instead of
+    the request thread, for requests with a ``request.tm`` of their own
+    which isn't bound to a thread.  If ``zodbconn.cleanup_max_pending`` (100 by default)
+    cleanups are already pending, the request thread does it (see
+    :class:`pyramid_zodbconn.cleanup.CleanupExecutor`).  The cleanup
+    counters and times are included in the metrics.
+
+    Set ``zodbconn.subrequest_reuse`` to a true value to have sub-requests
+    share the connections and transaction manager of the request which
+    invoked them (see :func:`get_connection`).
+
+    Set ``zodbconn.readahead`` to a true value to learn which objects the
+    requests of each route load, and to read them ahead for later requests
+    of the route once they have loaded ``zodbconn.readahead_trigger``
+    objects (see :class:`pyramid_zodbconn.readahead.ReadAhead`).  At most
+    ``zodbconn.readahead_max_oids`` objects, loaded by at least
+    ``zodbconn.readahead_min_support`` of the route's requests, are read
+    ahead, and at most ``zodbconn.readahead_max_routes`` routes are
+    learned.  The read-ahead counters are included in the metrics.
+
+    Set ``zodbconn.async_threads`` to the number of threads which open and
+    close connections for :func:`pyramid_zodbconn.aio.aget_connection`; by
+    default, the primary database's pool size.
+
+    Set ``zodbconn.route_stats`` to a true value to aggregate the elapsed
+    time, loads and stores of requests into histograms per route (or view)
+    (see :class:`pyramid_zodbconn.routestats.RouteStats`).  The report is
+    written to ``zodbconn.route_stats_file`` every
+    ``zodbconn.route_stats_interval`` seconds and/or served as JSON from
+    ``zodbconn.route_stats_path`` (protected by
+    ``zodbconn.route_stats_permission``, if set).
+
+    Set ``zodbconn.class_stats`` to a true value to count the loads and
+    pickle bytes loaded per class and database (see
+    :class:`pyramid_zodbconn.classstats.ClassStats`), for
+    ``zodbconn.class_stats_sample_rate`` of the requests and at most
+    ``zodbconn.class_stats_max_classes`` classes per database.  The report
+    is served as JSON from ``zodbconn.class_stats_path`` (protected by
+    ``zodbconn.class_stats_permission``, if set), or written with
+    :func:`pyramid_zodbconn.classstats.dump`.
+
+    Set ``zodbconn.lazy`` to a true value to defer constructing each storage
+    and database until a connection to it is first requested (see
+    :class:`LazyDB`).  Otherwise, set ``zodbconn.open_threads`` to a number
+    greater than one to construct the databases concurrently using that many
+    threads (see :func:`open_databases`).
+
+    Set ``zodbconn.warmup`` to a whitespace-delimited list of oids and
+    traversal paths and/or ``zodbconn.warmup_file`` to a file listing them
+    to load those objects into the caches of the primary database's pooled
+    connections when the application is created (see
+    :mod:`pyramid_zodbconn.warmup`).
+
+    Set ``zodbconn.hotoids`` to a filename to sample the oids loaded through
+    the primary connection into a bounded frequency profile which is
+    periodically written to that file (see :mod:`pyramid_zodbconn.hotoids`).
+
+    Set ``zodbconn.load_trace`` to a filename (or leave it blank for stdout)
+    to write the objects loaded by traced requests which took at least
+    ``zodbconn.load_trace_threshold`` seconds to it.  Requests are traced
+    if they call :func:`pyramid_zodbconn.trace.trace_loads` or are picked
+    at random with ``zodbconn.load_trace_sample_rate``; at most
+    ``zodbconn.load_trace_max_loads`` loads are kept per request (see
+    :mod:`pyramid_zodbconn.trace`).
+
+    Connection events are only created and sent if something subscribes to
+    them.  Use the ``config.add_zodbconn_lifecycle_hook`` directive to add a
+    :class:`ConnectionLifecycleHook`, which is called directly instead.
     """
+    settings = config.registry.settings
     databases = config.registry._zodb_databases = {}
-    for name, uri in get_uris(config.registry.settings):
-        db = db_from_uri(uri, name, databases)
-        # ^^ side effect: populate "databases"
-        db.setActivityMonitor(ActivityMonitor())
-    txlog_filename = config.registry.settings.get('zodbconn.transferlog')
+    notifier = get_notifier(config.registry)
+    # after every subscriber of this commit has been registered
+    config.action(None, notifier.update, order=PHASE3_CONFIG + 1)
+    config.add_directive('add_zodbconn_lifecycle_hook', add_lifecycle_hook)
+    shared_caches = config.registry._zodb_shared_caches = {}
+    shared_cache_size = settings.get('zodbconn.shared_cache_size')
+    if shared_cache_size:
+        try:
+            shared_cache_size = parse_size(shared_cache_size)
+        except ValueError:
+            raise ConfigurationError(
+                'Invalid zodbconn.shared_cache_size: %r' % shared_cache_size)
+        db_from_uri = shared_cache_factory(
+            db_from_uri, shared_cache_size, shared_caches)
+    lazy = asbool(settings.get('zodbconn.lazy', False))
+    open_threads = int(settings.get('zodbconn.open_threads', 1))
+    if lazy:
+        for name, uri in get_uris(settings):
+            databases[name] = LazyDB(uri, name, databases, db_from_uri)
+    elif open_threads > 1:
+        open_databases(
+            get_uris(settings), databases, db_from_uri, open_threads)
+    else:
+        for name, uri in get_uris(settings):
+            db = db_from_uri(uri, name, databases)
+            # ^^ side effect: populate "databases"
+            db.setActivityMonitor(ActivityMonitor())
+    txlog_filename = settings.get('zodbconn.transferlog')
     if txlog_filename is not None:
+        txlog_format = settings.get('zodbconn.transferlog_format', 'csv')
+        txlog_format = txlog_format.strip()
+        txlog_threshhold = settings.get('zodbconn.transferlog_threshhold')
+        if txlog_threshhold is not None:
+            txlog_threshhold = float(txlog_threshhold)
+        sample_rate = settings.get('zodbconn.transferlog_sample_rate')
+        max_rate = settings.get('zodbconn.transferlog_max_rate')
+        transferlog = TransferLog(
+            None,
+            txlog_threshhold,
+            sample_rate=float(sample_rate) if sample_rate else None,
+            max_rate=float(max_rate) if max_rate else None,
+            format=txlog_format,
+            )
         if txlog_filename.strip() == '':
             stream = sys.stdout
+            if transferlog.binary:
+                stream = getattr(stream, 'buffer', stream)
         else:
-            stream = open(txlog_filename, 'a')
-        txlog_threshhold = config.registry.settings.get(
-            'zodbconn.transferlog_threshhold')
-        if txlog_threshhold is not None:
-            txlog_threshhold = int(txlog_threshhold)
-        transferlog = TransferLog(stream, txlog_threshhold)
+            stream = open(txlog_filename, 'ab' if transferlog.binary else 'a')
+        if asbool(settings.get('zodbconn.transferlog_buffered', False)):
+            stream = BufferedTransferLogWriter(
+                stream,
+                maxlines=int(settings.get(
+                    'zodbconn.transferlog_buffer_size', 10000)),
+                flush_lines=int(settings.get(
+                    'zodbconn.transferlog_flush_lines', 100)),
+                flush_interval=float(settings.get(
+                    'zodbconn.transferlog_flush_interval', 1.0)),
+                overflow=settings.get(
+                    'zodbconn.transferlog_overflow', 'drop').strip(),
+                )
+            atexit.register(stream.close)
+        transferlog.stream = stream
         config.add_subscriber(transferlog.start, ZODBConnectionOpened)
         config.add_subscriber(transferlog.end, ZODBConnectionWillClose)
         config.registry._transferlog = transferlog # for testing only
+    if asbool(settings.get('zodbconn.stats', False)):
+        stats_factory = settings.get('zodbconn.stats_factory')
+        if stats_factory is None:
+            collector = StatsCollector()
+        else:
+            collector = StatsCollector(config.maybe_dotted(stats_factory))
+        config.add_subscriber(collector.start, ZODBConnectionOpened)
+        config.add_subscriber(collector.end, ZODBConnectionWillClose)
+        config.add_subscriber(
+            collector.start_secondary, ZODBSecondaryConnectionOpened)
+        config.registry._zodb_stats_collector = collector # for testing only
+    readonly_predicate = settings.get('zodbconn.readonly_predicate')
+    if readonly_predicate is not None:
+        readonly_predicate = config.maybe_dotted(readonly_predicate)
+    config.registry._zodb_readonly_policy = readonly_policy(
+        settings.get('zodbconn.readonly_methods', '').split(),
+        readonly_predicate,
+        )
+    hotoids_filename = settings.get('zodbconn.hotoids', '').strip()
+    if hotoids_filename:
+        profiler = HotOidProfiler(
+            HotOidProfile(int(settings.get('zodbconn.hotoids_size', 10000))),
+            databases,
+            filename=hotoids_filename,
+            interval=float(settings.get('zodbconn.hotoids_interval', 300)),
+            sample_rate=float(
+                settings.get('zodbconn.hotoids_sample_rate', 1.0)),
+            )
+        config.add_subscriber(profiler.start, ZODBConnectionOpened)
+        config.add_subscriber(profiler.end, ZODBConnectionWillClose)
+        config.add_subscriber(profiler.writer.start, ApplicationCreated)
+        config.registry._zodb_hotoids = profiler # for testing only
+    load_trace_filename = settings.get('zodbconn.load_trace')
+    if load_trace_filename is not None:
+        if load_trace_filename.strip() == '':
+            stream = sys.stdout
+        else:
+            stream = open(load_trace_filename, 'a')
+        threshold = settings.get('zodbconn.load_trace_threshold')
+        sample_rate = settings.get('zodbconn.load_trace_sample_rate')
+        tracer = LoadTracer(
+            stream,
+            threshold=float(threshold) if threshold else None,
+            sample_rate=float(sample_rate) if sample_rate else None,
+            max_loads=int(settings.get('zodbconn.load_trace_max_loads', 10000)),
+            )
+        config.add_subscriber(tracer.start, ZODBConnectionOpened)
+        config.add_subscriber(
+            tracer.start_secondary, ZODBSecondaryConnectionOpened)
+        config.add_subscriber(tracer.end, ZODBConnectionWillClose)
+        config.registry._zodb_load_tracer = tracer
+    warmup_entries = parse_entries(settings.get('zodbconn.warmup', '').split())
+    warmup_filename = settings.get('zodbconn.warmup_file', '').strip()
+    if warmup_filename and os.path.exists(warmup_filename):
+        warmup_entries.extend(read_entries(warmup_filename, open=open))
+    if warmup_entries and '' in databases:
+        warmup_connections = settings.get('zodbconn.warmup_connections')
+        if warmup_connections is not None:
+            warmup_connections = int(warmup_connections)
+        warmer = CacheWarmer(
+            databases,
+            warmup_entries,
+            connections=warmup_connections,
+            background=asbool(settings.get('zodbconn.warmup_background')),
+            )
+        config.add_subscriber(warmer.start, ApplicationCreated)
+        config.registry._zodb_warmer = warmer # for testing only
+    memory_budget = settings.get('zodbconn.memory_budget')
+    if memory_budget:
+        try:
+            budget = parse_size(memory_budget)
+        except ValueError:
+            raise ConfigurationError(
+                'Invalid zodbconn.memory_budget: %r' % memory_budget)
+        governor = MemoryGovernor(
+            databases,
+            budget,
+            interval=float(settings.get(
+                'zodbconn.memory_budget_interval', 30)),
+            )
+        config.add_subscriber(governor.start, ApplicationCreated)
+        config.registry._zodb_governor = governor # for testing only
+    idle_time = settings.get('zodbconn.idle_trim')
+    if idle_time:
+        keep = settings.get('zodbconn.idle_keep')
+        trimmer = IdleTrimmer(
+            databases,
+            idle_time=float(idle_time),
+            interval=float(settings.get('zodbconn.idle_trim_interval', 60)),
+            batch=int(settings.get('zodbconn.idle_trim_batch', 10)),
+            keep=int(keep) if keep else None,
+            )
+        config.add_subscriber(trimmer.start, ApplicationCreated)
+        config.registry._zodb_trimmer = trimmer # for testing only
+    prefetch_threads = settings.get('zodbconn.prefetch_threads')
+    config.registry._zodb_prefetch_threads = (
+        int(prefetch_threads) if prefetch_threads else None)
+    async_threads = settings.get('zodbconn.async_threads')
+    config.registry._zodb_async_threads = (
+        int(async_threads) if async_threads else None)
+    limiter = None
+    pool_limit = settings.get('zodbconn.pool_limit')
+    if pool_limit:
+        pool_timeout = settings.get('zodbconn.pool_timeout')
+        limiter = ConnectionLimiter(
+            int(pool_limit),
+            timeout=float(pool_timeout) if pool_timeout else None,
+            )
+    config.registry._zodb_limiter = limiter
+    readahead = None
+    if asbool(settings.get('zodbconn.readahead', False)):
+        readahead = ReadAhead(
+            config.registry,
+            trigger=int(settings.get('zodbconn.readahead_trigger', 3)),
+            max_oids=int(settings.get('zodbconn.readahead_max_oids', 100)),
+            min_support=float(settings.get(
+                'zodbconn.readahead_min_support', 0.5)),
+            max_routes=int(settings.get(
+                'zodbconn.readahead_max_routes', 100)),
+            )
+        config.add_subscriber(readahead.start, ZODBConnectionOpened)
+        config.add_subscriber(readahead.end, ZODBConnectionWillClose)
+    config.registry._zodb_readahead = readahead
+    cleanup = None
+    if asbool(settings.get('zodbconn.background_cleanup', False)):
+        cleanup = CleanupExecutor(
+            threads=int(settings.get('zodbconn.cleanup_threads', 1)),
+            max_pending=int(settings.get(
+                'zodbconn.cleanup_max_pending', 100)),
+            )
+        atexit.register(cleanup.shutdown)
+    config.registry._zodb_cleanup = cleanup
+    config.registry._zodb_subrequest_reuse = asbool(
+        settings.get('zodbconn.subrequest_reuse', False))
+    if asbool(settings.get('zodbconn.route_stats', False)):
+        route_stats = RouteStats(
+            filename=settings.get('zodbconn.route_stats_file') or None,
+            interval=float(settings.get(
+                'zodbconn.route_stats_interval', 300)),
+            max_endpoints=int(settings.get(
+                'zodbconn.route_stats_max_endpoints', 1000)),
+            )
+        config.add_subscriber(route_stats.start, ZODBConnectionOpened)
+        config.add_subscriber(route_stats.end, ZODBConnectionWillClose)
+        if route_stats.filename:
+            config.add_subscriber(route_stats.writer.start, ApplicationCreated)
+        route_stats_path = settings.get('zodbconn.route_stats_path')
+        if route_stats_path:
+            config.add_route('zodbconn_route_stats', route_stats_path)
+            config.add_view(
+                route_stats_view,
+                route_name='zodbconn_route_stats',
+                permission=settings.get('zodbconn.route_stats_permission'),
+                )
+        config.registry._zodb_route_stats = route_stats
+    if asbool(settings.get('zodbconn.class_stats', False)):
+        class_stats = ClassStats(
+            max_classes=int(settings.get(
+                'zodbconn.class_stats_max_classes', 1000)),
+            sample_rate=float(settings.get(
+                'zodbconn.class_stats_sample_rate', 1.0)),
+            )
+        config.add_subscriber(class_stats.start, ZODBConnectionOpened)
+        config.add_subscriber(
+            class_stats.start_secondary, ZODBSecondaryConnectionOpened)
+        config.add_subscriber(class_stats.end, ZODBConnectionWillClose)
+        class_stats_path = settings.get('zodbconn.class_stats_path')
+        if class_stats_path:
+            config.add_route('zodbconn_class_stats', class_stats_path)
+            config.add_view(
+                class_stats_view,
+                route_name='zodbconn_class_stats',
+                permission=settings.get('zodbconn.class_stats_permission'),
+                )
+        config.registry._zodb_class_stats = class_stats
+    metrics_path = settings.get('zodbconn.metrics_path')
+    if metrics_path:
+        config.add_route('zodbconn_metrics', metrics_path)
+        config.add_view(
+            metrics_view,
+            route_name='zodbconn_metrics',
+            permission=settings.get('zodbconn.metrics_permission'),
+            )
+    statsd_address = settings.get('zodbconn.statsd')
+    if statsd_address:
+        pusher = StatsdPusher(
+            databases,
+            parse_address(statsd_address),
+            prefix=settings.get('zodbconn.statsd_prefix', 'zodb'),
+            interval=float(settings.get('zodbconn.metrics_interval', 60)),
+            limiter=limiter,
+            shared_caches=shared_caches,
+            readahead=readahead,
+            cleanup=cleanup,
+            )
+        config.add_subscriber(pusher.start, ApplicationCreated)
+        config.registry._zodb_statsd = pusher # for testing only
@@ -0,0 +1,95 @@
+""" asyncio support (Python 3.5 and later). """
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import transaction
+from pyramid.exceptions import ConfigurationError
+from pyramid.threadlocal import manager
+
+from .cleanup import is_thread_local
+
+# the default pool size of ZODB databases
+DEFAULT_THREADS = 7
+
+_lock = threading.Lock()
+
+def get_executor(registry):
+    """ Return the thread pool which opens and closes connections for
+    :func:`aget_connection` and :func:`aclose_connection`, creating it if
+    necessary.  It has ``zodbconn.async_threads`` threads, by default as
+    many as the primary database's connection pool holds, so that no more
+    connections are opened at the same time than the pool can take back. """
+    from pyramid_zodbconn import is_loaded
+    executor = getattr(registry, '_zodb_executor', None)
+    if executor is None:
+        with _lock:
+            executor = getattr(registry, '_zodb_executor', None)
+            if executor is None:
+                threads = getattr(registry, '_zodb_async_threads', None)
+                if threads is None:
+                    db = getattr(registry, '_zodb_databases', {}).get('')
+                    if db is not None and is_loaded(db):
+                        threads = db.getPoolSize()
+                    else:
+                        threads = DEFAULT_THREADS
+                executor = ThreadPoolExecutor(threads)
+                registry._zodb_executor = executor
+    return executor
+
+def run_in_executor(request, func, *args):
+    """ Call ``func(*args)`` in a thread of :func:`get_executor`, with
+    ``request`` and its registry as the current request and registry. """
+    registry = request.registry
+    def call():
+        manager.push({'request': request, 'registry': registry})
+        try:
+            return func(*args)
+        finally:
+            manager.pop()
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(get_executor(registry), call)
+
+async def aget_connection(request, dbname=None):
+    """ Like :func:`pyramid_zodbconn.get_connection`, but opening the
+    connection, which may block on the storage, is done by a thread of
+    :func:`get_executor` while the event loop goes on.
+
+    A thread-local transaction manager doesn't work across threads, so if
+    ``request.tm`` isn't set, the request gets a transaction manager of its
+    own; if it is a thread-local one (such as ``transaction.manager``, the
+    default of ``pyramid_tm``), ``ConfigurationError`` is raised.  The
+    connection is closed when the request is finished, or earlier by
+    awaiting :func:`aclose_connection`."""
+    from pyramid_zodbconn import get_connection
+    tm = getattr(request, 'tm', None)
+    if tm is None:
+        request.tm = transaction.TransactionManager()
+    elif is_thread_local(tm):
+        # replacing it would silently lose the changes, as whoever set it
+        # commits that one
+        raise ConfigurationError(
+            'aget_connection needs a transaction manager which is not bound '
+            'to a thread, request.tm is %r (with pyramid_tm, set '
+            'tm.manager_hook = pyramid_tm.explicit_manager)' % (tm,))
+    return await run_in_executor(request, get_connection, request, dbname)
+
+async def aclose_connection(request):
+    """ Abort the transaction of the connections ``request`` opened and
+    close them in a thread of :func:`get_executor`, sending the same events
+    as when the request is finished.  Do nothing if the request has no open
+    connection. """
+    finished = getattr(request, '_zodb_finished', None)
+    if finished is None:
+        return
+    del request._zodb_finished
+    try:
+        request.finished_callbacks.remove(finished)
+    except ValueError:
+        pass
+    try:
+        await run_in_executor(request, finished, request)
+    finally:
+        del request._primary_zodb_conn
+        if getattr(request, '_zodb_secondary_conns', None) is not None:
+            del request._zodb_secondary_conns
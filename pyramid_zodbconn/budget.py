@@ -0,0 +1,199 @@
+import re
+import time
+
+from .periodic import PeriodicThread
+
+# the smallest per-connection cache targets the governor ever sets, in
+# objects and in bytes (a byte target of 0 would mean no limit at all)
+MIN_CACHE_SIZE = 100
+MIN_CACHE_SIZE_BYTES = 64 * 1024
+
+# room given to a database which uses less than its share, so that it can
+# still grow a little until the next adjustment
+HEADROOM = 1.25
+
+SIZE_RE = re.compile(r'^\s*(\d+)\s*([kmg]?)b?\s*$', re.IGNORECASE)
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+def parse_size(value):
+    """ Parse a number of bytes with an optional ``KB``, ``MB`` or ``GB``
+    suffix (multiples of 1024). """
+    match = SIZE_RE.match(value)
+    if match is None:
+        raise ValueError('Invalid size: %r' % value)
+    number, unit = match.groups()
+    return int(number) * UNITS[unit.lower()]
+
+def allocate(budget, demands):
+    """ Divide ``budget`` bytes among databases.  ``demands`` maps database
+    names to ``(weight, demand)`` tuples: the budget is shared in proportion
+    to the weights, but a database never gets more than its ``demand``
+    (``None`` meaning no limit), and what it leaves is shared among the
+    others.  Return a dictionary mapping the names to bytes. """
+    result = {}
+    pending = dict(demands)
+    while pending:
+        total_weight = sum(weight for weight, demand in pending.values())
+        satisfied = [
+            name for name, (weight, demand) in pending.items()
+            if demand is not None
+            and demand <= budget * weight / total_weight]
+        if not satisfied:
+            for name, (weight, demand) in pending.items():
+                result[name] = int(budget * weight / total_weight)
+            break
+        for name in satisfied:
+            weight, demand = pending.pop(name)
+            result[name] = int(demand)
+            budget -= demand
+    return result
+
+class DatabaseUsage(object):
+    """ The cache usage of one database: ``size`` is the estimated number
+    of bytes held by the caches of all its connections, ``objects`` the
+    number of non-ghost objects in them, ``connections`` the number of
+    connections and ``loads`` the number of objects loaded from storage
+    during the last interval. """
+    def __init__(self, size=0, objects=0, connections=0, loads=0):
+        self.size = size
+        self.objects = objects
+        self.connections = connections
+        self.loads = loads
+
+    @classmethod
+    def measure(cls, db, interval, now):
+        usage = cls()
+        def measure(conn):
+            usage.size += conn._cache.total_estimated_size
+            usage.objects += conn._cache.cache_non_ghost_count
+            usage.connections += 1
+        db._connectionMap(measure)
+        am = db.getActivityMonitor()
+        if am is not None:
+            usage.loads = am.getActivityAnalysis(
+                start=now - interval, end=now, divisions=1)[0]['loads']
+        return usage
+
+def idle_connections(db, func):
+    """ Call ``func`` with every connection of ``db`` which sits unused in
+    its pool, and the connections to other databases attached to it, and
+    return true.  The pool is locked meanwhile, so none of them can be
+    opened; if it is locked already, because a request is opening or
+    closing a connection, nothing is done and false is returned, so that
+    requests never wait for the governor. """
+    if not db._lock.acquire(False):
+        return False
+    try:
+        for t, conn in db.pool.available:
+            for c in conn.connections.values():
+                func(c)
+    finally:
+        db._lock.release()
+    return True
+
+class MemoryGovernor(PeriodicThread):
+    """ Keeps the object caches of all connections of all databases in
+    ``databases`` within ``budget`` bytes (as estimated by the caches).
+
+    Every ``interval`` seconds :meth:`adjust` shares the budget among the
+    databases in proportion to the objects they loaded from storage during
+    the last interval (a database which loaded nothing only keeps what it
+    uses, plus some headroom), and divides each share among the database's
+    connections.  The per-connection share becomes the cache byte target of
+    the database, and the cache object target is set to the number of
+    objects of the database's average size which fit into it.  Unused
+    pooled connections are garbage collected right away; connections in use
+    shrink when they are closed.  If that isn't enough to get under the
+    budget, the caches of unused connections of the databases over their
+    share are minimized.  A database whose pool is locked by a request is
+    left alone until the next run (counted in ``skipped``), so the governor
+    never makes a request wait.
+
+    :meth:`start` and :meth:`stop` start and stop the thread which adjusts
+    the caches (see :class:`pyramid_zodbconn.periodic.PeriodicThread`). """
+    def __init__(self, databases, budget, interval=30, time=time):
+        # XXX time is parameterized only for testing
+        PeriodicThread.__init__(
+            self, 'pyramid_zodbconn-governor', self.adjust, interval)
+        self.databases = databases
+        self.budget = budget
+        self._time = time
+        self.targets = {}
+        self.usage = 0
+        self.runs = 0
+        self.collected = 0
+        self.minimized = 0
+        self.skipped = 0
+
+    def measure(self):
+        from pyramid_zodbconn import is_loaded
+        now = self._time.time()
+        usages = {}
+        for name, db in list(self.databases.items()):
+            if not is_loaded(db):
+                continue
+            if not db._lock.acquire(False):
+                # busy, measure it next time
+                self.skipped += 1
+                continue
+            try:
+                usages[name] = DatabaseUsage.measure(db, self.interval, now)
+            finally:
+                db._lock.release()
+        return usages
+
+    def adjust(self):
+        """ Measure the caches, set new targets and collect garbage. """
+        usages = self.measure()
+        demands = {}
+        for name, usage in usages.items():
+            demand = None
+            if not usage.loads:
+                demand = usage.size * HEADROOM
+            demands[name] = (usage.loads + 1, demand)
+        shares = allocate(self.budget, demands)
+        targets = {}
+        for name, usage in usages.items():
+            db = self.databases[name]
+            target = max(shares[name] // max(usage.connections, 1),
+                         MIN_CACHE_SIZE_BYTES)
+            targets[name] = target
+            if not db._lock.acquire(False):
+                # busy, set the targets next time
+                self.skipped += 1
+                continue
+            try:
+                # the lock is reentrant, ZODB takes it again
+                db.setCacheSizeBytes(target)
+                if usage.objects and usage.size:
+                    average = float(usage.size) / usage.objects
+                    db.setCacheSize(
+                        max(int(target / average), MIN_CACHE_SIZE))
+            finally:
+                db._lock.release()
+        self.targets = targets
+        self.runs += 1
+        self.usage = sum(usage.size for usage in usages.values())
+        primary = self.databases.get('')
+        if self.usage <= self.budget or primary is None:
+            return
+        def collect(conn):
+            conn._cache.incrgc()
+            self.collected += 1
+        if not idle_connections(primary, collect):
+            self.skipped += 1
+            return
+        usages = self.measure()
+        self.usage = sum(usage.size for usage in usages.values())
+        if self.usage <= self.budget:
+            return
+        over = set(name for name, usage in usages.items()
+                   if usage.size > shares[name])
+        def minimize(conn):
+            if conn.db().database_name in over:
+                conn._cache.minimize()
+                self.minimized += 1
+        if not idle_connections(primary, minimize):
+            self.skipped += 1
+            return
+        self.usage = sum(usage.size for usage in self.measure().values())
@@ -0,0 +1,156 @@
+import json
+import random
+import sys
+import threading
+
+from pyramid.response import Response
+
+from .stats import (
+    Recorder,
+    instrument,
+    )
+from .trace import pickle_class
+
+# the label of the classes over the limit
+OTHER = '(other)'
+
+class ClassHistogram(object):
+    """ The number of loads and the pickle bytes loaded per class of one
+    database.  At most ``max_classes`` classes are told apart, the loads of
+    any further ones are counted as ``(other)``. """
+    def __init__(self, max_classes=1000):
+        self.max_classes = max_classes
+        # class name -> [loads, bytes, largest pickle]
+        self.classes = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, size):
+        with self._lock:
+            counts = self.classes.get(name)
+            if counts is None:
+                if len(self.classes) >= self.max_classes:
+                    name = OTHER
+                    counts = self.classes.get(name)
+                if counts is None:
+                    counts = self.classes[name] = [0, 0, 0]
+            counts[0] += 1
+            counts[1] += size
+            if size > counts[2]:
+                counts[2] = size
+
+    def report(self):
+        """ Return a list of dictionaries with the ``class`` name, the
+        number of ``loads``, the total ``bytes``, the ``mean`` and the
+        ``max`` pickle size of each class, most bytes first. """
+        with self._lock:
+            items = [(name, list(counts))
+                     for name, counts in self.classes.items()]
+        items.sort(key=lambda item: (-item[1][1], item[0]))
+        return [
+            {'class': name, 'loads': loads, 'bytes': size,
+             'mean': size // loads, 'max': largest}
+            for name, (loads, size, largest) in items]
+
+class ClassRecorder(Recorder):
+    """ Adds the records loaded by a connection to a
+    :class:`ClassHistogram`. """
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def record_load(self, oid, data, elapsed):
+        self.histogram.add(pickle_class(data), len(data))
+
+class ClassStats(object):
+    """ Keeps a :class:`ClassHistogram` per database, fed with the records
+    loaded through the connections opened by
+    :func:`pyramid_zodbconn.get_connection` for ``sample_rate`` of the
+    requests.
+
+    :meth:`start`, :meth:`start_secondary` and :meth:`end` are subscribers
+    for the connection opened, secondary connection opened and will-close
+    events. """
+    key = '_pyramid_zodbconn_classstats'
+
+    def __init__(self, max_classes=1000, sample_rate=1.0,
+                 random=random.random):
+        # XXX random is parameterized only for testing
+        self.max_classes = max_classes
+        self.sample_rate = sample_rate
+        self.random = random
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, dbname):
+        histogram = self.histograms.get(dbname)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.get(dbname)
+                if histogram is None:
+                    histogram = ClassHistogram(self.max_classes)
+                    self.histograms[dbname] = histogram
+        return histogram
+
+    def start(self, event):
+        if self.sample_rate < 1.0 and self.random() >= self.sample_rate:
+            return
+        recorders = {}
+        setattr(event.request, self.key, recorders)
+        for dbname, conn in event.conn.connections.items():
+            self._track(recorders, dbname, conn)
+
+    def start_secondary(self, event):
+        recorders = getattr(event.request, self.key, None)
+        if recorders is not None:
+            self._track(recorders, event.dbname, event.conn)
+
+    def _track(self, recorders, dbname, conn):
+        if dbname in recorders:
+            return
+        recorder = ClassRecorder(self.histogram(dbname))
+        instrument(conn).add_recorder(recorder)
+        recorders[dbname] = (conn, recorder)
+
+    def end(self, event):
+        recorders = getattr(event.request, self.key, None)
+        if recorders is None:
+            return
+        for conn, recorder in recorders.values():
+            conn._normal_storage.remove_recorder(recorder)
+        delattr(event.request, self.key)
+
+    def report(self):
+        """ Return a dictionary mapping database names to the
+        :meth:`ClassHistogram.report` of the database. """
+        return dict(
+            (dbname, histogram.report())
+            for dbname, histogram in list(self.histograms.items()))
+
+    def dump(self, out=None, n=None):
+        """ Write the report as a table, listing the ``n`` classes with
+        the most bytes of each database (all of them by default). """
+        if out is None:
+            out = sys.stdout
+        for dbname, rows in sorted(self.report().items()):
+            out.write('Database %r:\n' % dbname)
+            out.write('%10s %14s %10s %10s  %s\n' % (
+                'loads', 'bytes', 'mean', 'max', 'class'))
+            for row in rows[:n]:
+                out.write('%(loads)10d %(bytes)14d %(mean)10d %(max)10d  '
+                          '%(class)s\n' % row)
+            out.write('\n')
+
+def dump(registry, out=None, n=None):
+    """ Write the class statistics collected for the application of
+    ``registry`` to ``out`` (stdout by default), for instance from
+    ``pshell``.  See :meth:`ClassStats.dump`. """
+    stats = getattr(registry, '_zodb_class_stats', None)
+    if stats is None:
+        raise ValueError('zodbconn.class_stats is not enabled')
+    stats.dump(out, n)
+
+def class_stats_view(request):
+    """ A Pyramid view which renders the report as JSON. """
+    stats = request.registry._zodb_class_stats
+    response = Response(json.dumps(stats.report(), sort_keys=True))
+    response.content_type = 'application/json'
+    return response
@@ -0,0 +1,137 @@
+""" Closing connections after the response has been sent. """
+import collections
+import sys
+import threading
+import time
+import traceback
+
+import transaction
+from pyramid.threadlocal import manager
+
+class CleanupExecutor(object):
+    """ Runs the end-of-request cleanup of connections (aborting their
+    transaction and closing them) in ``threads`` daemon threads, so that it
+    doesn't delay completing the response.
+
+    At most ``max_pending`` cleanups are queued or running; a cleanup
+    submitted when that many are is run right away by the caller instead
+    (and counted in ``inline``), as is any cleanup submitted after
+    :meth:`shutdown`.  ``completed`` counts the cleanups run in the
+    threads, ``errors`` those of them which raised an exception (its
+    traceback is printed to ``sys.stderr``, as there is nobody to raise it
+    to), and ``seconds`` and ``max_seconds`` the total and longest time
+    cleanups took, wherever they were run. """
+    def __init__(self, threads=1, max_pending=100, time=time):
+        # XXX time is parameterized only for testing
+        self.threads = threads
+        self.max_pending = max_pending
+        self.completed = 0
+        self.inline = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.pending = 0
+        self.closed = False
+        self._time = time
+        self._tasks = collections.deque()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def submit(self, request, func):
+        """ Call ``func()`` in a thread, with ``request`` and its registry
+        as the current request and registry, or right away if too many
+        cleanups are pending. """
+        with self._cond:
+            background = not self.closed and self.pending < self.max_pending
+            if background:
+                self.pending += 1
+                self._tasks.append((request, func))
+                if len(self._threads) < self.threads:
+                    # started on first use, in the process which serves
+                    # requests
+                    thread = threading.Thread(
+                        target=self._run, name='pyramid_zodbconn-cleanup')
+                    thread.daemon = True
+                    thread.start()
+                    self._threads.append(thread)
+                self._cond.notify()
+            else:
+                self.inline += 1
+        if not background:
+            self.call(func)
+
+    def call(self, func):
+        start = self._time.time()
+        try:
+            func()
+        finally:
+            elapsed = self._time.time() - start
+            with self._cond:
+                self.seconds += elapsed
+                if elapsed > self.max_seconds:
+                    self.max_seconds = elapsed
+
+    def shutdown(self, timeout=None):
+        """ Run the pending cleanups and stop the threads. """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _take(self):
+        with self._cond:
+            while not self._tasks and not self.closed:
+                self._cond.wait()
+            if self._tasks:
+                return self._tasks.popleft()
+            return None
+
+    def _run(self):
+        while True:
+            task = self._take()
+            if task is None:
+                break
+            request, func = task
+            manager.push({'request': request, 'registry': request.registry})
+            try:
+                self.call(func)
+            except Exception:
+                with self._cond:
+                    self.errors += 1
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                manager.pop()
+            with self._cond:
+                self.pending -= 1
+                self.completed += 1
+
+    def stats(self):
+        """ Return a dictionary of the counters. """
+        with self._cond:
+            return dict(
+                cleanup_pending=self.pending,
+                cleanup_completed=self.completed,
+                cleanup_inline=self.inline,
+                cleanup_errors=self.errors,
+                cleanup_seconds=self.seconds,
+                cleanup_max_seconds=self.max_seconds,
+                )
+
+def is_thread_local(tm):
+    """ Return true if the transaction manager ``tm`` is bound to the
+    current thread: ``transaction.manager``, or the manager it uses for the
+    current thread (which ZODB gives the connections opened without a
+    transaction manager, such as those of requests without ``request.tm``).
+    A connection using it can't be used by another thread, and the thread
+    goes on using the manager for its next requests. """
+    return (isinstance(tm, transaction.ThreadTransactionManager) or
+            tm is transaction.manager.manager)
+
+def can_defer(conn):
+    """ Return true if the cleanup of ``conn`` may be run by another thread:
+    that is only the case when its transaction manager belongs to the
+    request alone, as aborting a thread's transaction manager later would
+    abort the transaction of whichever request the thread serves by then.
+    Must be called by the request thread. """
+    return not is_thread_local(conn.transaction_manager)
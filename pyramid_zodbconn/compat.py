@@ -3,11 +3,24 @@ import sys
 # True if we are running on Python 3.
 PY3 = sys.version_info[0] == 3
 
+# True if async/await syntax is available.
+PY35 = sys.version_info >= (3, 5)
+
 if PY3: # pragma: no cover
     binary_type = bytes
 else:
     binary_type = str
 
+if PY3: # pragma: no cover
+    def reraise(tp, value, tb=None):
+        if value.__traceback__ is not tb:
+            raise value.with_traceback(tb)
+        raise value
+else: # pragma: no cover
+    exec("""def reraise(tp, value, tb=None):
+    raise tp, value, tb
+""")
+
 def text_(s, encoding='latin-1', errors='strict'):
     """ If ``s`` is an instance of ``binary_type``, return
     ``s.decode(encoding, errors)``, otherwise return ``s``"""
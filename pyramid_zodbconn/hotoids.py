@@ -0,0 +1,148 @@
+import heapq
+import os
+import random
+import threading
+
+from ZODB.utils import u64
+
+from .periodic import PeriodicThread
+from .stats import (
+    Recorder,
+    instrument,
+    )
+
+class HotOidProfile(object):
+    """ A bounded frequency table of the oids loaded from storage.
+
+    At most ``size`` oids are tracked: whenever the table grows to twice
+    that, the least frequently loaded half is dropped (and counted in
+    ``pruned``).  Oids which are loaded often stay in the table, so its top
+    entries approximate the working set of the application. """
+    def __init__(self, size=10000):
+        self.size = size
+        self.counts = {}
+        self.requests = 0
+        self.loads = 0
+        self.pruned = 0
+        self._lock = threading.Lock()
+
+    def add(self, oids):
+        """ Add the oids loaded by one request. """
+        with self._lock:
+            self.requests += 1
+            self.loads += len(oids)
+            counts = self.counts
+            for oid in oids:
+                counts[oid] = counts.get(oid, 0) + 1
+            if len(counts) > 2 * self.size:
+                keep = heapq.nlargest(
+                    self.size, counts.items(), key=lambda item: item[1])
+                self.pruned += len(counts) - len(keep)
+                self.counts = dict(keep)
+
+    def top(self, n=None):
+        """ Return a list of ``(oid, count)`` tuples, most loaded first. """
+        with self._lock:
+            items = list(self.counts.items())
+        items.sort(key=lambda item: (-item[1], item[0]))
+        if n is not None:
+            items = items[:n]
+        return items
+
+    def hot_set(self, fraction):
+        """ Return the number of (most loaded) oids which together account
+        for ``fraction`` of the loads in the table. """
+        top = self.top()
+        wanted = fraction * sum(count for oid, count in top)
+        total = 0
+        for n, (oid, count) in enumerate(top):
+            if total >= wanted:
+                return n
+            total += count
+        return len(top)
+
+    def report(self, cache_size=None):
+        """ Return a dictionary describing the profile.  When
+        ``cache_size`` (the per-connection object cache size) is given,
+        ``covered`` tells whether the objects making up 90% of the loads fit
+        into a connection cache of that size. """
+        hot_set_90 = self.hot_set(0.9)
+        return dict(
+            requests=self.requests,
+            loads=self.loads,
+            tracked=len(self.counts),
+            pruned=self.pruned,
+            hot_set_90=hot_set_90,
+            hot_set_99=self.hot_set(0.99),
+            cache_size=cache_size,
+            covered=None if cache_size is None else hot_set_90 <= cache_size,
+            )
+
+    def write(self, filename, cache_size=None, open=open):
+        """ Write the profile to ``filename``: a commented report followed
+        by one ``<oid in hex> <count>`` line per oid, most loaded first.
+        The file can be used as a ``zodbconn.warmup_file``.  It is written
+        to a temporary file first and renamed into place. """
+        report = self.report(cache_size)
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            f.write('# pyramid_zodbconn hot oid profile\n')
+            for key in sorted(report):
+                f.write('# %s: %s\n' % (key, report[key]))
+            for oid, count in self.top():
+                f.write('0x%x %d\n' % (u64(oid), count))
+        os.rename(tmpname, filename)
+
+class OidRecorder(Recorder):
+    """ Remembers the oids loaded by one request. """
+    def __init__(self):
+        self.oids = []
+
+    def record_load(self, oid, data, elapsed):
+        self.oids.append(oid)
+
+class HotOidProfiler(object):
+    """ Samples ``sample_rate`` of the requests and adds the oids they load
+    through the primary connection to ``profile``.  :meth:`start` and
+    :meth:`end` are subscribers for the connection opened and will-close
+    events.  If ``filename`` is given, the profile is written to it every
+    ``interval`` seconds by the
+    :class:`pyramid_zodbconn.periodic.PeriodicThread` ``writer``, and once
+    more when it is stopped or the process exits. """
+    key = '_pyramid_zodbconn_hotoids'
+
+    def __init__(self, profile, databases, filename=None, interval=300,
+                 sample_rate=1.0, random=random.random):
+        # XXX random is parameterized only for testing
+        self.profile = profile
+        self.databases = databases
+        self.filename = filename
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.random = random
+        self.writer = PeriodicThread(
+            'pyramid_zodbconn-hotoids', self.write, interval, final=True)
+
+    def start(self, event):
+        if self.sample_rate < 1.0 and self.random() >= self.sample_rate:
+            return
+        recorder = OidRecorder()
+        instrument(event.conn).add_recorder(recorder)
+        setattr(event.request, self.key, recorder)
+
+    def end(self, event):
+        recorder = getattr(event.request, self.key, None)
+        if recorder is None:
+            return
+        event.conn._normal_storage.remove_recorder(recorder)
+        self.profile.add(recorder.oids)
+
+    def cache_size(self):
+        from pyramid_zodbconn import is_loaded
+        db = self.databases.get('')
+        if db is None or not is_loaded(db):
+            return None
+        return db.getCacheSize()
+
+    def write(self):
+        self.profile.write(self.filename, self.cache_size())
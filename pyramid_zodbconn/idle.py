@@ -0,0 +1,85 @@
+import time
+import weakref
+
+from .periodic import PeriodicThread
+
+class IdleTrimmer(PeriodicThread):
+    """ Releases the memory held by pooled connections nobody uses.
+
+    Every ``interval`` seconds, :meth:`trim` walks the pools of the
+    databases in ``databases`` and minimizes the object caches of at most
+    ``batch`` connections (and the connections to other databases attached
+    to them) which have been idle for more than ``idle_time`` seconds.  If
+    ``keep`` is not ``None``, idle connections beyond the ``keep`` most
+    recently used ones of a pool are closed for good.  A pool which is
+    locked because a request is opening or closing a connection is skipped
+    until the next run, so the trimmer never makes a request wait.
+
+    ``trimmed`` and ``closed`` count the connections trimmed and closed.
+    :meth:`start` and :meth:`stop` start and stop the thread which trims
+    them (see :class:`pyramid_zodbconn.periodic.PeriodicThread`). """
+    def __init__(self, databases, idle_time=300, interval=60, batch=10,
+                 keep=None, time=time):
+        # XXX time is parameterized only for testing
+        PeriodicThread.__init__(
+            self, 'pyramid_zodbconn-idle', self.trim, interval)
+        self.databases = databases
+        self.idle_time = idle_time
+        self.batch = batch
+        self.keep = keep
+        self.trimmed = 0
+        self.closed = 0
+        self._time = time
+        # connection -> time it was returned to the pool when last trimmed
+        self._done = weakref.WeakKeyDictionary()
+
+    def trim(self):
+        """ Trim idle connections, return the number trimmed. """
+        from pyramid_zodbconn import is_loaded
+        budget = self.batch
+        for name, db in list(self.databases.items()):
+            if budget <= 0:
+                break
+            if not is_loaded(db):
+                continue
+            budget -= self.trim_pool(db, budget)
+        return self.batch - budget
+
+    def trim_pool(self, db, budget):
+        if not db._lock.acquire(False):
+            # busy, try again next time
+            return 0
+        try:
+            threshold = self._time.time() - self.idle_time
+            pool = db.pool
+            idle = [(t, conn) for t, conn in pool.available if t < threshold]
+            if self.keep is not None:
+                # keep the most recently returned connections
+                by_age = sorted(pool.available, key=lambda item: item[0])
+                surplus = by_age[:max(len(by_age) - self.keep, 0)]
+                for item in surplus:
+                    if item[0] < threshold:
+                        self.close(pool, item)
+                        idle.remove(item)
+            count = 0
+            for t, conn in idle:
+                if count >= budget:
+                    break
+                if self._done.get(conn) == t:
+                    continue
+                for c in conn.connections.values():
+                    c._cache.minimize()
+                self._done[conn] = t
+                count += 1
+            self.trimmed += count
+            return count
+        finally:
+            db._lock.release()
+
+    def close(self, pool, item):
+        # what ZODB's ConnectionPool does with connections it has too many of
+        pool.available.remove(item)
+        t, conn = item
+        pool.all.remove(conn)
+        conn._release_resources()
+        self.closed += 1
@@ -0,0 +1,217 @@
+import socket
+import time
+
+from pyramid.response import Response
+
+from .periodic import PeriodicThread
+
+PRIMARY_LABEL = 'primary'
+
+GAUGE = 'gauge'
+# only ever increases (until the process is restarted)
+COUNTER = 'counter'
+
+# (name, type, help) in the order they are rendered
+METRICS = (
+    ('loads', GAUGE, 'Objects loaded from storage during the last interval.'),
+    ('stores', GAUGE, 'Objects stored during the last interval.'),
+    ('connection_closes', GAUGE,
+     'Connections closed during the last interval.'),
+    ('pool_size', GAUGE, 'Configured connection pool size.'),
+    ('connections', GAUGE, 'Connections known to the pool.'),
+    ('connections_open', GAUGE, 'Connections currently opened.'),
+    ('cache_size', GAUGE, 'Configured per-connection object cache size.'),
+    ('cache_objects', GAUGE,
+     'Objects (including ghosts) in all object caches.'),
+    ('cache_non_ghost_objects', GAUGE,
+     'Non-ghost objects in all object caches.'),
+    # only reported for the primary database when zodbconn.pool_limit is set
+    ('pool_limit', GAUGE,
+     'Maximum number of connections open at the same time.'),
+    ('pool_in_use', GAUGE, 'Connections counted against the pool limit.'),
+    ('pool_waiting', GAUGE, 'Requests currently waiting for a connection.'),
+    ('pool_waits', COUNTER, 'Requests which had to wait for a connection.'),
+    ('pool_wait_seconds', COUNTER,
+     'Total seconds requests waited for a connection.'),
+    ('pool_rejections', COUNTER,
+     'Requests which timed out waiting for a connection.'),
+    # only reported when zodbconn.shared_cache_size is set
+    ('shared_cache_bytes', GAUGE, 'Bytes of records in the shared cache.'),
+    ('shared_cache_records', GAUGE, 'Records in the shared cache.'),
+    ('shared_cache_hits', COUNTER, 'Loads served from the shared cache.'),
+    ('shared_cache_misses', COUNTER,
+     'Loads passed on to storage by the shared cache.'),
+    ('shared_cache_evictions', COUNTER,
+     'Records evicted from the shared cache.'),
+    # only reported for the primary database when zodbconn.readahead is set
+    ('readahead_requests', COUNTER,
+     'Requests for which objects were read ahead.'),
+    ('readahead_predicted', COUNTER, 'Objects read ahead.'),
+    ('readahead_used', COUNTER,
+     'Objects read ahead which requests then loaded.'),
+    # only reported for the primary database when
+    # zodbconn.background_cleanup is set
+    ('cleanup_pending', GAUGE, 'Connection cleanups queued or running.'),
+    ('cleanup_completed', COUNTER,
+     'Connection cleanups run in the background.'),
+    ('cleanup_inline', COUNTER,
+     'Connection cleanups run by the request thread.'),
+    ('cleanup_errors', COUNTER,
+     'Background connection cleanups which failed.'),
+    ('cleanup_seconds', COUNTER,
+     'Total seconds spent on connection cleanups.'),
+    ('cleanup_max_seconds', GAUGE, 'Longest connection cleanup in seconds.'),
+    )
+
+def collect(databases, interval=60, time=time, limiter=None,
+            shared_caches=None, readahead=None, cleanup=None):
+    """ Return a list of ``(label, metrics)`` tuples, one for each database in
+    ``databases`` (a mapping of names to ``ZODB.DB`` objects, as stored in
+    ``registry._zodb_databases``), sorted by label.  ``metrics`` is a
+    dictionary with a value for each name in ``METRICS``, except for the
+    ``pool_*`` counters, which are only included for the primary database
+    when a :class:`pyramid_zodbconn.pool.ConnectionLimiter` is passed as
+    ``limiter``, the ``shared_cache_*`` counters, which are only included
+    for the databases which have a
+    :class:`pyramid_zodbconn.sharedcache.SharedStateCache` in
+    ``shared_caches`` (a mapping of database names to caches), and the
+    ``readahead_*`` and ``cleanup_*`` counters, which are only included for
+    the primary database when a
+    :class:`pyramid_zodbconn.readahead.ReadAhead` is passed as
+    ``readahead`` and a :class:`pyramid_zodbconn.cleanup.CleanupExecutor`
+    as ``cleanup``.  Load, store and close counts are read from the
+    database's activity monitor and cover the last ``interval`` seconds.
+    Lazily opened databases which have not been used yet are left out. """
+    # XXX time is parameterized only for testing
+    from pyramid_zodbconn import is_loaded
+    now = time.time()
+    result = []
+    for name, db in list(databases.items()):
+        if not is_loaded(db):
+            continue
+        activity = {'loads': 0, 'stores': 0, 'connections': 0}
+        am = db.getActivityMonitor()
+        if am is not None:
+            activity = am.getActivityAnalysis(
+                start=now - interval, end=now, divisions=1)[0]
+        caches = db.cacheDetailSize()
+        opened = [info for info in db.connectionDebugInfo() if info['opened']]
+        metrics = dict(
+            loads=activity['loads'],
+            stores=activity['stores'],
+            connection_closes=activity['connections'],
+            pool_size=db.getPoolSize(),
+            connections=len(caches),
+            connections_open=len(opened),
+            cache_size=db.getCacheSize(),
+            cache_objects=sum(cache['size'] for cache in caches),
+            cache_non_ghost_objects=sum(cache['ngsize'] for cache in caches),
+            )
+        if name == '' and limiter is not None:
+            metrics.update(limiter.stats())
+        if name == '' and readahead is not None:
+            metrics.update(readahead.stats())
+        if name == '' and cleanup is not None:
+            metrics.update(cleanup.stats())
+        if shared_caches and name in shared_caches:
+            metrics.update(shared_caches[name].stats())
+        result.append((name or PRIMARY_LABEL, metrics))
+    result.sort(key=lambda item: item[0])
+    return result
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.6f' % value
+    return '%d' % value
+
+def render_prometheus(collected, prefix='zodb'):
+    """ Render the result of :func:`collect` in the Prometheus text
+    exposition format.  Counters get the ``_total`` suffix. """
+    lines = []
+    for metric, kind, help in METRICS:
+        samples = [(label, metrics[metric]) for label, metrics in collected
+                   if metric in metrics]
+        if not samples:
+            continue
+        name = '%s_%s' % (prefix, metric)
+        if kind == COUNTER:
+            name += '_total'
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for label, value in samples:
+            lines.append('%s{database="%s"} %s' % (
+                name, label.replace('\\', '\\\\').replace('"', '\\"'),
+                format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+def render_statsd(collected, prefix='zodb'):
+    """ Render the result of :func:`collect` as StatsD gauges, one
+    newline-delimited packet per database.  Counters are sent as gauges
+    too, with their value since the process was started (not the increase
+    since the last push), so they drop back to zero when it is
+    restarted. """
+    packets = []
+    for label, metrics in collected:
+        packets.append('\n'.join(
+            '%s.%s.%s:%s|g' % (
+                prefix, label, metric, format_value(metrics[metric]))
+            for metric, kind, help in METRICS if metric in metrics))
+    return packets
+
+def metrics_view(request):
+    """ A Pyramid view which renders the metrics of every configured
+    database in the Prometheus text exposition format. """
+    registry = request.registry
+    settings = registry.settings
+    collected = collect(
+        registry._zodb_databases,
+        interval=float(settings.get('zodbconn.metrics_interval', 60)),
+        limiter=getattr(registry, '_zodb_limiter', None),
+        shared_caches=getattr(registry, '_zodb_shared_caches', None),
+        readahead=getattr(registry, '_zodb_readahead', None),
+        cleanup=getattr(registry, '_zodb_cleanup', None),
+        )
+    response = Response(render_prometheus(collected))
+    response.headers['Content-Type'] = (
+        'text/plain; version=0.0.4; charset=utf-8')
+    return response
+
+class StatsdPusher(PeriodicThread):
+    """ Sends the metrics of every database in ``databases`` as StatsD
+    gauges to the UDP socket at ``address`` every ``interval`` seconds, from
+    a daemon thread started by :meth:`start` (see
+    :class:`pyramid_zodbconn.periodic.PeriodicThread`). """
+    def __init__(self, databases, address, prefix='zodb', interval=60,
+                 limiter=None, shared_caches=None, readahead=None,
+                 cleanup=None, socket=socket):
+        # XXX socket is parameterized only for testing
+        PeriodicThread.__init__(
+            self, 'pyramid_zodbconn-statsd', self.push, interval)
+        self.databases = databases
+        self.limiter = limiter
+        self.shared_caches = shared_caches
+        self.readahead = readahead
+        self.cleanup = cleanup
+        self.address = address
+        self.prefix = prefix
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def push(self):
+        collected = collect(
+            self.databases, self.interval, limiter=self.limiter,
+            shared_caches=self.shared_caches, readahead=self.readahead,
+            cleanup=self.cleanup)
+        for packet in render_statsd(collected, self.prefix):
+            try:
+                self.sock.sendto(packet.encode('utf-8'), self.address)
+            except socket.error:
+                # metrics are fire-and-forget, a missing daemon must never
+                # break the application
+                pass
+
+def parse_address(value):
+    """ Parse a ``host:port`` string into a ``(host, port)`` tuple. """
+    host, sep, port = value.strip().rpartition(':')
+    if not sep or not host:
+        return value.strip(), 8125
+    return host, int(port)
@@ -0,0 +1,46 @@
+import atexit
+import threading
+
+class PeriodicThread(object):
+    """ Calls ``func`` every ``interval`` seconds from a daemon thread named
+    ``name``, between :meth:`start` and :meth:`stop`.  If ``final`` is true,
+    ``func`` is called once more when the thread is stopped, at the latest
+    when the process exits. """
+    def __init__(self, name, func, interval, final=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.final = final
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, event=None):
+        """ Start the thread, unless it is running already.  Return true if
+        it was started. """
+        # usable as an ``ApplicationCreated`` subscriber, so that the thread
+        # is started in the process which serves requests
+        if self._thread is not None:
+            return False
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+        if self.final:
+            atexit.register(self.stop)
+        return True
+
+    def stop(self):
+        """ Stop the thread and wait for it to exit.  Return true if it was
+        running. """
+        self._stopped.set()
+        if self._thread is None:
+            return False
+        self._thread.join()
+        self._thread = None
+        if self.final:
+            self.func()
+        return True
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.func()
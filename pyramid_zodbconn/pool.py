@@ -0,0 +1,79 @@
+import collections
+import threading
+import time
+
+from pyramid.httpexceptions import HTTPServiceUnavailable
+
+class PoolTimeoutError(HTTPServiceUnavailable):
+    """ Raised by :func:`pyramid_zodbconn.get_connection` when a request
+    waited longer than ``zodbconn.pool_timeout`` seconds for a connection.
+    As an HTTP exception, it is rendered as a ``503 Service Unavailable``
+    response unless the application handles it. """
+
+class ConnectionLimiter(object):
+    """ Limits the number of connections of a database which are open at
+    the same time to ``size``.  A request which finds every slot taken
+    waits, first come first served, until a connection is released or
+    ``timeout`` seconds (if not ``None``) have passed.
+
+    ``waits`` counts the acquisitions which had to wait, ``wait_time`` is
+    the total number of seconds they waited, ``rejections`` counts the
+    waits which timed out and ``in_use`` is the number of slots currently
+    taken. """
+    def __init__(self, size, timeout=None, time=time):
+        # XXX time is parameterized only for testing
+        self.size = size
+        self.timeout = timeout
+        self.in_use = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.rejections = 0
+        self._time = time
+        self._lock = threading.Lock()
+        self._waiters = collections.deque()
+
+    def acquire(self):
+        """ Take a slot, waiting for one if necessary.  Raise
+        :class:`PoolTimeoutError` if none became free in time. """
+        with self._lock:
+            if self.in_use < self.size and not self._waiters:
+                self.in_use += 1
+                return
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+        start = self._time.time()
+        waiter.wait(self.timeout)
+        elapsed = self._time.time() - start
+        with self._lock:
+            self.waits += 1
+            self.wait_time += elapsed
+            # the slot may have been handed over after the wait timed out
+            if waiter.is_set():
+                return
+            self._waiters.remove(waiter)
+            self.rejections += 1
+        raise PoolTimeoutError(
+            'Timed out after %.1f seconds waiting for a database connection'
+            % elapsed)
+
+    def release(self):
+        """ Give a slot back, handing it over to the longest waiting
+        request, if any. """
+        with self._lock:
+            if self._waiters:
+                # in_use stays the same, the slot changes hands
+                self._waiters.popleft().set()
+            else:
+                self.in_use -= 1
+
+    def stats(self):
+        """ Return a dictionary of the counters. """
+        with self._lock:
+            return dict(
+                pool_limit=self.size,
+                pool_in_use=self.in_use,
+                pool_waiting=len(self._waiters),
+                pool_waits=self.waits,
+                pool_wait_seconds=self.wait_time,
+                pool_rejections=self.rejections,
+                )
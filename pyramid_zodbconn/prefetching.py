@@ -0,0 +1,153 @@
+import threading
+from multiprocessing.pool import ThreadPool
+
+from .stats import InstrumentedStorage
+
+# the default number of threads which load records for storages which
+# can't prefetch them themselves
+DEFAULT_THREADS = 4
+
+_lock = threading.Lock()
+
+def get_pool(registry):
+    """ Return the thread pool which loads records for :func:`prefetch`,
+    creating it if necessary.  It has ``zodbconn.prefetch_threads``
+    threads. """
+    pool = getattr(registry, '_zodb_prefetch_pool', None)
+    if pool is None:
+        with _lock:
+            pool = getattr(registry, '_zodb_prefetch_pool', None)
+            if pool is None:
+                threads = getattr(registry, '_zodb_prefetch_threads', None)
+                pool = ThreadPool(threads or DEFAULT_THREADS)
+                registry._zodb_prefetch_pool = pool
+    return pool
+
+class PrefetchedStorage(object):
+    """ Sits between a connection and its storage (below the
+    instrumentation of :mod:`pyramid_zodbconn.stats`, if any), answering
+    loads of the records in ``records`` (a mapping of oids to ``(data,
+    serial)`` tuples filled in by :func:`prefetch` and
+    :class:`pyramid_zodbconn.readahead.ReadAhead`) without asking
+    ``storage``.  The records are dropped when the connection starts a new
+    transaction, as they may be out of date by then. """
+    def __init__(self, storage, records=None):
+        self.storage = storage
+        if records is None:
+            records = {}
+        self.records = records
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def load(self, oid):
+        record = self.records.get(oid)
+        if record is None:
+            return self.storage.load(oid)
+        return record
+
+    def poll_invalidations(self):
+        # replace rather than clear, records still being loaded by other
+        # threads are stored into the old dictionary
+        self.records = {}
+        return self.storage.poll_invalidations()
+
+def prefetched_storage(conn):
+    """ Return the :class:`PrefetchedStorage` of ``conn``, installing it
+    (once per connection) below the instrumentation, so that the loads it
+    answers are still recorded. """
+    storage = conn._normal_storage
+    instrumented = None
+    if isinstance(storage, InstrumentedStorage):
+        instrumented = storage
+        storage = storage.storage
+    if isinstance(storage, PrefetchedStorage):
+        return storage
+    prefetched = PrefetchedStorage(storage)
+    if instrumented is not None:
+        instrumented.storage = prefetched
+    else:
+        if conn._storage is conn._normal_storage:
+            # otherwise it is the temporary storage of a savepoint, which
+            # goes on using the storage it was given
+            conn._storage = prefetched
+        conn._normal_storage = prefetched
+    return prefetched
+
+def can_prefetch(conn):
+    """ Return true if the storage of ``conn`` loads a batch of records
+    itself when asked to prefetch them (ZEO and RelStorage do). """
+    return hasattr(conn.db().storage, 'prefetch')
+
+def base_storage(conn):
+    """ Return the storage of ``conn`` below the instrumentation of
+    :mod:`pyramid_zodbconn.stats` and the :class:`PrefetchedStorage`, if
+    any. """
+    storage = conn._normal_storage
+    if isinstance(storage, InstrumentedStorage):
+        storage = storage.storage
+    if isinstance(storage, PrefetchedStorage):
+        storage = storage.storage
+    return storage
+
+def fetch(pool, conn, oids):
+    """ Load the records of ``oids`` through ``conn``'s storage in the
+    threads of ``pool``.  Return a dictionary mapping the oids to ``(data,
+    serial)``; oids which couldn't be loaded are left out, so that loading
+    them again raises the error where the object is used.
+
+    The records are loaded from the storage below the instrumentation, as
+    its recorders are only meant to be used by the request thread. """
+    storage = base_storage(conn)
+    def load(oid):
+        try:
+            return oid, storage.load(oid)
+        except Exception:
+            return oid, None
+    return dict(
+        (oid, record) for oid, record in pool.map(load, oids)
+        if record is not None)
+
+def prefetch(request, objects_or_oids, dbname=None):
+    """ Load the state of persistent objects, given as objects (ghosts or
+    not) and/or oids, into the cache of the connection to the database
+    ``dbname`` (opened with :func:`pyramid_zodbconn.get_connection` if
+    necessary) in a batch, and return the objects, in the order given.
+
+    The records which aren't in the connection's cache yet are loaded all
+    at once: through the storage's own ``prefetch`` if it has one (such as
+    ZEO and RelStorage, which pipeline the loads), else concurrently by the
+    threads of :func:`get_pool`, unless the connection has a savepoint (its
+    temporary storage can't be read by several threads at once).  As with
+    ``Connection.get``, an oid which doesn't exist raises ``POSKeyError``;
+    objects whose state can't be loaded are returned as ghosts, and raise
+    their error when they are used."""
+    from pyramid_zodbconn import get_connection
+    conn = get_connection(request, dbname)
+    items = list(objects_or_oids)
+    wanted = []
+    for item in items:
+        if isinstance(item, bytes):
+            obj = conn._cache.get(item, None)
+            if obj is None or obj._p_changed is None:
+                wanted.append(item)
+        elif item._p_changed is None and item._p_jar is conn:
+            wanted.append(item._p_oid)
+    if len(wanted) > 1:
+        if can_prefetch(conn):
+            conn.prefetch(wanted)
+        elif conn._savepoint_storage is None:
+            records = fetch(get_pool(request.registry), conn, wanted)
+            prefetched_storage(conn).records.update(records)
+    objects = []
+    for item in items:
+        if isinstance(item, bytes):
+            item = conn.get(item)
+        if item._p_changed is None and item._p_jar is conn:
+            try:
+                item._p_activate()
+            except Exception:
+                # left to the code which uses the object
+                pass
+        objects.append(item)
+    return objects
@@ -0,0 +1,206 @@
+import heapq
+import threading
+
+from .prefetching import (
+    base_storage,
+    can_prefetch,
+    get_pool,
+    prefetched_storage,
+    )
+from .stats import (
+    Recorder,
+    instrument,
+    )
+
+# requests a route must have served before its predictions are used
+MIN_REQUESTS = 5
+
+# requests after which the prediction of a route is recomputed
+REFRESH = 10
+
+# oids loaded by one worker task
+CHUNK = 10
+
+class RouteModel(object):
+    """ Counts how many requests of one route loaded each oid (after their
+    first few loads).  At most ``size`` oids are tracked: whenever the
+    table grows to twice that, the less frequently loaded half is dropped.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.counts = {}
+        self.requests = 0
+        self._prediction = None
+        self._lock = threading.Lock()
+
+    def add(self, oids):
+        """ Add the oids loaded by one request. """
+        with self._lock:
+            self.requests += 1
+            counts = self.counts
+            for oid in oids:
+                counts[oid] = counts.get(oid, 0) + 1
+            if len(counts) > 2 * self.size:
+                self.counts = dict(heapq.nlargest(
+                    self.size, counts.items(), key=lambda item: item[1]))
+            if self.requests % REFRESH == 0:
+                self._prediction = None
+
+    def predict(self, min_support, limit):
+        """ Return up to ``limit`` oids which were loaded by at least
+        ``min_support`` of the requests, most often loaded first. """
+        with self._lock:
+            if self.requests < MIN_REQUESTS:
+                return []
+            if self._prediction is None:
+                threshold = min_support * self.requests
+                frequent = [item for item in self.counts.items()
+                            if item[1] >= threshold]
+                frequent.sort(key=lambda item: (-item[1], item[0]))
+                self._prediction = [oid for oid, count in frequent[:limit]]
+            return self._prediction
+
+class ReadAheadRecorder(Recorder):
+    """ Remembers the oids loaded by one request, and starts the read-ahead
+    when the ``trigger``-th oid is loaded. """
+    def __init__(self, readahead, model, conn):
+        self.readahead = readahead
+        self.model = model
+        self.conn = conn
+        self.oids = []
+        self.predicted = ()
+        self.cancelled = False
+
+    def record_load(self, oid, data, elapsed):
+        oids = self.oids
+        if len(oids) < self.readahead.max_loads:
+            oids.append(oid)
+        if len(oids) == self.readahead.trigger:
+            self.readahead.read_ahead(self)
+
+class ReadAhead(object):
+    """ Learns which objects the requests of each route load, and reads
+    them ahead for later requests of the route.
+
+    The oids a request loads through its primary connection after its
+    first ``trigger`` loads are counted in a :class:`RouteModel` of the
+    route (at most ``max_routes`` routes are learned; requests which didn't
+    match a route are left alone).  Once the route has served a few
+    requests, the ``trigger``-th load of a request starts loading the up to
+    ``max_oids`` oids which at least ``min_support`` of the route's
+    requests loaded, in the background: through the storage's own
+    ``prefetch`` if it has one, else in the ``zodbconn.prefetch_threads``
+    threads used by :func:`pyramid_zodbconn.prefetch`, into the
+    :class:`pyramid_zodbconn.prefetching.PrefetchedStorage` of the
+    connection, which then answers the loads of those objects until the
+    connection starts a new transaction.
+
+    ``predicted`` counts the oids read ahead, ``used`` those of them which
+    the requests then loaded, and ``requests`` the requests for which oids
+    were read ahead.
+
+    :meth:`start` and :meth:`end` are subscribers for the connection opened
+    and will-close events. """
+    key = '_pyramid_zodbconn_readahead'
+
+    def __init__(self, registry, trigger=3, max_oids=100, min_support=0.5,
+                 max_routes=100):
+        self.registry = registry
+        self.trigger = trigger
+        self.max_oids = max_oids
+        self.min_support = min_support
+        self.max_routes = max_routes
+        # the oids of a request which are remembered
+        self.max_loads = trigger + 10 * max_oids
+        self.models = {}
+        self.requests = 0
+        self.predicted = 0
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def model(self, route):
+        model = self.models.get(route)
+        if model is None:
+            with self._lock:
+                model = self.models.get(route)
+                if model is None:
+                    if len(self.models) >= self.max_routes:
+                        return None
+                    model = RouteModel(10 * self.max_oids)
+                    self.models[route] = model
+        return model
+
+    def start(self, event):
+        route = getattr(event.request, 'matched_route', None)
+        if route is None:
+            return
+        model = self.model(route.name)
+        if model is None:
+            return
+        recorder = ReadAheadRecorder(self, model, event.conn)
+        instrument(event.conn).add_recorder(recorder)
+        setattr(event.request, self.key, recorder)
+
+    def read_ahead(self, recorder):
+        """ Start reading ahead the predicted oids of the request of
+        ``recorder`` which it hasn't loaded yet. """
+        conn = recorder.conn
+        loaded = set(recorder.oids)
+        oids = []
+        for oid in recorder.model.predict(self.min_support, self.max_oids):
+            if oid in loaded:
+                continue
+            obj = conn._cache.get(oid, None)
+            if obj is not None and obj._p_changed is not None:
+                continue
+            oids.append(oid)
+        if not oids:
+            return
+        recorder.predicted = oids
+        with self._lock:
+            self.requests += 1
+            self.predicted += len(oids)
+        if can_prefetch(conn):
+            conn.prefetch(oids)
+            return
+        # the records of the connection's current transaction, shared with
+        # pyramid_zodbconn.prefetch
+        records = prefetched_storage(conn).records
+        storage = base_storage(conn)
+        pool = get_pool(self.registry)
+        for i in range(0, len(oids), CHUNK):
+            pool.apply_async(
+                self.load, (recorder, storage, records, oids[i:i + CHUNK]))
+
+    def load(self, recorder, storage, records, oids):
+        # runs in the threads of the pool
+        for oid in oids:
+            if recorder.cancelled:
+                return
+            try:
+                records[oid] = storage.load(oid)
+            except Exception:
+                # loaded again, raising the error, if the object is used
+                pass
+
+    def end(self, event):
+        recorder = getattr(event.request, self.key, None)
+        if recorder is None:
+            return
+        recorder.cancelled = True
+        event.conn._normal_storage.remove_recorder(recorder)
+        oids = set(recorder.oids[self.trigger:])
+        if recorder.predicted:
+            used = len(oids.intersection(recorder.predicted))
+            with self._lock:
+                self.used += used
+        recorder.model.add(oids)
+
+    def stats(self):
+        """ Return a dictionary of the counters. """
+        with self._lock:
+            return dict(
+                readahead_requests=self.requests,
+                readahead_predicted=self.predicted,
+                readahead_used=self.used,
+                )
@@ -0,0 +1,177 @@
+import json
+import math
+import os
+import threading
+import time
+
+from pyramid.response import Response
+
+from .periodic import PeriodicThread
+
+# the label of requests whose endpoint could not be told, and of endpoints
+# over the limit
+UNKNOWN = '(unknown)'
+OTHER = '(other)'
+
+class LogHistogram(object):
+    """ A streaming histogram with logarithmic buckets: each bucket covers
+    values up to ``growth`` times larger than the previous one, so
+    percentiles are accurate to within that factor while the number of
+    buckets only grows with the logarithm of the range of values.  Zero and
+    negative values share a bucket of their own. """
+    def __init__(self, growth=2 ** 0.125):
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if value <= 0:
+            self.zeros += 1
+            return
+        index = int(math.floor(math.log(value) / self._log_growth))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, fraction):
+        """ Return the (upper bound of the bucket holding the) value below
+        which ``fraction`` of the values fall. """
+        if not self.count:
+            return 0
+        wanted = fraction * self.count
+        seen = self.zeros
+        if seen >= wanted:
+            return 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= wanted:
+                return min(self.growth ** (index + 1), self.max)
+        return self.max
+
+    def summary(self):
+        return dict(
+            count=self.count,
+            mean=self.total / float(self.count) if self.count else 0,
+            p50=self.percentile(0.5),
+            p95=self.percentile(0.95),
+            p99=self.percentile(0.99),
+            max=self.max,
+            )
+
+class EndpointStats(object):
+    """ Histograms of the elapsed time, loads and stores of the requests of
+    one endpoint. """
+    def __init__(self):
+        self.elapsed = LogHistogram()
+        self.loads = LogHistogram()
+        self.stores = LogHistogram()
+
+    def add(self, elapsed, loads, stores):
+        self.elapsed.add(elapsed)
+        self.loads.add(loads)
+        self.stores.add(stores)
+
+    def summary(self):
+        return dict(
+            requests=self.elapsed.count,
+            elapsed=self.elapsed.summary(),
+            loads=self.loads.summary(),
+            stores=self.stores.summary(),
+            )
+
+def endpoint(request):
+    """ Return the name of the endpoint which handled ``request``: the name
+    of the matched route, or else the class of the traversal context and
+    the view name. """
+    route = getattr(request, 'matched_route', None)
+    if route is not None:
+        return route.name
+    context = getattr(request, 'context', None)
+    if context is None:
+        return UNKNOWN
+    cls = context.__class__
+    return '%s.%s:%s' % (
+        cls.__module__, cls.__name__, getattr(request, 'view_name', ''))
+
+class RouteStats(object):
+    """ Aggregates the ZODB activity of requests per endpoint (see
+    :func:`endpoint`), in constant memory: at most ``max_endpoints``
+    endpoints are told apart, the requests of any further ones are counted
+    as ``(other)``.
+
+    :meth:`start` and :meth:`end` are subscribers for the connection opened
+    and will-close events.  If ``filename`` is given, :meth:`report` is
+    written to it as JSON every ``interval`` seconds by the
+    :class:`pyramid_zodbconn.periodic.PeriodicThread` ``writer``, and once
+    more when it is stopped or the process exits. """
+    key = '_pyramid_zodbconn_routestats'
+
+    def __init__(self, filename=None, interval=300, max_endpoints=1000):
+        self.filename = filename
+        self.interval = interval
+        self.max_endpoints = max_endpoints
+        self.endpoints = {}
+        self._lock = threading.Lock()
+        self.writer = PeriodicThread(
+            'pyramid_zodbconn-routestats', self.write, interval, final=True)
+
+    def start(self, event, time=time):
+        # XXX time is parameterized only for testing
+        loads, stores = event.conn.getTransferCounts()
+        setattr(event.request, self.key, (time.time(), loads, stores))
+
+    def end(self, event, time=time):
+        # XXX time is parameterized only for testing
+        info = getattr(event.request, self.key, None)
+        if info is None:
+            return
+        started, loads_before, stores_before = info
+        loads, stores = event.conn.getTransferCounts()
+        self.add(
+            endpoint(event.request),
+            time.time() - started,
+            loads - loads_before,
+            stores - stores_before,
+            )
+
+    def add(self, name, elapsed, loads, stores):
+        with self._lock:
+            stats = self.endpoints.get(name)
+            if stats is None:
+                if len(self.endpoints) >= self.max_endpoints:
+                    name = OTHER
+                    stats = self.endpoints.get(name)
+                if stats is None:
+                    stats = self.endpoints[name] = EndpointStats()
+            stats.add(elapsed, loads, stores)
+
+    def report(self):
+        """ Return a dictionary mapping endpoint names to summaries of their
+        requests: the number of requests, and the count, mean, 50th, 95th
+        and 99th percentile and maximum of their elapsed time (in seconds),
+        loads and stores. """
+        with self._lock:
+            return dict(
+                (name, stats.summary())
+                for name, stats in self.endpoints.items())
+
+    def write(self, open=open):
+        """ Write :meth:`report` to ``filename`` (through a temporary file
+        which is renamed into place). """
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        os.rename(tmpname, self.filename)
+
+def route_stats_view(request):
+    """ A Pyramid view which renders the per-endpoint report as JSON. """
+    stats = request.registry._zodb_route_stats
+    response = Response(json.dumps(stats.report(), sort_keys=True))
+    response.content_type = 'application/json'
+    return response
@@ -0,0 +1,216 @@
+import collections
+import threading
+
+from ZODB.mvccadapter import MVCCAdapter
+from ZODB.utils import (
+    p64,
+    u64,
+    z64,
+    )
+from zope.interface import (
+    directlyProvides,
+    providedBy,
+    )
+
+class SharedStateCache(object):
+    """ A process-wide cache of object records (pickles) of one database,
+    shared by all its connections, so that a record loaded from storage by
+    one connection can be handed to any other connection which needs the
+    same revision instead of loading it again.
+
+    Records are kept by ``(oid, tid)``, with the tid of the transaction
+    which ended their validity, if known.  At most ``max_bytes`` bytes of
+    records are kept; the least recently used ones are evicted first, and
+    records larger than ``max_record_size`` (by default a tenth of
+    ``max_bytes``) are not cached at all.  Only the latest revision of an
+    object which has been loaded is kept.
+
+    Committed transactions invalidate the records they changed: a current
+    record becomes a historical one, which can still be served to
+    connections looking at the database as of before the transaction.  A
+    record is only served as current to connections which don't look past
+    the last transaction the cache was told about.
+
+    ``hits``, ``misses`` and ``evictions`` count the loads served from the
+    cache, the loads passed on to the storage and the records evicted. """
+    def __init__(self, max_bytes, max_record_size=None):
+        self.max_bytes = max_bytes
+        if max_record_size is None:
+            max_record_size = max_bytes // 10
+        self.max_record_size = max_record_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # (oid, serial) -> (data, next serial or None), least recently used
+        # first
+        self._entries = collections.OrderedDict()
+        # oid -> serial of its entry
+        self._latest = {}
+        self._horizon = z64
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def reset(self, ltid):
+        """ Forget all records; ``ltid`` is the last transaction of the
+        storage. """
+        with self._lock:
+            self._entries.clear()
+            self._latest.clear()
+            self.size = 0
+            self._generation += 1
+            self._horizon = p64(u64(ltid) + 1)
+
+    def lookup(self, oid, before):
+        """ Return the ``(data, serial, next serial)`` of the revision of
+        ``oid`` which was current before the transaction ``before``, or
+        ``None`` if it isn't cached. """
+        with self._lock:
+            serial = self._latest.get(oid)
+            if serial is not None and serial < before:
+                key = (oid, serial)
+                data, next_serial = self._entries[key]
+                if next_serial is None:
+                    valid = before <= self._horizon
+                else:
+                    valid = before <= next_serial
+                if valid:
+                    # most recently used
+                    self._entries[key] = self._entries.pop(key)
+                    self.hits += 1
+                    return data, serial, next_serial
+            self.misses += 1
+        return None
+
+    def generation(self):
+        return self._generation
+
+    def store(self, oid, result, generation):
+        """ Add the ``(data, serial, next serial)`` returned by
+        ``loadBefore``.  A current record (without a next serial) is only
+        added if no invalidation was processed since ``generation`` was
+        taken before loading it, as it may have been invalidated before it
+        could be added. """
+        data, serial, next_serial = result
+        if len(data) > self.max_record_size:
+            return
+        with self._lock:
+            if next_serial is None and generation != self._generation:
+                return
+            latest = self._latest.get(oid)
+            if latest is not None:
+                if latest > serial:
+                    return
+                old_data, ignored = self._entries.pop((oid, latest))
+                self.size -= len(old_data)
+            self._entries[(oid, serial)] = (data, next_serial)
+            self._latest[oid] = serial
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                (old_oid, old_serial), (old_data, ignored) = (
+                    self._entries.popitem(last=False))
+                del self._latest[old_oid]
+                self.size -= len(old_data)
+                self.evictions += 1
+
+    def invalidate(self, tid, oids):
+        """ Process the transaction ``tid`` which changed ``oids``. """
+        with self._lock:
+            self._generation += 1
+            horizon = p64(u64(tid) + 1)
+            if horizon > self._horizon:
+                self._horizon = horizon
+            for oid in oids:
+                serial = self._latest.get(oid)
+                if serial is None or serial >= tid:
+                    continue
+                key = (oid, serial)
+                data, next_serial = self._entries[key]
+                if next_serial is None:
+                    self._entries[key] = (data, tid)
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                shared_cache_bytes=self.size,
+                shared_cache_records=len(self._entries),
+                shared_cache_hits=self.hits,
+                shared_cache_misses=self.misses,
+                shared_cache_evictions=self.evictions,
+                )
+
+class CachingStorage(object):
+    """ Wraps the storage of a database so that ``loadBefore`` goes through
+    a :class:`SharedStateCache`.  Everything else is delegated to the
+    wrapped storage. """
+    def __init__(self, storage, cache):
+        self.storage = storage
+        self.cache = cache
+        directlyProvides(self, providedBy(storage))
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def __len__(self):
+        return len(self.storage)
+
+    def loadBefore(self, oid, before):
+        cache = self.cache
+        result = cache.lookup(oid, before)
+        if result is not None:
+            return result
+        generation = cache.generation()
+        result = self.storage.loadBefore(oid, before)
+        if result is not None:
+            cache.store(oid, result, generation)
+        return result
+
+def install(db, cache):
+    """ Put ``cache`` between the connections of ``db`` and its storage,
+    and have it told about every committed transaction.  Return false,
+    doing nothing, if the storage of ``db`` manages the views of its
+    connections itself (such as RelStorage, which has caches of its
+    own). """
+    adapter = db._mvcc_storage
+    if not isinstance(adapter, MVCCAdapter):
+        return False
+    storage = adapter._storage
+    cache.reset(storage.lastTransaction())
+    caching_storage = CachingStorage(storage, cache)
+    with adapter._lock:
+        adapter._storage = caching_storage
+        # the connections which were already created (DB creates one to
+        # set up the root object)
+        for instance in adapter._instances:
+            instance._storage = caching_storage
+    # transactions committed by other processes (ZEO)
+    invalidate = adapter.invalidate
+    def cached_invalidate(transaction_id, oids):
+        cache.invalidate(transaction_id, oids)
+        invalidate(transaction_id, oids)
+    adapter.invalidate = cached_invalidate
+    # transactions committed by this process
+    invalidate_finish = adapter._invalidate_finish
+    def cached_invalidate_finish(tid, oids, committing_instance):
+        cache.invalidate(tid, oids)
+        invalidate_finish(tid, oids, committing_instance)
+    adapter._invalidate_finish = cached_invalidate_finish
+    # invalidations which were lost (ZEO reconnection)
+    invalidate_cache = adapter.invalidateCache
+    def cached_invalidate_cache():
+        cache.reset(storage.lastTransaction())
+        invalidate_cache()
+    adapter.invalidateCache = cached_invalidate_cache
+    return True
+
+def shared_cache_factory(db_from_uri, max_bytes, caches):
+    """ Return a replacement for ``db_from_uri`` which installs a
+    :class:`SharedStateCache` of ``max_bytes`` bytes on each database it
+    creates, keeping the caches in ``caches`` by database name. """
+    def factory(uri, dbname, dbmap, *arg, **kw):
+        db = db_from_uri(uri, dbname, dbmap, *arg, **kw)
+        cache = SharedStateCache(max_bytes)
+        if install(db, cache):
+            caches[dbname] = cache
+        return db
+    return factory
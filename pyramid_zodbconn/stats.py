@@ -0,0 +1,228 @@
+import time
+
+class Recorder(object):
+    """ Base class for objects which are told about the activity of an
+    instrumented connection while they are added to its
+    :class:`InstrumentedStorage` (see :func:`instrument`).  ``record_load``
+    is called with the oid, the record (pickle) and the seconds spent in
+    storage for each record loaded, ``record_hit`` for each object lookup
+    answered from the pickle cache and ``record_invalidations`` with the
+    number of invalidated oids the connection processed.  The methods of
+    this class do nothing. """
+
+    def record_hit(self):
+        pass
+
+    def record_load(self, oid, data, elapsed):
+        pass
+
+    def record_invalidations(self, count):
+        pass
+
+class ConnectionStats(Recorder):
+    """ ZODB activity caused by a single request on a single connection.
+
+    ``cache_hits`` is the number of object lookups by oid which were answered
+    from the connection's pickle cache, ``cache_misses`` is the number of
+    records which had to be loaded from storage (this can be higher than the
+    ``loads`` transfer count, as fetching an object which is not in the
+    cache at all also loads its record to build a ghost).  ``load_time`` is
+    the number of seconds spent inside storage ``load``/``loadBefore`` calls
+    and ``bytes_loaded`` is the total size of the pickles they returned.
+    ``invalidations`` is the number of invalidated oids the connection
+    processed since it was last used, which mostly happens when it is
+    opened.  ``loads`` and ``stores`` are the transfer counts and
+    ``elapsed`` the wall time between open and close; these are filled in
+    when the connection is about to be closed.
+    """
+    def __init__(self, dbname=''):
+        self.dbname = dbname
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.load_time = 0.0
+        self.bytes_loaded = 0
+        self.invalidations = 0
+        self.loads = 0
+        self.stores = 0
+        self.elapsed = 0.0
+
+    def record_hit(self):
+        self.cache_hits += 1
+
+    def record_load(self, oid, data, elapsed):
+        self.cache_misses += 1
+        self.bytes_loaded += len(data)
+        self.load_time += elapsed
+
+    def record_invalidations(self, count):
+        self.invalidations += count
+
+    def as_dict(self):
+        return dict(
+            dbname=self.dbname,
+            cache_hits=self.cache_hits,
+            cache_misses=self.cache_misses,
+            load_time=self.load_time,
+            bytes_loaded=self.bytes_loaded,
+            invalidations=self.invalidations,
+            loads=self.loads,
+            stores=self.stores,
+            elapsed=self.elapsed,
+            )
+
+class InstrumentedStorage(object):
+    """ Wraps the per-connection storage instance of a ZODB connection and
+    reports loads and invalidations to the recorders currently added to it
+    (see :class:`Recorder`).  Everything else is delegated to the wrapped
+    storage.  Invalidations processed while no recorder is added (typically
+    while the connection is opened) are counted in
+    ``pending_invalidations``. """
+    def __init__(self, storage, time=time):
+        # XXX time is parameterized only for testing
+        self.storage = storage
+        self.recorders = ()
+        self.pending_invalidations = 0
+        self._time = time
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def add_recorder(self, recorder):
+        # replace rather than mutate, so that a load in progress keeps
+        # iterating over a consistent tuple
+        self.recorders = self.recorders + (recorder,)
+
+    def remove_recorder(self, recorder):
+        self.recorders = tuple(r for r in self.recorders if r is not recorder)
+
+    def load(self, oid):
+        recorders = self.recorders
+        if not recorders:
+            return self.storage.load(oid)
+        start = self._time.time()
+        p, serial = self.storage.load(oid)
+        elapsed = self._time.time() - start
+        for recorder in recorders:
+            recorder.record_load(oid, p, elapsed)
+        return p, serial
+
+    def loadBefore(self, oid, tid):
+        recorders = self.recorders
+        if not recorders:
+            return self.storage.loadBefore(oid, tid)
+        start = self._time.time()
+        result = self.storage.loadBefore(oid, tid)
+        if result is not None:
+            elapsed = self._time.time() - start
+            for recorder in recorders:
+                recorder.record_load(oid, result[0], elapsed)
+        return result
+
+    def poll_invalidations(self):
+        invalidated = self.storage.poll_invalidations()
+        if invalidated:
+            recorders = self.recorders
+            if not recorders:
+                self.pending_invalidations += len(invalidated)
+            for recorder in recorders:
+                recorder.record_invalidations(len(invalidated))
+        return invalidated
+
+    def record_hit(self):
+        for recorder in self.recorders:
+            recorder.record_hit()
+
+class InstrumentedCache(object):
+    """ Wraps the pickle cache used by a connection's object reader so that
+    lookups of persistent references can be counted as hits or misses. """
+    def __init__(self, cache, storage):
+        self.cache = cache
+        self.storage = storage
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def get(self, oid, default=None):
+        obj = self.cache.get(oid, None)
+        if obj is None:
+            return default
+        if self.storage.recorders:
+            self.storage.record_hit()
+        return obj
+
+def instrument(conn):
+    """ Install the instrumentation wrappers on ``conn`` (once per
+    connection) and return its ``InstrumentedStorage``. """
+    storage = conn._normal_storage
+    if isinstance(storage, InstrumentedStorage):
+        return storage
+    storage = InstrumentedStorage(storage)
+    if conn._storage is conn._normal_storage:
+        # otherwise it is the temporary storage of a savepoint, which loads
+        # what it doesn't hold through the storage it was given, and is
+        # replaced by _normal_storage when the savepoint is done with
+        conn._storage = storage
+    conn._normal_storage = storage
+    conn._reader._cache = InstrumentedCache(conn._reader._cache, storage)
+    get = conn.get
+    def instrumented_get(oid):
+        if storage.recorders and conn._cache.get(oid, None) is not None:
+            storage.record_hit()
+        return get(oid)
+    conn.get = instrumented_get
+    return storage
+
+class StatsCollector(object):
+    """ Collects a :class:`ConnectionStats` (or an instance of the
+    configured ``stats_factory``) for each database used by a request.  The
+    statistics of the primary connection are exposed as
+    ``request.zodb_stats``, and those of every database (keyed by database
+    name, the primary database included) as ``request.zodb_database_stats``.
+    Secondary connections are tracked from the moment they are attached to
+    the primary connection or first requested through ``get_connection``,
+    whichever comes first. """
+    key = '_pyramid_zodbconn_stats_info'
+    def __init__(self, stats_factory=ConnectionStats):
+        self.stats_factory = stats_factory
+
+    def start(self, event, time=time):
+        # XXX time is parameterized only for testing
+        conn = event.conn
+        request = event.request
+        info = {}
+        setattr(request, self.key, info)
+        request.zodb_database_stats = {}
+        for dbname, c in conn.connections.items():
+            stats = self._track(request, info, dbname, c, time)
+            if c is conn:
+                request.zodb_stats = stats
+
+    def start_secondary(self, event, time=time):
+        # XXX time is parameterized only for testing
+        info = getattr(event.request, self.key, None)
+        if info is not None and event.dbname not in info:
+            self._track(event.request, info, event.dbname, event.conn, time)
+
+    def _track(self, request, info, dbname, conn, time):
+        storage = instrument(conn)
+        stats = self.stats_factory(dbname)
+        stats.record_invalidations(storage.pending_invalidations)
+        storage.pending_invalidations = 0
+        storage.add_recorder(stats)
+        request.zodb_database_stats[dbname] = stats
+        info[dbname] = (conn, time.time(), conn.getTransferCounts())
+        return stats
+
+    def end(self, event, time=time):
+        # XXX time is parameterized only for testing
+        info = getattr(event.request, self.key, None)
+        if info is None:
+            return
+        now = time.time()
+        for dbname, (conn, started, counts) in info.items():
+            stats = event.request.zodb_database_stats[dbname]
+            conn._normal_storage.remove_recorder(stats)
+            loads, stores = conn.getTransferCounts()
+            stats.loads = loads - counts[0]
+            stats.stores = stores - counts[1]
+            stats.elapsed = now - started
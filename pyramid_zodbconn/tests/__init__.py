@@ -1 +1,9 @@
 # package
+
+class DummyLazyDB(object):
+    """ A :class:`pyramid_zodbconn.LazyDB` which hasn't been loaded yet. """
+    loaded = False
+    def __init__(self, db=None):
+        self.db = db
+    def load(self):
+        return self.db
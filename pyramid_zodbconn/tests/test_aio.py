@@ -0,0 +1,117 @@
+import unittest
+from pyramid import testing
+
+from pyramid_zodbconn.compat import PY35
+from pyramid_zodbconn.tests import DummyLazyDB
+
+@unittest.skipUnless(PY35, 'asyncio support needs Python 3.5')
+class AsyncTestBase(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        self.config = testing.setUp(settings={'zodbconn.uri': 'memory://'})
+        self.config.include('pyramid_zodbconn')
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        executor = getattr(self.config.registry, '_zodb_executor', None)
+        if executor is not None:
+            executor.shutdown()
+        self.loop.close()
+        self.config.registry._zodb_databases[''].close()
+        testing.tearDown()
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+class Test_aget_connection(AsyncTestBase):
+    def test_it(self):
+        import threading
+        import transaction
+        from pyramid_zodbconn.aio import aget_connection
+        request = testing.DummyRequest()
+        opened_in = []
+        db = self.config.registry._zodb_databases['']
+        open = db.open
+        def recording_open(*arg, **kw):
+            opened_in.append(threading.current_thread())
+            return open(*arg, **kw)
+        db.open = recording_open
+        conn = self._run(aget_connection(request))
+        self.assertEqual(conn.root(), {})
+        self.assertTrue(isinstance(request.tm, transaction.TransactionManager))
+        self.assertTrue(conn.transaction_manager is request.tm)
+        self.assertFalse(opened_in[0] is threading.current_thread())
+        self.assertTrue(self._run(aget_connection(request)) is conn)
+        request.finished_callbacks[0](request)
+        self.assertEqual(conn.opened, None)
+
+    def test_keeps_request_tm(self):
+        import transaction
+        from pyramid_zodbconn.aio import aget_connection
+        request = testing.DummyRequest()
+        tm = request.tm = transaction.TransactionManager()
+        conn = self._run(aget_connection(request))
+        self.assertTrue(conn.transaction_manager is tm)
+        request.finished_callbacks[0](request)
+
+    def test_thread_local_request_tm(self):
+        import transaction
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_zodbconn.aio import aget_connection
+        request = testing.DummyRequest()
+        request.tm = transaction.manager
+        self.assertRaises(ConfigurationError, self._run,
+                          aget_connection(request))
+        self.assertFalse(hasattr(request, '_primary_zodb_conn'))
+
+class Test_aclose_connection(AsyncTestBase):
+    def test_it(self):
+        from pyramid_zodbconn import ZODBConnectionClosed
+        from pyramid_zodbconn.aio import aclose_connection
+        from pyramid_zodbconn.aio import aget_connection
+        events = []
+        self.config.add_subscriber(events.append, ZODBConnectionClosed)
+        request = testing.DummyRequest()
+        conn = self._run(aget_connection(request))
+        conn.root()['a'] = 1
+        self._run(aclose_connection(request))
+        self.assertEqual(conn.opened, None)
+        self.assertEqual(list(request.finished_callbacks), [])
+        self.assertEqual(len(events), 1)
+        # the change was aborted and a new connection can be opened
+        conn = self._run(aget_connection(request))
+        self.assertEqual(conn.root(), {})
+        self._run(aclose_connection(request))
+
+    def test_without_connection(self):
+        from pyramid_zodbconn.aio import aclose_connection
+        request = testing.DummyRequest()
+        self._run(aclose_connection(request))
+        self.assertEqual(list(request.finished_callbacks), [])
+
+class Test_get_executor(AsyncTestBase):
+    def _callFUT(self, registry):
+        from pyramid_zodbconn.aio import get_executor
+        return get_executor(registry)
+
+    def test_pool_size(self):
+        registry = self.config.registry
+        executor = self._callFUT(registry)
+        self.assertEqual(executor._max_workers, 7)
+        self.assertTrue(self._callFUT(registry) is executor)
+
+    def test_async_threads(self):
+        registry = self.config.registry
+        registry._zodb_async_threads = 3
+        self.assertEqual(self._callFUT(registry)._max_workers, 3)
+
+    def test_lazy_database(self):
+        from pyramid_zodbconn.aio import DEFAULT_THREADS
+        registry = self.config.registry
+        databases = registry._zodb_databases
+        registry._zodb_databases = {'': DummyLazyDB()}
+        try:
+            executor = self._callFUT(registry)
+        finally:
+            registry._zodb_databases = databases
+        self.assertEqual(executor._max_workers, DEFAULT_THREADS)
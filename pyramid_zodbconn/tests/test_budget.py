@@ -0,0 +1,208 @@
+import unittest
+
+from pyramid_zodbconn.tests import DummyLazyDB
+
+class Test_parse_size(unittest.TestCase):
+    def _callFUT(self, value):
+        from pyramid_zodbconn.budget import parse_size
+        return parse_size(value)
+
+    def test_bytes(self):
+        self.assertEqual(self._callFUT('1000'), 1000)
+
+    def test_suffixes(self):
+        self.assertEqual(self._callFUT('2KB'), 2048)
+        self.assertEqual(self._callFUT(' 512 mb '), 512 * 1024 * 1024)
+        self.assertEqual(self._callFUT('1g'), 1024 ** 3)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self._callFUT, '12 apples')
+
+class Test_allocate(unittest.TestCase):
+    def _callFUT(self, budget, demands):
+        from pyramid_zodbconn.budget import allocate
+        return allocate(budget, demands)
+
+    def test_by_weight(self):
+        result = self._callFUT(1000, {'': (3, None), 'a': (1, None)})
+        self.assertEqual(result, {'': 750, 'a': 250})
+
+    def test_demand_left_to_others(self):
+        result = self._callFUT(
+            1000, {'': (1, None), 'a': (1, 100), 'b': (1, None)})
+        self.assertEqual(result, {'': 450, 'a': 100, 'b': 450})
+
+    def test_demand_larger_than_share(self):
+        result = self._callFUT(1000, {'': (1, None), 'a': (1, 800)})
+        self.assertEqual(result, {'': 500, 'a': 500})
+
+    def test_all_satisfied(self):
+        result = self._callFUT(1000, {'': (1, 10), 'a': (1, 20)})
+        self.assertEqual(result, {'': 10, 'a': 20})
+
+class Test_idle_connections(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        import transaction
+        self.db = DB(MappingStorage())
+        self.conn = self.db.open(transaction.TransactionManager())
+        self.conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _callFUT(self, db, func):
+        from pyramid_zodbconn.budget import idle_connections
+        return idle_connections(db, func)
+
+    def test_idle(self):
+        L = []
+        self.assertTrue(self._callFUT(self.db, L.append))
+        self.assertEqual(L, [self.conn])
+
+    def test_busy_pool_skipped(self):
+        import threading
+        L = []
+        result = []
+        self.db._lock.acquire()
+        try:
+            thread = threading.Thread(
+                target=lambda: result.append(self._callFUT(self.db, L.append)))
+            thread.start()
+            thread.join()
+        finally:
+            self.db._lock.release()
+        self.assertEqual(result, [False])
+        self.assertEqual(L, [])
+
+class TestMemoryGovernor(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.ActivityMonitor import ActivityMonitor
+        from ZODB.MappingStorage import MappingStorage
+        from persistent.mapping import PersistentMapping
+        import transaction
+        self.databases = {}
+        for name in ('', 'foo'):
+            db = DB(MappingStorage(), databases=self.databases,
+                    database_name=name)
+            db.setActivityMonitor(ActivityMonitor())
+        self.tm = transaction.TransactionManager()
+        conn = self.databases[''].open(self.tm)
+        root = conn.root()
+        for i in range(100):
+            root[i] = PersistentMapping(data='x' * 1000)
+        self.tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        for db in self.databases.values():
+            db.close()
+
+    def _makeOne(self, budget):
+        from pyramid_zodbconn.budget import MemoryGovernor
+        return MemoryGovernor(self.databases, budget, interval=0.01)
+
+    def _load(self):
+        conn = self.databases[''].open(self.tm)
+        conn.get_connection('foo').root()
+        for obj in conn.root().values():
+            obj._p_activate()
+        conn.close()
+
+    def test_adjust_within_budget(self):
+        from pyramid_zodbconn.budget import MIN_CACHE_SIZE_BYTES
+        self._load()
+        inst = self._makeOne(10 * 1024 * 1024)
+        inst.adjust()
+        self.assertEqual(inst.runs, 1)
+        self.assertTrue(inst.usage > 50000)
+        self.assertEqual(inst.collected, 0)
+        # nothing was loaded, so each database keeps what it uses
+        self.assertEqual(inst.targets['foo'], MIN_CACHE_SIZE_BYTES)
+        primary = self.databases['']
+        self.assertEqual(primary.getCacheSizeBytes(), inst.targets[''])
+        self.assertEqual(inst.targets[''], int(inst.usage * 1.25) - 160)
+
+    def test_adjust_shares_by_loads(self):
+        self.databases[''].cacheMinimize()
+        self._load()
+        inst = self._makeOne(10 * 1024 * 1024)
+        inst.adjust()
+        self.assertEqual(inst.targets[''], 10 * 1024 * 1024 - 160)
+        self.assertTrue(self.databases[''].getCacheSize() > 5000)
+
+    def test_adjust_over_budget(self):
+        self.databases[''].cacheMinimize()
+        self._load()
+        inst = self._makeOne(80000)
+        inst.adjust()
+        self.assertEqual(inst.collected, 2)
+        self.assertEqual(inst.minimized, 0)
+        self.assertTrue(inst.usage <= 80000)
+
+    def test_adjust_minimizes(self):
+        from pyramid_zodbconn.budget import MIN_CACHE_SIZE_BYTES
+        self._load()
+        # less than the smallest target a connection cache gets
+        inst = self._makeOne(1000)
+        inst.adjust()
+        self.assertEqual(inst.targets[''], MIN_CACHE_SIZE_BYTES)
+        self.assertEqual(inst.collected, 2)
+        self.assertEqual(inst.minimized, 1)
+        self.assertTrue(inst.usage < 1000)
+        self.assertEqual(self.databases[''].getCacheSize(), 100)
+
+    def test_adjust_skips_busy_pool(self):
+        import pyramid_zodbconn.budget as module
+        self.databases[''].cacheMinimize()
+        self._load()
+        inst = self._makeOne(80000)
+        idle_connections = module.idle_connections
+        module.idle_connections = lambda db, func: False
+        try:
+            inst.adjust()
+        finally:
+            module.idle_connections = idle_connections
+        self.assertEqual(inst.skipped, 1)
+        self.assertEqual(inst.collected, 0)
+        self.assertTrue(inst.usage > 80000)
+
+    def test_adjust_never_waits_for_busy_pool(self):
+        import threading
+        self._load()
+        inst = self._makeOne(10 * 1024 * 1024)
+        self.databases['foo']._lock.acquire()
+        try:
+            thread = threading.Thread(target=inst.adjust)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finally:
+            self.databases['foo']._lock.release()
+        self.assertEqual(inst.skipped, 1)
+        self.assertEqual(inst.runs, 1)
+        self.assertFalse('foo' in inst.targets)
+        self.assertTrue('' in inst.targets)
+
+    def test_skips_unloaded_lazy_databases(self):
+        lazy = DummyLazyDB()
+        self.databases['lazy'] = lazy
+        try:
+            inst = self._makeOne(1000)
+            inst.adjust()
+        finally:
+            del self.databases['lazy']
+        self.assertFalse('lazy' in inst.targets)
+
+    def test_start_stop(self):
+        inst = self._makeOne(10 * 1024 * 1024)
+        inst.start(None)
+        thread = inst._thread
+        inst.start(None)
+        self.assertTrue(inst._thread is thread)
+        inst.stop()
+        self.assertEqual(inst._thread, None)
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(inst.runs >= 0)
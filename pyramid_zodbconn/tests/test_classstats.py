@@ -0,0 +1,178 @@
+import unittest
+from pyramid import testing
+
+class TestClassHistogram(unittest.TestCase):
+    def _makeOne(self, max_classes=1000):
+        from pyramid_zodbconn.classstats import ClassHistogram
+        return ClassHistogram(max_classes)
+
+    def test_report(self):
+        inst = self._makeOne()
+        inst.add('a.Small', 10)
+        inst.add('a.Small', 30)
+        inst.add('a.Big', 1000)
+        self.assertEqual(inst.report(), [
+            {'class': 'a.Big', 'loads': 1, 'bytes': 1000, 'mean': 1000,
+             'max': 1000},
+            {'class': 'a.Small', 'loads': 2, 'bytes': 40, 'mean': 20,
+             'max': 30},
+            ])
+
+    def test_bounded(self):
+        inst = self._makeOne(max_classes=2)
+        inst.add('a.A', 1)
+        inst.add('a.B', 1)
+        inst.add('a.C', 1)
+        inst.add('a.D', 1)
+        inst.add('a.A', 1)
+        self.assertEqual(sorted(inst.classes), ['(other)', 'a.A', 'a.B'])
+        self.assertEqual(inst.classes['(other)'][0], 2)
+        self.assertEqual(inst.classes['a.A'][0], 2)
+
+class TestClassStats(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from persistent.mapping import PersistentMapping
+        import transaction
+        self.db = DB(MappingStorage())
+        self.tm = transaction.TransactionManager()
+        conn = self.db.open(self.tm)
+        conn.root()['a'] = PersistentMapping({'b': PersistentMapping()})
+        self.tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _makeOne(self, **kw):
+        from pyramid_zodbconn.classstats import ClassStats
+        return ClassStats(**kw)
+
+    def _run(self, inst):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        conn = self.db.open(self.tm)
+        conn.cacheMinimize()
+        event = ZODBConnectionOpened(conn, testing.DummyRequest())
+        inst.start(event)
+        conn.root()['a']['b'].keys()
+        inst.end(event)
+        conn.close()
+        return conn
+
+    def test_request_cycle(self):
+        inst = self._makeOne()
+        conn = self._run(inst)
+        report = inst.report()
+        self.assertEqual(list(report), ['unnamed'])
+        rows = report['unnamed']
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['class'],
+                         'persistent.mapping.PersistentMapping')
+        self.assertTrue(rows[0]['loads'] >= 3)
+        self.assertTrue(rows[0]['bytes'] > 0)
+        self.assertEqual(conn._normal_storage.recorders, ())
+
+    def test_not_sampled(self):
+        inst = self._makeOne(sample_rate=0.5, random=lambda: 0.5)
+        self._run(inst)
+        self.assertEqual(inst.report(), {})
+
+    def test_start_secondary(self):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        inst = self._makeOne()
+        conn = self.db.open(self.tm)
+        event = ZODBConnectionOpened(conn, testing.DummyRequest())
+        inst.start(event)
+        other = DummyConnection()
+        secondary = ZODBSecondaryConnectionOpened(
+            other, event.request, 'other')
+        inst.start_secondary(secondary)
+        inst.start_secondary(secondary)
+        self.assertEqual(len(other._normal_storage.recorders), 1)
+        self.assertEqual(sorted(inst.histograms), ['other', 'unnamed'])
+        inst.end(event)
+        conn.close()
+        self.assertEqual(other._normal_storage.recorders, ())
+
+    def test_start_secondary_untracked(self):
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        inst = self._makeOne()
+        other = DummyConnection()
+        inst.start_secondary(ZODBSecondaryConnectionOpened(
+            other, testing.DummyRequest(), 'other'))
+        self.assertEqual(inst.histograms, {})
+
+    def test_end_untracked(self):
+        inst = self._makeOne()
+        event = DummyEvent()
+        inst.end(event)
+
+    def test_dump(self):
+        import io
+        inst = self._makeOne()
+        inst.histogram('').add('a.Big', 1000)
+        inst.histogram('').add('a.Small', 10)
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        inst.dump(out, n=1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], "Database '':")
+        self.assertEqual(lines[2].split(), ['1', '1000', '1000', '1000',
+                                            'a.Big'])
+        self.assertEqual(len(lines), 4)
+
+class Test_dump(unittest.TestCase):
+    def test_not_enabled(self):
+        from pyramid_zodbconn.classstats import dump
+        self.assertRaises(ValueError, dump, DummyRegistry())
+
+    def test_it(self):
+        from pyramid_zodbconn.classstats import ClassStats
+        from pyramid_zodbconn.classstats import dump
+        registry = DummyRegistry()
+        registry._zodb_class_stats = ClassStats()
+        dumped = []
+        registry._zodb_class_stats.dump = lambda out, n: dumped.append(n)
+        dump(registry, n=5)
+        self.assertEqual(dumped, [5])
+
+class Test_class_stats_view(unittest.TestCase):
+    def test_it(self):
+        import json
+        from pyramid_zodbconn.classstats import ClassStats
+        from pyramid_zodbconn.classstats import class_stats_view
+        request = testing.DummyRequest()
+        request.registry = DummyRegistry()
+        request.registry._zodb_class_stats = ClassStats()
+        request.registry._zodb_class_stats.histogram('').add('a.A', 5)
+        response = class_stats_view(request)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.text)[''][0]['bytes'], 5)
+
+class DummyRegistry(object):
+    pass
+
+class DummyEvent(object):
+    def __init__(self):
+        self.request = testing.DummyRequest()
+
+class DummyStorage(object):
+    def load(self, oid): # pragma: no cover
+        pass
+
+class DummyCache(object):
+    pass
+
+class DummyReader(object):
+    def __init__(self):
+        self._cache = DummyCache()
+
+class DummyConnection(object):
+    def __init__(self):
+        self._storage = self._normal_storage = DummyStorage()
+        self._reader = DummyReader()
+        self._cache = DummyCache()
+
+    def get(self, oid): # pragma: no cover
+        pass
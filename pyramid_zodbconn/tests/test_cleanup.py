@@ -0,0 +1,199 @@
+import threading
+import unittest
+from pyramid import testing
+
+class TestCleanupExecutor(unittest.TestCase):
+    def _makeOne(self, threads=1, max_pending=100, time=None):
+        from pyramid_zodbconn.cleanup import CleanupExecutor
+        if time is None:
+            time = DummyTime()
+        inst = CleanupExecutor(threads, max_pending, time=time)
+        self.addCleanup(inst.shutdown)
+        return inst
+
+    def test_runs_in_thread_with_request(self):
+        from pyramid.threadlocal import get_current_request
+        inst = self._makeOne()
+        request = testing.DummyRequest()
+        L = []
+        def func():
+            L.append((threading.current_thread().name,
+                      get_current_request()))
+        inst.submit(request, func)
+        inst.shutdown()
+        self.assertEqual(L, [('pyramid_zodbconn-cleanup', request)])
+        self.assertEqual(inst.completed, 1)
+        self.assertEqual(inst.pending, 0)
+        self.assertEqual(inst.inline, 0)
+
+    def test_ordered(self):
+        inst = self._makeOne()
+        request = testing.DummyRequest()
+        L = []
+        for i in range(5):
+            inst.submit(request, lambda i=i: L.append(i))
+        inst.shutdown()
+        self.assertEqual(L, list(range(5)))
+
+    def test_threads_bounded(self):
+        inst = self._makeOne(threads=2)
+        request = testing.DummyRequest()
+        event = threading.Event()
+        for i in range(5):
+            inst.submit(request, event.wait)
+        self.assertEqual(len(inst._threads), 2)
+        event.set()
+        inst.shutdown()
+        self.assertEqual(inst.completed, 5)
+
+    def test_inline_when_too_many_pending(self):
+        inst = self._makeOne(max_pending=1)
+        request = testing.DummyRequest()
+        event = threading.Event()
+        inst.submit(request, event.wait)
+        L = []
+        inst.submit(request, lambda: L.append(threading.current_thread()))
+        self.assertEqual(L, [threading.current_thread()])
+        self.assertEqual(inst.inline, 1)
+        self.assertEqual(inst.pending, 1)
+        event.set()
+        inst.shutdown()
+
+    def test_inline_after_shutdown(self):
+        inst = self._makeOne()
+        inst.shutdown()
+        L = []
+        inst.submit(testing.DummyRequest(), lambda: L.append(1))
+        self.assertEqual(L, [1])
+        self.assertEqual(inst.inline, 1)
+        self.assertEqual(inst._threads, [])
+
+    def test_inline_error_raised(self):
+        inst = self._makeOne(max_pending=0)
+        def func():
+            raise ValueError
+        self.assertRaises(ValueError, inst.submit, testing.DummyRequest(),
+                          func)
+        self.assertEqual(inst.errors, 0)
+
+    def test_error_counted(self):
+        import io
+        import sys
+        inst = self._makeOne()
+        def func():
+            raise ValueError('broken')
+        stderr = sys.stderr
+        sys.stderr = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            inst.submit(testing.DummyRequest(), func)
+            inst.shutdown()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue('ValueError: broken' in output)
+        self.assertEqual(inst.errors, 1)
+        self.assertEqual(inst.completed, 1)
+
+    def test_stats(self):
+        inst = self._makeOne(max_pending=0, time=DummyTime([1.0, 3.5]))
+        inst.submit(testing.DummyRequest(), lambda: None)
+        self.assertEqual(inst.stats(), {
+            'cleanup_pending': 0,
+            'cleanup_completed': 0,
+            'cleanup_inline': 1,
+            'cleanup_errors': 0,
+            'cleanup_seconds': 2.5,
+            'cleanup_max_seconds': 2.5,
+            })
+
+class TestBackgroundCleanup(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.background_cleanup': 'true',
+            })
+        self.config.include('pyramid_zodbconn')
+        self.db = self.config.registry._zodb_databases['']
+        self.cleanup = self.config.registry._zodb_cleanup
+
+    def tearDown(self):
+        self.cleanup.shutdown()
+        self.db.close()
+        testing.tearDown()
+
+    def test_connection_returned_to_pool(self):
+        import transaction
+        from pyramid_zodbconn import get_connection
+        request = testing.DummyRequest()
+        request.tm = transaction.TransactionManager()
+        conn = get_connection(request)
+        conn.root()['a'] = 1
+        request.finished_callbacks[0](request)
+        self.cleanup.shutdown()
+        self.assertEqual(self.cleanup.completed, 1)
+        self.assertEqual(conn.opened, None)
+        self.assertTrue(self.db.pool.available[-1][1] is conn)
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        self.assertFalse('a' in conn.root())
+        conn.close()
+
+    def test_request_without_tm_cleaned_up_inline(self):
+        import transaction
+        from pyramid_zodbconn import get_connection
+        request = testing.DummyRequest()
+        conn = get_connection(request)
+        conn.root()['a'] = 1
+        request.finished_callbacks[0](request)
+        self.assertEqual(self.cleanup.inline, 0)
+        self.assertEqual(self.cleanup.pending, 0)
+        self.assertEqual(conn.opened, None)
+        # the next request served by the thread uses the same manager
+        request = testing.DummyRequest()
+        conn = get_connection(request)
+        self.assertFalse('a' in conn.root())
+        conn.root()['b'] = 2
+        transaction.commit()
+        request.finished_callbacks[0](request)
+        self.cleanup.shutdown()
+        conn = self.db.open(transaction.TransactionManager())
+        self.assertEqual(conn.root()['b'], 2)
+        conn.close()
+
+class Test_can_defer(unittest.TestCase):
+    def _callFUT(self, conn):
+        from pyramid_zodbconn.cleanup import can_defer
+        return can_defer(conn)
+
+    def test_explicit_tm(self):
+        import transaction
+        conn = DummyConnection(transaction.TransactionManager())
+        self.assertTrue(self._callFUT(conn))
+
+    def test_thread_local_tm(self):
+        import transaction
+        conn = DummyConnection(transaction.manager)
+        self.assertFalse(self._callFUT(conn))
+
+    def test_default_tm_of_thread(self):
+        import transaction
+        conn = DummyConnection(transaction.manager.manager)
+        self.assertFalse(self._callFUT(conn))
+
+    def test_readonly_tm(self):
+        from pyramid_zodbconn import READONLY_TM
+        conn = DummyConnection(READONLY_TM)
+        self.assertTrue(self._callFUT(conn))
+
+class DummyTime(object):
+    def __init__(self, times=None):
+        self.times = list(times or ())
+
+    def time(self):
+        if self.times:
+            return self.times.pop(0)
+        return 0.0
+
+class DummyConnection(object):
+    def __init__(self, transaction_manager):
+        self.transaction_manager = transaction_manager
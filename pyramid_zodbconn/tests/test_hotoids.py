@@ -0,0 +1,129 @@
+import unittest
+from pyramid import testing
+
+from pyramid_zodbconn.tests import DummyLazyDB
+
+class TestHotOidProfile(unittest.TestCase):
+    def _makeOne(self, size=10000):
+        from pyramid_zodbconn.hotoids import HotOidProfile
+        return HotOidProfile(size)
+
+    def test_add_and_top(self):
+        inst = self._makeOne()
+        inst.add([b'a', b'b', b'a'])
+        inst.add([b'c', b'a'])
+        self.assertEqual(inst.requests, 2)
+        self.assertEqual(inst.loads, 5)
+        self.assertEqual(inst.top(), [(b'a', 3), (b'b', 1), (b'c', 1)])
+        self.assertEqual(inst.top(1), [(b'a', 3)])
+
+    def test_bounded(self):
+        inst = self._makeOne(size=2)
+        inst.add([b'a', b'a', b'a', b'b', b'b', b'c', b'd', b'e'])
+        self.assertEqual(len(inst.counts), 2)
+        self.assertEqual(inst.pruned, 3)
+        self.assertEqual(inst.top(), [(b'a', 3), (b'b', 2)])
+
+    def test_hot_set(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.hot_set(0.9), 0)
+        inst.add([b'a'] * 90 + [b'b'] * 9 + [b'c'])
+        self.assertEqual(inst.hot_set(0.9), 1)
+        self.assertEqual(inst.hot_set(0.99), 2)
+        self.assertEqual(inst.hot_set(1.0), 3)
+
+    def test_report(self):
+        inst = self._makeOne()
+        inst.add([b'a', b'b'])
+        report = inst.report(cache_size=1)
+        self.assertEqual(report['requests'], 1)
+        self.assertEqual(report['tracked'], 2)
+        self.assertEqual(report['hot_set_90'], 2)
+        self.assertEqual(report['covered'], False)
+        self.assertEqual(inst.report()['covered'], None)
+
+    def test_write(self):
+        import os
+        import shutil
+        import tempfile
+        from ZODB.utils import p64
+        from pyramid_zodbconn.warmup import read_entries
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'hot.txt')
+        inst = self._makeOne()
+        inst.add([p64(1), p64(42), p64(42)])
+        inst.write(filename, cache_size=400)
+        self.assertEqual(os.listdir(tmpdir), ['hot.txt'])
+        with open(filename) as f:
+            lines = f.read().splitlines()
+        self.assertTrue('# covered: True' in lines)
+        self.assertEqual(lines[-2:], ['0x2a 2', '0x1 1'])
+        self.assertEqual(read_entries(filename), [p64(42), p64(1)])
+
+class TestHotOidProfiler(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        self.db = DB(MappingStorage())
+        self.db.cacheMinimize()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _makeOne(self, **kw):
+        from pyramid_zodbconn.hotoids import HotOidProfile
+        from pyramid_zodbconn.hotoids import HotOidProfiler
+        return HotOidProfiler(HotOidProfile(), {'': self.db}, **kw)
+
+    def _makeEvent(self, conn):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        return ZODBConnectionOpened(conn, testing.DummyRequest())
+
+    def test_request_cycle(self):
+        from ZODB.utils import z64
+        inst = self._makeOne()
+        conn = self.db.open()
+        conn.cacheMinimize()
+        event = self._makeEvent(conn)
+        inst.start(event)
+        conn.root()['x'] = 1
+        inst.end(event)
+        conn.transaction_manager.abort()
+        conn.close()
+        self.assertEqual(inst.profile.requests, 1)
+        self.assertEqual(inst.profile.top(1)[0][0], z64)
+        self.assertEqual(conn._normal_storage.recorders, ())
+
+    def test_not_sampled(self):
+        inst = self._makeOne(sample_rate=0.5, random=lambda: 0.5)
+        conn = self.db.open()
+        event = self._makeEvent(conn)
+        inst.start(event)
+        inst.end(event)
+        conn.close()
+        self.assertEqual(inst.profile.requests, 0)
+
+    def test_cache_size(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.cache_size(), 400)
+        inst.databases = {'': DummyLazyDB()}
+        self.assertEqual(inst.cache_size(), None)
+        inst.databases = {}
+        self.assertEqual(inst.cache_size(), None)
+
+    def test_writer(self):
+        import os
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'hot.txt')
+        inst = self._makeOne(filename=filename, interval=60)
+        inst.writer.start(None)
+        thread = inst.writer._thread
+        inst.writer.start(None)
+        self.assertTrue(inst.writer._thread is thread)
+        inst.writer.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(os.path.exists(filename))
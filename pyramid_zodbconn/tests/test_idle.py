@@ -0,0 +1,118 @@
+import unittest
+
+from pyramid_zodbconn.tests import DummyLazyDB
+
+class TestIdleTrimmer(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from persistent.mapping import PersistentMapping
+        import transaction
+        self.databases = {}
+        for name in ('', 'foo'):
+            DB(MappingStorage(), databases=self.databases, database_name=name)
+        self.db = self.databases['']
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        conn.get_connection('foo').root()['a'] = PersistentMapping()
+        root = conn.root()
+        for i in range(10):
+            root[i] = PersistentMapping()
+        tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        for db in self.databases.values():
+            db.close()
+
+    def _makeOne(self, **kw):
+        from pyramid_zodbconn.idle import IdleTrimmer
+        kw.setdefault('time', FakeTimeModule())
+        return IdleTrimmer(self.databases, **kw)
+
+    def _open(self, n):
+        import transaction
+        conns = [self.db.open(transaction.TransactionManager())
+                 for i in range(n)]
+        for conn in conns:
+            conn.get_connection('foo').root()['a']._p_activate()
+            for obj in conn.root().values():
+                obj._p_activate()
+        for conn in conns:
+            conn.close()
+        return conns
+
+    def _cached(self, conn):
+        return sum(c._cache.cache_non_ghost_count
+                   for c in conn.connections.values())
+
+    def test_trims_idle_connections(self):
+        conn, = self._open(1)
+        self.assertTrue(self._cached(conn) > 10)
+        inst = self._makeOne(idle_time=300)
+        self.assertEqual(inst.trim(), 0)
+        inst._time.now += 400
+        self.assertEqual(inst.trim(), 1)
+        self.assertEqual(self._cached(conn), 0)
+        # already trimmed
+        self.assertEqual(inst.trim(), 0)
+        self.assertEqual(inst.trimmed, 1)
+
+    def test_batch(self):
+        self._open(3)
+        inst = self._makeOne(idle_time=0, batch=2)
+        inst._time.now += 1
+        self.assertEqual(inst.trim(), 2)
+        self.assertEqual(inst.trim(), 1)
+        self.assertEqual(inst.trim(), 0)
+
+    def test_skips_busy_pools(self):
+        self._open(1)
+        inst = self._makeOne(idle_time=0)
+        inst._time.now += 1
+        self.db._lock.acquire()
+        try:
+            import threading
+            result = []
+            thread = threading.Thread(target=lambda: result.append(inst.trim()))
+            thread.start()
+            thread.join()
+        finally:
+            self.db._lock.release()
+        self.assertEqual(result, [0])
+
+    def test_keep(self):
+        self._open(3)
+        inst = self._makeOne(idle_time=0, keep=1)
+        inst._time.now += 1
+        inst.trim()
+        self.assertEqual(inst.closed, 2)
+        self.assertEqual(len(self.db.pool.available), 1)
+        self.assertEqual(len(self.db.pool.all), 1)
+        self.assertEqual(inst.trimmed, 1)
+
+    def test_skips_unloaded_lazy_databases(self):
+        self.databases['lazy'] = DummyLazyDB()
+        try:
+            inst = self._makeOne(idle_time=300)
+            self.assertEqual(inst.trim(), 0)
+        finally:
+            del self.databases['lazy']
+
+    def test_start_stop(self):
+        inst = self._makeOne(interval=0.01)
+        inst.start(None)
+        thread = inst._thread
+        inst.start(None)
+        self.assertTrue(inst._thread is thread)
+        inst.stop()
+        self.assertEqual(inst._thread, None)
+        self.assertFalse(thread.is_alive())
+
+class FakeTimeModule(object):
+    def __init__(self):
+        import time
+        self.now = time.time()
+
+    def time(self):
+        return self.now
@@ -1,4 +1,5 @@
 import unittest
+import transaction
 from pyramid import testing
 from webtest import TestApp
 
@@ -44,6 +45,30 @@ class Test_get_connection(unittest.TestCase):
         conn = self._callFUT(request, 'secondary')
         self.assertEqual(conn, secondary)
 
+    def test_secondary_conn_event_sent_once(self):
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        from pyramid_zodbconn import get_secondary_connections
+        events = []
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        self.config.add_subscriber(events.append, ZODBSecondaryConnectionOpened)
+        request = self._makeRequest()
+        secondary = DummyConnection()
+        request._primary_zodb_conn = DummyConnection({'secondary':secondary})
+        self._callFUT(request, 'secondary')
+        self._callFUT(request, 'secondary')
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].conn, secondary)
+        self.assertEqual(events[0].dbname, 'secondary')
+        self.assertEqual(events[0].request, request)
+        self.assertEqual(get_secondary_connections(request),
+                         {'secondary': secondary})
+
+    def test_get_secondary_connections_none(self):
+        from pyramid_zodbconn import get_secondary_connections
+        request = self._makeRequest()
+        self.assertEqual(get_secondary_connections(request), {})
+
     def test_primary_conn_new_wo_request_tm(self):
         request = self._makeRequest()
         db = request.registry._zodb_databases['']
@@ -71,13 +96,421 @@ class Test_get_connection(unittest.TestCase):
         self.assertTrue(conn.closed)
         self.assertTrue(conn.transaction_manager.aborted)
 
+    def test_primary_conn_readonly_request_attribute(self):
+        from pyramid_zodbconn import READONLY_TM
+        request = self._makeRequest()
+        request.tm = object()
+        request.zodb_readonly = True
+        db = request.registry._zodb_databases['']
+        conn = self._callFUT(request)
+        self.assertEqual(db._opened_with, [READONLY_TM])
+        callback = request.finished_callbacks[0]
+        callback(request)
+        self.assertTrue(conn.closed)
+        self.assertFalse(conn.transaction_manager.aborted)
+
+    def test_primary_conn_readonly_policy(self):
+        from pyramid_zodbconn import READONLY_TM
+        from pyramid_zodbconn import readonly_policy
+        request = self._makeRequest()
+        request.registry._zodb_readonly_policy = readonly_policy(['GET'])
+        self.addCleanup(delattr, request.registry, '_zodb_readonly_policy')
+        db = request.registry._zodb_databases['']
+        self._callFUT(request)
+        self.assertEqual(db._opened_with, [READONLY_TM])
+
+    def test_primary_conn_readonly_policy_overridden(self):
+        from pyramid_zodbconn import readonly_policy
+        request = self._makeRequest()
+        request.registry._zodb_readonly_policy = readonly_policy(['GET'])
+        self.addCleanup(delattr, request.registry, '_zodb_readonly_policy')
+        request.zodb_readonly = False
+        db = request.registry._zodb_databases['']
+        self._callFUT(request)
+        self.assertEqual(db._opened_with, [None])
+
+    def test_primary_conn_pool_limit(self):
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        request = self._makeRequest()
+        limiter = request.registry._zodb_limiter = ConnectionLimiter(1)
+        self.addCleanup(delattr, request.registry, '_zodb_limiter')
+        self._callFUT(request)
+        self.assertEqual(limiter.in_use, 1)
+        request.finished_callbacks[0](request)
+        self.assertEqual(limiter.in_use, 0)
+
+    def test_primary_conn_pool_limit_released_on_error(self):
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        request = self._makeRequest()
+        limiter = request.registry._zodb_limiter = ConnectionLimiter(1)
+        self.addCleanup(delattr, request.registry, '_zodb_limiter')
+        db = request.registry._zodb_databases['']
+        def open(transaction_manager=None):
+            raise ValueError
+        db.open = open
+        self.assertRaises(ValueError, self._callFUT, request)
+        self.assertEqual(limiter.in_use, 0)
+
+    def test_primary_conn_pool_limit_released_on_close_error(self):
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        request = self._makeRequest()
+        limiter = request.registry._zodb_limiter = ConnectionLimiter(1)
+        self.addCleanup(delattr, request.registry, '_zodb_limiter')
+        conn = self._callFUT(request)
+        def close():
+            raise ValueError
+        conn.close = close
+        self.assertRaises(ValueError, request.finished_callbacks[0], request)
+        self.assertEqual(limiter.in_use, 0)
+
+    def test_primary_conn_background_cleanup(self):
+        from pyramid_zodbconn import ZODBConnectionClosed
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        events = []
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        self.config.add_subscriber(events.append, ZODBConnectionWillClose)
+        self.config.add_subscriber(events.append, ZODBConnectionClosed)
+        request = self._makeRequest()
+        cleanup = request.registry._zodb_cleanup = DummyCleanupExecutor()
+        self.addCleanup(delattr, request.registry, '_zodb_cleanup')
+        limiter = request.registry._zodb_limiter = ConnectionLimiter(1)
+        self.addCleanup(delattr, request.registry, '_zodb_limiter')
+        conn = self._callFUT(request)
+        request.finished_callbacks[0](request)
+        self.assertEqual([event.__class__ for event in events],
+                         [ZODBConnectionWillClose])
+        self.assertFalse(conn.closed)
+        self.assertEqual(limiter.in_use, 1)
+        self.assertEqual(len(cleanup.submitted), 1)
+        self.assertTrue(cleanup.submitted[0][0] is request)
+        cleanup.submitted[0][1]()
+        self.assertTrue(conn.transaction_manager.aborted)
+        self.assertTrue(conn.closed)
+        self.assertEqual(limiter.in_use, 0)
+        self.assertEqual([event.__class__ for event in events],
+                         [ZODBConnectionWillClose, ZODBConnectionClosed])
+
+    def test_primary_conn_background_cleanup_thread_local_tm(self):
+        import transaction
+        request = self._makeRequest()
+        cleanup = request.registry._zodb_cleanup = DummyCleanupExecutor()
+        self.addCleanup(delattr, request.registry, '_zodb_cleanup')
+        conn = self._callFUT(request)
+        tm = conn.transaction_manager = DummyThreadTransactionManager()
+        self.assertTrue(isinstance(tm, transaction.ThreadTransactionManager))
+        request.finished_callbacks[0](request)
+        self.assertEqual(cleanup.submitted, [])
+        self.assertTrue(conn.closed)
+        self.assertTrue(tm.aborted)
+
+    def test_primary_conn_pool_limit_released_on_will_close_error(self):
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        def will_close(event):
+            raise ValueError
+        self.config.add_subscriber(will_close, ZODBConnectionWillClose)
+        request = self._makeRequest()
+        limiter = request.registry._zodb_limiter = ConnectionLimiter(1)
+        self.addCleanup(delattr, request.registry, '_zodb_limiter')
+        conn = self._callFUT(request)
+        self.assertRaises(ValueError, request.finished_callbacks[0], request)
+        self.assertEqual(limiter.in_use, 0)
+        self.assertTrue(conn.closed)
+        self.assertTrue(conn.transaction_manager.aborted)
+
+    def test_primary_conn_released_on_opened_error(self):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        self.config = testing.setUp()
+        self.addCleanup(testing.tearDown)
+        def opened(event):
+            raise ValueError
+        self.config.add_subscriber(opened, ZODBConnectionOpened)
+        request = self._makeRequest()
+        limiter = request.registry._zodb_limiter = ConnectionLimiter(1)
+        self.addCleanup(delattr, request.registry, '_zodb_limiter')
+        db = request.registry._zodb_databases['']
+        self.assertRaises(ValueError, self._callFUT, request)
+        self.assertEqual(limiter.in_use, 0)
+        self.assertTrue(db.connection.closed)
+        self.assertTrue(db.connection.transaction_manager.aborted)
+        self.assertEqual(len(request.finished_callbacks), 0)
+        self.assertFalse(hasattr(request, '_primary_zodb_conn'))
+
+    def _pushRequests(self, *requests):
+        from pyramid.threadlocal import manager
+        for request in requests:
+            manager.push({'request': request, 'registry': request.registry})
+            self.addCleanup(manager.pop)
+
+    def test_subrequest_reuses_parent_conn(self):
+        parent = self._makeRequest()
+        parent_tm = parent.tm = object()
+        request = testing.DummyRequest()
+        request.registry._zodb_subrequest_reuse = True
+        self.addCleanup(delattr, request.registry, '_zodb_subrequest_reuse')
+        db = parent.registry._zodb_databases['']
+        conn = self._callFUT(parent)
+        self._pushRequests(parent, request)
+        self.assertTrue(self._callFUT(request) is conn)
+        self.assertTrue(self._callFUT(request) is conn)
+        self.assertEqual(db._opened_with, [parent_tm])
+        self.assertTrue(request.tm is parent_tm)
+        self.assertEqual(len(request.finished_callbacks), 0)
+        self.assertEqual(len(parent.finished_callbacks), 1)
+
+    def test_subrequest_opens_parent_conn(self):
+        parent = self._makeRequest()
+        request = testing.DummyRequest()
+        request.registry._zodb_subrequest_reuse = True
+        self.addCleanup(delattr, request.registry, '_zodb_subrequest_reuse')
+        self._pushRequests(parent, request)
+        conn = self._callFUT(request)
+        self.assertTrue(parent._primary_zodb_conn is conn)
+        self.assertEqual(len(request.finished_callbacks), 0)
+        self.assertEqual(len(parent.finished_callbacks), 1)
+        self.assertFalse(hasattr(request, 'tm'))
+
+    def test_nested_subrequest_opens_outer_conn(self):
+        outer = self._makeRequest()
+        outer_tm = outer.tm = object()
+        middle = testing.DummyRequest()
+        request = testing.DummyRequest()
+        request.registry._zodb_subrequest_reuse = True
+        self.addCleanup(delattr, request.registry, '_zodb_subrequest_reuse')
+        db = outer.registry._zodb_databases['']
+        self._pushRequests(outer, middle, request)
+        conn = self._callFUT(request)
+        self.assertTrue(outer._primary_zodb_conn is conn)
+        self.assertTrue(middle._primary_zodb_conn is conn)
+        self.assertTrue(self._callFUT(middle) is conn)
+        self.assertEqual(db._opened_with, [outer_tm])
+        self.assertTrue(middle.tm is outer_tm)
+        self.assertTrue(request.tm is outer_tm)
+        self.assertEqual(len(middle.finished_callbacks), 0)
+        self.assertEqual(len(outer.finished_callbacks), 1)
+
+    def test_subrequest_secondary_conn(self):
+        from pyramid_zodbconn import get_secondary_connections
+        parent = self._makeRequest()
+        secondary = DummyConnection()
+        parent._primary_zodb_conn = DummyConnection({'secondary': secondary})
+        request = testing.DummyRequest()
+        request.registry._zodb_subrequest_reuse = True
+        self.addCleanup(delattr, request.registry, '_zodb_subrequest_reuse')
+        self._pushRequests(parent, request)
+        self.assertTrue(self._callFUT(request, 'secondary') is secondary)
+        self.assertEqual(get_secondary_connections(parent),
+                         {'secondary': secondary})
+        self.assertEqual(get_secondary_connections(request),
+                         {'secondary': secondary})
+
+    def test_subrequest_without_reuse(self):
+        parent = self._makeRequest()
+        request = testing.DummyRequest()
+        self._pushRequests(parent, request)
+        self._callFUT(request)
+        self.assertFalse(hasattr(parent, '_primary_zodb_conn'))
+        self.assertEqual(len(request.finished_callbacks), 1)
+
+class Test_find_parent_request(unittest.TestCase):
+    def _callFUT(self, request):
+        from pyramid_zodbconn import find_parent_request
+        return find_parent_request(request)
+
+    def _push(self, request):
+        from pyramid.threadlocal import manager
+        manager.push({'request': request})
+        self.addCleanup(manager.pop)
+
+    def test_subrequest(self):
+        parent = testing.DummyRequest()
+        request = testing.DummyRequest()
+        self._push(parent)
+        self._push(request)
+        self.assertTrue(self._callFUT(request) is parent)
+
+    def test_not_a_subrequest(self):
+        request = testing.DummyRequest()
+        self.assertEqual(self._callFUT(request), None)
+        self._push(request)
+        self.assertEqual(self._callFUT(request), None)
+
+    def test_not_on_stack(self):
+        parent = testing.DummyRequest()
+        request = testing.DummyRequest()
+        self._push(parent)
+        self._push(testing.DummyRequest())
+        self.assertEqual(self._callFUT(request), None)
+
+    def test_pushed_twice(self):
+        request = testing.DummyRequest()
+        self._push(request)
+        self._push(request)
+        self.assertEqual(self._callFUT(request), None)
+
+    def test_parent_pushed_twice(self):
+        parent = testing.DummyRequest()
+        request = testing.DummyRequest()
+        self._push(parent)
+        self._push(request)
+        self._push(request)
+        self.assertTrue(self._callFUT(request) is parent)
+
+    def test_not_current_request(self):
+        outer = testing.DummyRequest()
+        request = testing.DummyRequest()
+        self._push(outer)
+        self._push(request)
+        self._push(testing.DummyRequest())
+        self.assertTrue(self._callFUT(request) is outer)
+
+    def test_nested_nearest_with_connection(self):
+        outer = testing.DummyRequest()
+        outer._primary_zodb_conn = DummyConnection()
+        middle = testing.DummyRequest()
+        request = testing.DummyRequest()
+        self._push(outer)
+        self._push(middle)
+        self._push(request)
+        self.assertTrue(self._callFUT(request) is outer)
+        middle._primary_zodb_conn = DummyConnection()
+        self.assertTrue(self._callFUT(request) is middle)
+
+    def test_nested_without_connection(self):
+        outer = testing.DummyRequest()
+        middle = testing.DummyRequest()
+        request = testing.DummyRequest()
+        self._push(outer)
+        self._push(middle)
+        self._push(request)
+        self.assertTrue(self._callFUT(request) is middle)
+        self.assertTrue(self._callFUT(middle) is outer)
+
+class TestReadOnlyTransactionManager(unittest.TestCase):
+    def _makeOne(self):
+        from pyramid_zodbconn import ReadOnlyTransactionManager
+        return ReadOnlyTransactionManager()
+
+    def test_it(self):
+        from ZODB.POSException import ReadOnlyError
+        inst = self._makeOne()
+        self.assertFalse(getattr(inst, 'explicit', False))
+        resource = DummyConnection()
+        self.assertRaises(ReadOnlyError, inst.get().join, resource)
+        self.assertTrue(resource._pyramid_zodbconn_readonly_violated)
+        self.assertRaises(ReadOnlyError, inst.begin)
+        self.assertRaises(ReadOnlyError, inst.commit)
+        inst.abort()
+        inst.registerSynch(None)
+        inst.unregisterSynch(None)
+
+class Test_readonly_policy(unittest.TestCase):
+    def _callFUT(self, methods=(), predicate=None):
+        from pyramid_zodbconn import readonly_policy
+        return readonly_policy(methods, predicate)
+
+    def test_none(self):
+        self.assertEqual(self._callFUT(), None)
+
+    def test_methods(self):
+        policy = self._callFUT(['get', 'HEAD'])
+        self.assertTrue(policy(testing.DummyRequest()))
+        self.assertFalse(policy(testing.DummyRequest(post={})))
+
+    def test_predicate(self):
+        policy = self._callFUT(
+            ['HEAD'], lambda request: request.path.startswith('/static'))
+        self.assertFalse(policy(testing.DummyRequest(path='/foo')))
+        self.assertTrue(policy(testing.DummyRequest(path='/static/x')))
+
+class TestConnectionNotifier(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def _makeOne(self):
+        from pyramid_zodbconn import ConnectionNotifier
+        registry = self.config.registry
+        notified = []
+        registry.notify = notified.append
+        return ConnectionNotifier(registry), notified
+
+    def test_without_subscribers(self):
+        inst, notified = self._makeOne()
+        inst.opened(None, None)
+        inst.secondary_opened(None, None, 'foo')
+        inst.will_close(None, None)
+        inst.closed(None, None)
+        self.assertEqual(notified, [])
+
+    def test_subscriptions_change(self):
+        from pyramid_zodbconn import ZODBConnectionClosed
+        from pyramid_zodbconn import ZODBConnectionOpened
+        inst, notified = self._makeOne()
+        inst.opened('conn', 'request')
+        self.config.add_subscriber(lambda event: None, ZODBConnectionClosed)
+        inst.opened('conn', 'request')
+        inst.closed('conn', 'request')
+        self.assertEqual(len(notified), 1)
+        self.assertEqual(notified[0].__class__, ZODBConnectionClosed)
+        self.assertEqual(notified[0].conn, 'conn')
+        self.assertEqual(notified[0].request, 'request')
+        self.assertFalse(inst.wants(ZODBConnectionOpened))
+
+    def test_base_class_subscriber(self):
+        from pyramid_zodbconn import ConnectionEvent
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        inst, notified = self._makeOne()
+        self.config.add_subscriber(lambda event: None, ConnectionEvent)
+        inst.secondary_opened('conn', 'request', 'foo')
+        self.assertEqual(notified[0].__class__, ZODBSecondaryConnectionOpened)
+        self.assertEqual(notified[0].dbname, 'foo')
+
+    def test_unknown_generation(self):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        inst, notified = self._makeOne()
+        inst.registry = DummyRegistry()
+        self.assertTrue(inst.wants(ZODBConnectionOpened))
+
+    def test_hooks(self):
+        inst, notified = self._makeOne()
+        hook = DummyLifecycleHook()
+        inst.add_hook(hook)
+        inst.opened('conn', 'request')
+        inst.secondary_opened('conn2', 'request', 'foo')
+        inst.will_close('conn', 'request')
+        inst.closed('conn', 'request')
+        self.assertEqual(hook.calls, [
+            ('opened', 'conn', 'request'),
+            ('secondary_opened', 'conn2', 'request', 'foo'),
+            ('will_close', 'conn', 'request'),
+            ('closed', 'conn', 'request'),
+            ])
+        self.assertEqual(notified, [])
+
+class TestConnectionLifecycleHook(unittest.TestCase):
+    def test_noops(self):
+        from pyramid_zodbconn import ConnectionLifecycleHook
+        hook = ConnectionLifecycleHook()
+        hook.opened(None, None)
+        hook.secondary_opened(None, None, 'foo')
+        hook.will_close(None, None)
+        hook.closed(None, None)
+
 class TestTransferLog(unittest.TestCase):
-    def _makeOne(self, stream=None, threshhold=None):
+    def _makeOne(self, stream=None, threshhold=None, **kw):
         from pyramid_zodbconn import TransferLog
         if stream is None:
             import io
             stream = io.StringIO()
-        return TransferLog(stream, threshhold)
+        return TransferLog(stream, threshhold, **kw)
 
     def test_start(self):
         inst = self._makeOne()
@@ -104,6 +537,32 @@ class TestTransferLog(unittest.TestCase):
         result = inst.stream.getvalue()
         self.assertTrue('"GET", "", 1.00, -1, -1\n' in result, result)
 
+    def test_bad_format(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._makeOne, format='xml')
+
+    def test_end_json(self):
+        import json
+        inst = self._makeOne(format='json')
+        event = DummyZODBEvent()
+        setattr(event.request, inst.key, {'loads':1, 'stores':1, 'start':0})
+        inst.end(event, time=FakeTimeModule(2))
+        record = json.loads(inst.stream.getvalue())
+        self.assertEqual(record['elapsed'], 2)
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['loads'], -1)
+
+    def test_end_binary(self):
+        import io
+        from pyramid_zodbconn.transferlog import read_binary
+        inst = self._makeOne(io.BytesIO(), format='binary')
+        event = DummyZODBEvent()
+        setattr(event.request, inst.key, {'loads':0, 'stores':0, 'start':0})
+        inst.end(event, time=FakeTimeModule(2))
+        records = list(read_binary(inst.stream.getvalue()))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].elapsed, 2)
+
     def test_limited_by_threshhold(self):
         inst = self._makeOne(threshhold=5)
         event = DummyZODBEvent()
@@ -123,6 +582,72 @@ class TestTransferLog(unittest.TestCase):
         result = inst.stream.getvalue()
         self.assertTrue('"GET", "", 2.00, -1, -1\n' in result, result)
 
+    def test_start_threshhold_only(self):
+        inst = self._makeOne(threshhold=0.5)
+        event = DummyZODBEvent()
+        inst.start(event, time=FakeTimeModule())
+        self.assertFalse(getattr(event.request, inst.key)['sampled'])
+
+    def test_start_not_sampled(self):
+        inst = self._makeOne(sample_rate=0.01, random=lambda: 0.5)
+        event = DummyZODBEvent()
+        inst.start(event, time=FakeTimeModule())
+        self.assertFalse(hasattr(event.request, inst.key))
+
+    def test_sampled_below_threshhold(self):
+        inst = self._makeOne(threshhold=0.5, sample_rate=0.01,
+                             random=lambda: 0.001)
+        event = DummyZODBEvent()
+        inst.start(event, time=FakeTimeModule(0))
+        inst.end(event, time=FakeTimeModule(0.1))
+        self.assertTrue('"GET", "", 0.10, 0, 0\n' in inst.stream.getvalue())
+
+    def test_not_sampled_above_threshhold(self):
+        inst = self._makeOne(threshhold=0.5, sample_rate=0.01,
+                             random=lambda: 0.5)
+        event = DummyZODBEvent()
+        inst.start(event, time=FakeTimeModule(0))
+        inst.end(event, time=FakeTimeModule(0.75))
+        self.assertTrue('"GET", "", 0.75, 0, 0\n' in inst.stream.getvalue())
+
+    def test_max_rate(self):
+        inst = self._makeOne(max_rate=2)
+        for now in (0, 0.1, 0.2, 0.3, 1.0):
+            event = DummyZODBEvent()
+            inst.start(event, time=FakeTimeModule(now))
+            inst.end(event, time=FakeTimeModule(now))
+        self.assertEqual(len(inst.stream.getvalue().splitlines()), 3)
+        self.assertEqual(inst.suppressed, 2)
+
+    def test_max_rate_below_one(self):
+        inst = self._makeOne(max_rate=0.5)
+        for now in (0, 1.0, 2.0, 3.0, 10.0, 10.5):
+            event = DummyZODBEvent()
+            inst.start(event, time=FakeTimeModule(now))
+            inst.end(event, time=FakeTimeModule(now))
+        # at 0, 2.0 and 10.0 (a single line's worth was saved up)
+        self.assertEqual(len(inst.stream.getvalue().splitlines()), 3)
+        self.assertEqual(inst.suppressed, 3)
+
+    def test_secondaries(self):
+        inst = self._makeOne()
+        event = DummyZODBEvent()
+        secondary = DummyConnection()
+        idle = DummyConnection()
+        untouched = DummyConnection()
+        event.conn.connections = {'': event.conn, 'foo': secondary,
+                                  'bar': idle, 'baz': untouched}
+        secondary.transfer_counts = (1, 1)
+        inst.start(event, time=FakeTimeModule())
+        secondary.transfer_counts = (4, 2)
+        idle.transfer_counts = (2, 0)
+        event.request._zodb_secondary_conns = {'baz': untouched}
+        inst.end(event, time=FakeTimeModule(1))
+        result = inst.stream.getvalue()
+        self.assertTrue(result.endswith(
+            '"GET", "", 1.00, 0, 0, "bar", 2, 0, "baz", 0, 0, "foo", 3, 1\n'),
+            result)
+
 class Test_db_from_uri(unittest.TestCase):
     def test_it(self):
         from pyramid_zodbconn import db_from_uri
@@ -135,6 +660,148 @@ class Test_db_from_uri(unittest.TestCase):
         db = db_from_uri('whatever', 'name', {}, resolve_uri=resolve_uri)
         self.assertEqual(db._storage, storage)
 
+class TestLazyDB(unittest.TestCase):
+    def _makeOne(self, databases, name='foo'):
+        from pyramid_zodbconn import LazyDB
+        self.created = []
+        def db_from_uri(uri, dbname, dbmap):
+            db = DummyDB()
+            dbmap[dbname] = db
+            self.created.append((uri, dbname, dbmap))
+            return db
+        inst = LazyDB('uri', name, databases, db_from_uri)
+        databases[name] = inst
+        return inst
+
+    def test_not_loaded(self):
+        inst = self._makeOne({})
+        self.assertFalse(inst.loaded)
+        self.assertEqual(self.created, [])
+
+    def test_open(self):
+        databases = {}
+        inst = self._makeOne(databases)
+        tm = object()
+        conn = inst.open(transaction_manager=tm)
+        db = databases['foo']
+        self.assertTrue(inst.loaded)
+        self.assertTrue(inst.db is db)
+        self.assertTrue(db.databases is databases)
+        self.assertTrue(db.getActivityMonitor())
+        self.assertEqual(conn, db.connection)
+        self.assertEqual(db._opened_with, [tm])
+        self.assertEqual(len(self.created), 1)
+        uri, dbname, dbmap = self.created[0]
+        self.assertEqual((uri, dbname), ('uri', 'foo'))
+        self.assertFalse(dbmap is databases)
+
+    def test_other_attributes_delegated(self):
+        databases = {}
+        inst = self._makeOne(databases)
+        self.assertTrue(inst.getActivityMonitor())
+        db = databases['foo']
+        self.assertTrue(inst.db is db)
+        inst.close()
+        self.assertTrue(db.closed)
+        self.assertEqual(len(self.created), 1)
+
+    def test_close_not_loaded(self):
+        inst = self._makeOne({})
+        inst.close()
+        self.assertFalse(inst.loaded)
+        self.assertEqual(self.created, [])
+
+    def test_protocol_attributes_not_delegated(self):
+        inst = self._makeOne({})
+        self.assertFalse(hasattr(inst, '__deepcopy__'))
+        self.assertFalse(inst.loaded)
+
+    def test_load_once(self):
+        inst = self._makeOne({})
+        db = inst.load()
+        self.assertTrue(inst.load() is db)
+        inst.open()
+        self.assertEqual(len(self.created), 1)
+
+    def test_load_concurrently(self):
+        import threading
+        inst = self._makeOne({})
+        barrier = threading.Event()
+        def load():
+            barrier.wait()
+            inst.load()
+        threads = [threading.Thread(target=load) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.created), 1)
+
+class Test_is_loaded(unittest.TestCase):
+    def _callFUT(self, db):
+        from pyramid_zodbconn import is_loaded
+        return is_loaded(db)
+
+    def test_database(self):
+        self.assertTrue(self._callFUT(DummyDB()))
+
+    def test_lazy_database(self):
+        from pyramid_zodbconn import LazyDB
+        databases = {}
+        def db_from_uri(uri, dbname, dbmap):
+            return DummyDB()
+        inst = LazyDB('uri', 'foo', databases, db_from_uri)
+        self.assertFalse(self._callFUT(inst))
+        inst.load()
+        self.assertTrue(self._callFUT(inst))
+
+class Test_open_databases(unittest.TestCase):
+    def _callFUT(self, uris, databases, db_from_uri, threads=4):
+        from pyramid_zodbconn import open_databases
+        return open_databases(uris, databases, db_from_uri, threads)
+
+    def test_it(self):
+        import threading
+        built = {}
+        threads = set()
+        def db_from_uri(uri, dbname, dbmap):
+            threads.add(threading.current_thread().name)
+            db = built[dbname] = DummyDB()
+            dbmap[dbname] = db
+            return db
+        databases = {}
+        uris = [('', 'uri'), ('foo', 'uri.foo'), ('bar', 'uri.bar')]
+        self._callFUT(iter(uris), databases, db_from_uri)
+        self.assertEqual(databases, built)
+        for db in databases.values():
+            self.assertTrue(db.databases is databases)
+            self.assertTrue(db.getActivityMonitor())
+        self.assertEqual(threads, set(['pyramid_zodbconn-open']))
+
+    def test_first_failure_wins(self):
+        import threading
+        built = []
+        release = threading.Event()
+        def db_from_uri(uri, dbname, dbmap):
+            if dbname == 'first':
+                # make sure the later failure happens first
+                release.wait(5)
+                raise KeyError(dbname)
+            if dbname == 'second':
+                release.set()
+                raise ValueError(dbname)
+            db = DummyDB()
+            built.append(db)
+            return db
+        databases = {}
+        uris = [('', 'uri'), ('first', 'uri.1'), ('second', 'uri.2')]
+        self.assertRaises(KeyError, self._callFUT, uris, databases,
+                          db_from_uri)
+        self.assertEqual(databases, {})
+        self.assertEqual(len(built), 1)
+        self.assertTrue(built[0].closed)
+
 class Test_includeme(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
@@ -219,6 +886,24 @@ class Test_includeme(unittest.TestCase):
         self.assertEqual(self.config.registry._transferlog.stream, None)
         self.assertEqual(opened, [('foo',  'a')])
 
+    def test_with_txlog_binary_format(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.transferlog'] = 'foo'
+        self.config.registry.settings['zodbconn.transferlog_format'] = 'binary'
+        opened = []
+        def fake_open(name, mode):
+            opened.append((name, mode))
+        self._callFUT(self.config, open=fake_open)
+        self.assertEqual(opened, [('foo',  'ab')])
+        self.assertEqual(self.config.registry._transferlog.format, 'binary')
+
+    def test_with_txlog_bad_format(self):
+        from pyramid.exceptions import ConfigurationError
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.transferlog'] = ''
+        self.config.registry.settings['zodbconn.transferlog_format'] = 'xml'
+        self.assertRaises(ConfigurationError, self._callFUT, self.config)
+
     def test_with_txlog_threshhold(self):
         import sys
         L = []
@@ -233,6 +918,455 @@ class Test_includeme(unittest.TestCase):
         self.assertEqual(self.config.registry._transferlog.stream, sys.stdout)
         self.assertEqual(self.config.registry._transferlog.threshhold, 1)
 
+    def test_with_txlog_sampling(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.transferlog'] = ''
+        self.config.registry.settings[
+            'zodbconn.transferlog_threshhold'] = '0.25'
+        self.config.registry.settings[
+            'zodbconn.transferlog_sample_rate'] = '0.01'
+        self.config.registry.settings['zodbconn.transferlog_max_rate'] = '50'
+        self._callFUT(self.config)
+        transferlog = self.config.registry._transferlog
+        self.assertEqual(transferlog.threshhold, 0.25)
+        self.assertEqual(transferlog.sample_rate, 0.01)
+        self.assertEqual(transferlog.max_rate, 50.0)
+
+    def test_with_txlog_buffered(self):
+        import sys
+        from pyramid_zodbconn import BufferedTransferLogWriter
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.transferlog'] = ''
+        self.config.registry.settings['zodbconn.transferlog_buffered'] = 'true'
+        self.config.registry.settings[
+            'zodbconn.transferlog_buffer_size'] = '50'
+        self.config.registry.settings[
+            'zodbconn.transferlog_flush_lines'] = '5'
+        self.config.registry.settings[
+            'zodbconn.transferlog_flush_interval'] = '0.5'
+        self.config.registry.settings[
+            'zodbconn.transferlog_overflow'] = 'block'
+        self._callFUT(self.config)
+        writer = self.config.registry._transferlog.stream
+        self.addCleanup(writer.close)
+        self.assertTrue(isinstance(writer, BufferedTransferLogWriter))
+        self.assertEqual(writer.stream, sys.stdout)
+        self.assertEqual(writer.maxlines, 50)
+        self.assertEqual(writer.flush_lines, 5)
+        self.assertEqual(writer.flush_interval, 0.5)
+        self.assertEqual(writer.overflow, 'block')
+
+    def test_with_stats(self):
+        from pyramid_zodbconn.stats import ConnectionStats
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.stats'] = 'true'
+        self._callFUT(self.config)
+        self.assertEqual(len(L), 3)
+        self.assertEqual(L[0][0].__name__, 'start')
+        self.assertEqual(L[1][0].__name__, 'end')
+        self.assertEqual(L[2][0].__name__, 'start_secondary')
+        collector = self.config.registry._zodb_stats_collector
+        self.assertEqual(collector.stats_factory, ConnectionStats)
+
+    def test_with_stats_factory(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.stats'] = 'true'
+        self.config.registry.settings['zodbconn.stats_factory'] = (
+            'pyramid_zodbconn.tests.test_init.DummyStats')
+        self._callFUT(self.config)
+        collector = self.config.registry._zodb_stats_collector
+        self.assertEqual(collector.stats_factory, DummyStats)
+
+    def test_with_lazy(self):
+        from pyramid_zodbconn import LazyDB
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.uri.foo'] = 'uri.foo'
+        self.config.registry.settings['zodbconn.lazy'] = 'true'
+        self._callFUT(self.config)
+        self.assertEqual(self.config.captured_uris, [])
+        databases = self.config.registry._zodb_databases
+        self.assertEqual(sorted(databases), ['', 'foo'])
+        for name, db in databases.items():
+            self.assertTrue(isinstance(db, LazyDB))
+            self.assertEqual(db.database_name, name)
+            self.assertTrue(db.databases is databases)
+        databases['foo'].load()
+        self.assertEqual(self.config.captured_uris, ['uri.foo'])
+        self.assertEqual(databases['foo'], self.db)
+
+    def test_with_open_threads(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.uri.foo'] = 'uri.foo'
+        self.config.registry.settings['zodbconn.uri.bar'] = 'uri.bar'
+        self.config.registry.settings['zodbconn.open_threads'] = '3'
+        self._callFUT(self.config)
+        self.assertEqual(sorted(self.config.captured_uris),
+                         ['uri', 'uri.bar', 'uri.foo'])
+        databases = self.config.registry._zodb_databases
+        self.assertEqual(sorted(databases), ['', 'bar', 'foo'])
+        self.assertTrue(self.db.databases is databases)
+
+    def test_with_hotoids(self):
+        from pyramid.events import ApplicationCreated
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.hotoids'] = 'hot.txt'
+        self.config.registry.settings['zodbconn.hotoids_size'] = '100'
+        self.config.registry.settings['zodbconn.hotoids_interval'] = '60'
+        self.config.registry.settings['zodbconn.hotoids_sample_rate'] = '0.1'
+        self._callFUT(self.config)
+        profiler = self.config.registry._zodb_hotoids
+        self.assertEqual(L, [
+            (profiler.start, ZODBConnectionOpened),
+            (profiler.end, ZODBConnectionWillClose),
+            (profiler.writer.start, ApplicationCreated),
+            ])
+        self.assertEqual(profiler.filename, 'hot.txt')
+        self.assertEqual(profiler.profile.size, 100)
+        self.assertEqual(profiler.interval, 60)
+        self.assertEqual(profiler.sample_rate, 0.1)
+
+    def test_with_load_trace(self):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.load_trace'] = 'trace.log'
+        self.config.registry.settings['zodbconn.load_trace_threshold'] = '2.5'
+        self.config.registry.settings[
+            'zodbconn.load_trace_sample_rate'] = '0.001'
+        self.config.registry.settings['zodbconn.load_trace_max_loads'] = '50'
+        opened = []
+        def fake_open(name, mode):
+            opened.append((name, mode))
+        self._callFUT(self.config, open=fake_open)
+        tracer = self.config.registry._zodb_load_tracer
+        self.assertEqual(L, [
+            (tracer.start, ZODBConnectionOpened),
+            (tracer.start_secondary, ZODBSecondaryConnectionOpened),
+            (tracer.end, ZODBConnectionWillClose),
+            ])
+        self.assertEqual(opened, [('trace.log', 'a')])
+        self.assertEqual(tracer.threshold, 2.5)
+        self.assertEqual(tracer.sample_rate, 0.001)
+        self.assertEqual(tracer.max_loads, 50)
+
+    def test_with_warmup(self):
+        from ZODB.utils import p64
+        from pyramid.events import ApplicationCreated
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.warmup'] = '0x01\n/app'
+        self.config.registry.settings['zodbconn.warmup_connections'] = '2'
+        self.config.registry.settings['zodbconn.warmup_background'] = 'true'
+        self._callFUT(self.config)
+        warmer = self.config.registry._zodb_warmer
+        self.assertEqual(L, [(warmer.start, ApplicationCreated)])
+        self.assertEqual(warmer.entries, [p64(1), ('app',)])
+        self.assertEqual(warmer.connections, 2)
+        self.assertTrue(warmer.background)
+
+    def test_with_invalid_warmup(self):
+        from pyramid.exceptions import ConfigurationError
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.warmup'] = '0x01 app'
+        self.assertRaises(ConfigurationError, self._callFUT, self.config)
+
+    def test_with_warmup_file(self):
+        import os
+        import tempfile
+        from ZODB.utils import p64
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, b'0x02\n')
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.warmup'] = '0x01'
+        self.config.registry.settings['zodbconn.warmup_file'] = filename
+        self._callFUT(self.config)
+        warmer = self.config.registry._zodb_warmer
+        self.assertEqual(warmer.entries, [p64(1), p64(2)])
+        self.assertEqual(warmer.connections, None)
+        self.assertFalse(warmer.background)
+
+    def test_with_missing_warmup_file(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.warmup_file'] = '/nonexistent'
+        self._callFUT(self.config)
+        self.assertFalse(hasattr(self.config.registry, '_zodb_warmer'))
+
+    def test_with_readonly(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.readonly_methods'] = 'GET HEAD'
+        self.config.registry.settings['zodbconn.readonly_predicate'] = (
+            'pyramid_zodbconn.tests.test_init.dummy_predicate')
+        self._callFUT(self.config)
+        policy = self.config.registry._zodb_readonly_policy
+        self.assertTrue(policy(testing.DummyRequest()))
+        self.assertTrue(policy(
+            testing.DummyRequest(post={}, params={'readonly': '1'})))
+        self.assertFalse(policy(testing.DummyRequest(post={})))
+
+    def test_without_readonly(self):
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_readonly_policy, None)
+
+    def test_with_memory_budget(self):
+        from pyramid.events import ApplicationCreated
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.memory_budget'] = '256MB'
+        self.config.registry.settings[
+            'zodbconn.memory_budget_interval'] = '5'
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self._callFUT(self.config)
+        governor = self.config.registry._zodb_governor
+        self.assertEqual(governor.budget, 256 * 1024 * 1024)
+        self.assertEqual(governor.interval, 5.0)
+        self.assertTrue(
+            governor.databases is self.config.registry._zodb_databases)
+        self.assertEqual(L, [(governor.start, ApplicationCreated)])
+
+    def test_with_invalid_memory_budget(self):
+        from pyramid.exceptions import ConfigurationError
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.memory_budget'] = 'lots'
+        self.assertRaises(ConfigurationError, self._callFUT, self.config)
+
+    def test_with_idle_trim(self):
+        from pyramid.events import ApplicationCreated
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.idle_trim'] = '120'
+        self.config.registry.settings['zodbconn.idle_trim_interval'] = '10'
+        self.config.registry.settings['zodbconn.idle_trim_batch'] = '3'
+        self.config.registry.settings['zodbconn.idle_keep'] = '2'
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self._callFUT(self.config)
+        trimmer = self.config.registry._zodb_trimmer
+        self.assertEqual(trimmer.idle_time, 120.0)
+        self.assertEqual(trimmer.interval, 10.0)
+        self.assertEqual(trimmer.batch, 3)
+        self.assertEqual(trimmer.keep, 2)
+        self.assertEqual(L, [(trimmer.start, ApplicationCreated)])
+
+    def test_with_idle_trim_defaults(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.idle_trim'] = '120'
+        self._callFUT(self.config)
+        trimmer = self.config.registry._zodb_trimmer
+        self.assertEqual(trimmer.interval, 60.0)
+        self.assertEqual(trimmer.batch, 10)
+        self.assertEqual(trimmer.keep, None)
+
+    def test_with_async_threads(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.async_threads'] = '4'
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_async_threads, 4)
+
+    def test_without_async_threads(self):
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_async_threads, None)
+
+    def test_with_route_stats(self):
+        from pyramid.events import ApplicationCreated
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.route_stats'] = 'true'
+        self.config.registry.settings['zodbconn.route_stats_file'] = 'r.json'
+        self.config.registry.settings['zodbconn.route_stats_interval'] = '10'
+        self.config.registry.settings[
+            'zodbconn.route_stats_max_endpoints'] = '5'
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self._callFUT(self.config)
+        stats = self.config.registry._zodb_route_stats
+        self.assertEqual(stats.filename, 'r.json')
+        self.assertEqual(stats.interval, 10.0)
+        self.assertEqual(stats.max_endpoints, 5)
+        self.assertEqual(L, [
+            (stats.start, ZODBConnectionOpened),
+            (stats.end, ZODBConnectionWillClose),
+            (stats.writer.start, ApplicationCreated),
+            ])
+
+    def test_with_route_stats_path(self):
+        from pyramid.interfaces import IRoutesMapper
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.route_stats'] = 'true'
+        self.config.registry.settings['zodbconn.route_stats_path'] = '/routes'
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self._callFUT(self.config)
+        self.config.commit()
+        self.assertEqual(len(L), 2)
+        mapper = self.config.registry.getUtility(IRoutesMapper)
+        route = mapper.get_route('zodbconn_route_stats')
+        self.assertEqual(route.pattern, '/routes')
+
+    def test_with_class_stats(self):
+        from pyramid.interfaces import IRoutesMapper
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.class_stats'] = 'true'
+        self.config.registry.settings[
+            'zodbconn.class_stats_max_classes'] = '50'
+        self.config.registry.settings[
+            'zodbconn.class_stats_sample_rate'] = '0.5'
+        self.config.registry.settings['zodbconn.class_stats_path'] = '/classes'
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self._callFUT(self.config)
+        self.config.commit()
+        stats = self.config.registry._zodb_class_stats
+        self.assertEqual(stats.max_classes, 50)
+        self.assertEqual(stats.sample_rate, 0.5)
+        self.assertEqual(L, [
+            (stats.start, ZODBConnectionOpened),
+            (stats.start_secondary, ZODBSecondaryConnectionOpened),
+            (stats.end, ZODBConnectionWillClose),
+            ])
+        mapper = self.config.registry.getUtility(IRoutesMapper)
+        route = mapper.get_route('zodbconn_class_stats')
+        self.assertEqual(route.pattern, '/classes')
+
+    def test_with_pool_limit(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.pool_limit'] = '10'
+        self.config.registry.settings['zodbconn.pool_timeout'] = '2.5'
+        self._callFUT(self.config)
+        limiter = self.config.registry._zodb_limiter
+        self.assertEqual(limiter.size, 10)
+        self.assertEqual(limiter.timeout, 2.5)
+
+    def test_with_pool_limit_no_timeout(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.pool_limit'] = '10'
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_limiter.timeout, None)
+
+    def test_without_pool_limit(self):
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_limiter, None)
+
+    def test_with_readahead(self):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.readahead'] = 'true'
+        self.config.registry.settings['zodbconn.readahead_trigger'] = '5'
+        self.config.registry.settings['zodbconn.readahead_max_oids'] = '20'
+        self.config.registry.settings['zodbconn.readahead_min_support'] = '0.8'
+        self.config.registry.settings['zodbconn.readahead_max_routes'] = '10'
+        self._callFUT(self.config)
+        readahead = self.config.registry._zodb_readahead
+        self.assertEqual(readahead.trigger, 5)
+        self.assertEqual(readahead.max_oids, 20)
+        self.assertEqual(readahead.min_support, 0.8)
+        self.assertEqual(readahead.max_routes, 10)
+        self.assertTrue(readahead.registry is self.config.registry)
+        self.assertEqual(L, [
+            (readahead.start, ZODBConnectionOpened),
+            (readahead.end, ZODBConnectionWillClose),
+            ])
+
+    def test_with_background_cleanup(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.background_cleanup'] = 'true'
+        self.config.registry.settings['zodbconn.cleanup_threads'] = '2'
+        self.config.registry.settings['zodbconn.cleanup_max_pending'] = '50'
+        self._callFUT(self.config)
+        cleanup = self.config.registry._zodb_cleanup
+        self.assertEqual(cleanup.threads, 2)
+        self.assertEqual(cleanup.max_pending, 50)
+
+    def test_with_subrequest_reuse(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.subrequest_reuse'] = 'true'
+        self._callFUT(self.config)
+        self.assertTrue(self.config.registry._zodb_subrequest_reuse)
+
+    def test_without_subrequest_reuse(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self._callFUT(self.config)
+        self.assertFalse(self.config.registry._zodb_subrequest_reuse)
+
+    def test_without_background_cleanup(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_cleanup, None)
+
+    def test_without_readahead(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_readahead, None)
+
+    def test_with_metrics_path(self):
+        from pyramid.interfaces import IRoutesMapper
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.metrics_path'] = '/metrics'
+        self._callFUT(self.config)
+        self.config.commit()
+        mapper = self.config.registry.getUtility(IRoutesMapper)
+        route = mapper.get_route('zodbconn_metrics')
+        self.assertEqual(route.pattern, '/metrics')
+
+    def test_with_shared_cache_size(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.shared_cache_size'] = '10MB'
+        def db_from_uri(uri, dbname, dbmap):
+            db = DB(MappingStorage(), databases=dbmap)
+            self.addCleanup(db.close)
+            return db
+        self._callFUT(self.config, db_from_uri=db_from_uri)
+        caches = self.config.registry._zodb_shared_caches
+        self.assertEqual(list(caches), [''])
+        self.assertEqual(caches[''].max_bytes, 10 * 1024 * 1024)
+
+    def test_with_invalid_shared_cache_size(self):
+        from pyramid.exceptions import ConfigurationError
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.shared_cache_size'] = 'big'
+        self.assertRaises(ConfigurationError, self._callFUT, self.config)
+
+    def test_without_shared_cache_size(self):
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self._callFUT(self.config)
+        self.assertEqual(self.config.registry._zodb_shared_caches, {})
+
+    def test_with_statsd(self):
+        from pyramid.events import ApplicationCreated
+        L = []
+        self.config.add_subscriber = lambda func, event: L.append((func, event))
+        self.config.registry.settings['zodbconn.uri'] = 'uri'
+        self.config.registry.settings['zodbconn.statsd'] = 'localhost:9125'
+        self.config.registry.settings['zodbconn.statsd_prefix'] = 'app'
+        self.config.registry.settings['zodbconn.metrics_interval'] = '10'
+        self._callFUT(self.config)
+        pusher = self.config.registry._zodb_statsd
+        self.assertEqual(L, [(pusher.start, ApplicationCreated)])
+        self.assertEqual(pusher.address, ('localhost', 9125))
+        self.assertEqual(pusher.prefix, 'app')
+        self.assertEqual(pusher.interval, 10)
+        self.assertTrue(
+            pusher.databases is self.config.registry._zodb_databases)
+
 class TestIntegration(unittest.TestCase):
     def setUp(self):
         self.config = testing.setUp()
@@ -242,6 +1376,294 @@ class TestIntegration(unittest.TestCase):
     def tearDown(self):
         testing.tearDown()
 
+    def test_stats(self):
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={'zodbconn.uri': 'memory://',
+                                              'zodbconn.stats': 'true'})
+        self.config.include('pyramid_zodbconn')
+        seen = []
+        def view(request):
+            get_connection(request).get(b'\0' * 8).keys()
+            seen.append(request.zodb_stats)
+            return 'bar'
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo')
+        self.assertEqual(seen[0].dbname, '')
+        self.assertTrue(seen[0].cache_hits >= 1)
+
+    def test_lazy_multidb(self):
+        from pyramid_zodbconn import LazyDB
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.uri.foo': 'memory://',
+            'zodbconn.uri.bar': 'memory://',
+            'zodbconn.lazy': 'true',
+            })
+        self.config.include('pyramid_zodbconn')
+        def view(request):
+            get_connection(request, 'foo').root()
+            return 'bar'
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo')
+        app.get('/foo')
+        databases = self.config.registry._zodb_databases
+        self.assertFalse(isinstance(databases[''], LazyDB))
+        self.assertFalse(isinstance(databases['foo'], LazyDB))
+        self.assertTrue(isinstance(databases['bar'], LazyDB))
+        self.assertTrue(databases['foo'].databases is databases)
+
+    def _subrequest_app(self, settings):
+        from pyramid.request import Request
+        from pyramid_zodbconn import get_connection
+        settings['zodbconn.uri'] = 'memory://'
+        self.config = testing.setUp(settings=settings)
+        self.config.include('pyramid_zodbconn')
+        hook = DummyLifecycleHook()
+        self.config.add_zodbconn_lifecycle_hook(hook)
+        seen = []
+        def parent_view(request):
+            conn = get_connection(request)
+            conn.root()['a'] = 1
+            response = request.invoke_subrequest(Request.blank('/child'))
+            seen.append((conn, conn.opened is not None))
+            return response.text
+        def child_view(request):
+            conn = get_connection(request)
+            seen.append(conn)
+            return str(conn.root().get('a'))
+        self.config.add_route('parent', '/parent')
+        self.config.add_view(parent_view, route_name='parent',
+                             renderer='string')
+        self.config.add_route('child', '/child')
+        self.config.add_view(child_view, route_name='child',
+                             renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        return app, hook, seen
+
+    def test_subrequest_reuse(self):
+        app, hook, seen = self._subrequest_app(
+            {'zodbconn.subrequest_reuse': 'true'})
+        response = app.get('/parent')
+        self.assertEqual(response.text, '1')
+        child_conn, (parent_conn, open_after_child) = seen
+        self.assertTrue(child_conn is parent_conn)
+        self.assertTrue(open_after_child)
+        self.assertEqual([call[0] for call in hook.calls],
+                         ['opened', 'will_close', 'closed'])
+
+    def test_nested_subrequest_reuse(self):
+        from pyramid.request import Request
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.subrequest_reuse': 'true',
+            })
+        self.config.include('pyramid_zodbconn')
+        hook = DummyLifecycleHook()
+        self.config.add_zodbconn_lifecycle_hook(hook)
+        seen = []
+        def outer_view(request):
+            response = request.invoke_subrequest(Request.blank('/middle'))
+            conn = get_connection(request)
+            seen.append(('outer', conn, conn.opened is not None))
+            return response.text
+        def middle_view(request):
+            response = request.invoke_subrequest(Request.blank('/inner'))
+            conn = get_connection(request)
+            seen.append(('middle', conn, conn.opened is not None))
+            return response.text
+        def inner_view(request):
+            conn = get_connection(request)
+            conn.root()['a'] = 1
+            seen.append(('inner', conn, True))
+            return str(conn.root().get('a'))
+        for name, view in (('outer', outer_view), ('middle', middle_view),
+                           ('inner', inner_view)):
+            self.config.add_route(name, '/' + name)
+            self.config.add_view(view, route_name=name, renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        response = app.get('/outer')
+        self.assertEqual(response.text, '1')
+        self.assertEqual([name for name, conn, opened in seen],
+                         ['inner', 'middle', 'outer'])
+        conns = set(conn for name, conn, opened in seen)
+        self.assertEqual(len(conns), 1)
+        # still open after the sub-requests were finished
+        self.assertTrue(all(opened for name, conn, opened in seen))
+        self.assertEqual([call[0] for call in hook.calls],
+                         ['opened', 'will_close', 'closed'])
+
+    def test_subrequest_without_reuse(self):
+        app, hook, seen = self._subrequest_app({})
+        response = app.get('/parent')
+        self.assertEqual(response.text, 'None')
+        child_conn, (parent_conn, open_after_child) = seen
+        self.assertFalse(child_conn is parent_conn)
+        # the sub-request's connection is closed when it is finished
+        self.assertEqual([call[0] for call in hook.calls],
+                         ['opened', 'opened', 'will_close', 'closed',
+                          'will_close', 'closed'])
+
+    def test_lifecycle_hook(self):
+        from pyramid_zodbconn import get_connection
+        hook = DummyLifecycleHook()
+        self.config.add_zodbconn_lifecycle_hook(hook)
+        def view(request):
+            get_connection(request).root()
+            return 'bar'
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo')
+        self.assertEqual([call[0] for call in hook.calls],
+                         ['opened', 'will_close', 'closed'])
+        notifier = self.config.registry._zodb_notifier
+        self.assertEqual(notifier.subscribed, frozenset())
+
+    def test_route_stats(self):
+        import json
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.route_stats': 'true',
+            'zodbconn.route_stats_path': '/_routes',
+            })
+        self.config.include('pyramid_zodbconn')
+        def view(request):
+            get_connection(request).root()
+            return 'bar'
+        self.config.add_route('foo', '/foo/{id}')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo/1')
+        app.get('/foo/2')
+        report = json.loads(app.get('/_routes').text)
+        self.assertEqual(report['foo']['requests'], 2)
+
+    def test_parallel_multidb(self):
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.uri.foo': 'memory://',
+            'zodbconn.uri.bar': 'memory://',
+            'zodbconn.open_threads': '3',
+            })
+        self.config.include('pyramid_zodbconn')
+        seen = []
+        def view(request):
+            seen.append(get_connection(request, 'foo').db().database_name)
+            seen.append(get_connection(request, 'bar').db().database_name)
+            return 'bar'
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo')
+        self.assertEqual(seen, ['foo', 'bar'])
+
+    def test_multidb_stats_and_transferlog(self):
+        import io
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.uri.foo': 'memory://',
+            'zodbconn.uri.bar': 'memory://',
+            'zodbconn.stats': 'true',
+            'zodbconn.transferlog': 'txlog',
+            })
+        stream = io.StringIO()
+        from pyramid_zodbconn import includeme
+        includeme(self.config, open=lambda name, mode: stream)
+        seen = []
+        def view(request):
+            get_connection(request, 'foo').root()['x'] = 1
+            seen.append(request.zodb_database_stats)
+            return 'bar'
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo')
+        self.assertEqual(sorted(seen[0]), ['', 'foo'])
+        self.assertTrue(seen[0]['foo'].cache_hits >= 1)
+        self.assertTrue(', "foo", 0, ' in stream.getvalue())
+
+    def test_readonly_methods(self):
+        from ZODB.POSException import ReadOnlyError
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.uri.foo': 'memory://',
+            'zodbconn.readonly_methods': 'GET',
+            })
+        self.config.include('pyramid_zodbconn')
+        self.config.include('pyramid_tm')
+        seen = []
+        def view(request):
+            root = get_connection(request).root()
+            seen.append(root.get('x'))
+            if request.method == 'POST':
+                root['x'] = request.params['x']
+            elif 'x' in request.params:
+                self.assertRaises(ReadOnlyError, root.__setitem__, 'x', 1)
+                foo = get_connection(request, 'foo').root()
+                self.assertRaises(ReadOnlyError, foo.__setitem__, 'x', 1)
+            return 'bar'
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        app.get('/foo', {'x': 'try'})
+        app.post('/foo', {'x': '1'})
+        app.get('/foo')
+        app.post('/foo', {'x': '2'})
+        app.get('/foo')
+        self.assertEqual(seen, [None, None, '1', '1', '2'])
+        db = self.config.registry._zodb_databases['']
+        self.assertEqual(len(db.pool.all), 1)
+
+    def test_readonly_cross_database_reference(self):
+        import transaction
+        from persistent.mapping import PersistentMapping
+        from pyramid_zodbconn import get_connection
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.uri.foo': 'memory://',
+            'zodbconn.readonly_methods': 'GET',
+            })
+        self.config.include('pyramid_zodbconn')
+        databases = self.config.registry._zodb_databases
+        tm = transaction.TransactionManager()
+        writer = databases[''].open(tm)
+        obj = PersistentMapping(v=1)
+        writer.get_connection('foo').add(obj)
+        writer.root()['ref'] = obj
+        tm.commit()
+        def view(request):
+            # the secondary connection is opened by ZODB, not get_connection
+            return str(get_connection(request).root()['ref']['v'])
+        self.config.add_route('foo', '/foo')
+        self.config.add_view(view, route_name='foo', renderer='string')
+        app = TestApp(self.config.make_wsgi_app())
+        self.assertEqual(app.get('/foo').text, '1')
+        obj['v'] = 2
+        tm.commit()
+        writer.close()
+        # from the pool, along with its secondary connection
+        self.assertEqual(app.get('/foo').text, '2')
+
+    def test_metrics_view(self):
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.metrics_path': '/metrics',
+            })
+        self.config.include('pyramid_zodbconn')
+        app = TestApp(self.config.make_wsgi_app())
+        result = app.get('/metrics')
+        self.assertTrue(b'zodb_pool_size{database="primary"} 7' in result.body)
+
     def test_it(self):
         from pyramid_zodbconn import get_connection
         self.config.add_settings({'tm.manager_hook': 'pyramid_tm.explicit_manager'})
@@ -270,12 +1692,25 @@ class DummyDB:
         self.am = am
     def getActivityMonitor(self):
         return getattr(self, 'am', None)
+    def close(self):
+        self.closed = True
 
 class DummyTransactionManager:
     aborted = False
     def abort(self):
         self.aborted = True
 
+class DummyThreadTransactionManager(transaction.ThreadTransactionManager):
+    aborted = False
+    def abort(self):
+        self.aborted = True
+
+class DummyCleanupExecutor(object):
+    def __init__(self):
+        self.submitted = []
+    def submit(self, request, func):
+        self.submitted.append((request, func))
+
 class DummyConnection:
     closed = False
 
@@ -298,6 +1733,31 @@ class DummyZODBEvent(object):
         self.conn = DummyConnection()
         self.request = testing.DummyRequest()
 
+class DummyRegistry(object):
+    adapters = None
+
+class DummyLifecycleHook(object):
+    def __init__(self):
+        self.calls = []
+
+    def opened(self, conn, request):
+        self.calls.append(('opened', conn, request))
+
+    def secondary_opened(self, conn, request, dbname):
+        self.calls.append(('secondary_opened', conn, request, dbname))
+
+    def will_close(self, conn, request):
+        self.calls.append(('will_close', conn, request))
+
+    def closed(self, conn, request):
+        self.calls.append(('closed', conn, request))
+
+class DummyStats(object):
+    pass
+
+def dummy_predicate(request):
+    return request.params.get('readonly')
+
 class FakeTimeModule(object):
     def __init__(self, when=0):
         self.when = when
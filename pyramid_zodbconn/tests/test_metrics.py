@@ -0,0 +1,256 @@
+import unittest
+from pyramid import testing
+
+class MetricsTestBase(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.ActivityMonitor import ActivityMonitor
+        from ZODB.MappingStorage import MappingStorage
+        import transaction
+        self.databases = {}
+        self.db = DB(MappingStorage(), databases=self.databases,
+                     database_name='', pool_size=3)
+        self.db.setActivityMonitor(ActivityMonitor())
+        self.tm = transaction.TransactionManager()
+        conn = self.db.open(self.tm)
+        conn.root()['a'] = 1
+        self.tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+class Test_collect(MetricsTestBase):
+    def _callFUT(self, databases, interval=60, limiter=None,
+                 shared_caches=None, readahead=None, cleanup=None):
+        from pyramid_zodbconn.metrics import collect
+        return collect(databases, interval, limiter=limiter,
+                       shared_caches=shared_caches, readahead=readahead,
+                       cleanup=cleanup)
+
+    def test_it(self):
+        conn = self.db.open(self.tm)
+        try:
+            result = self._callFUT(self.databases)
+        finally:
+            conn.close()
+        self.assertEqual(len(result), 1)
+        label, metrics = result[0]
+        self.assertEqual(label, 'primary')
+        self.assertTrue(metrics['stores'] > 0)
+        self.assertEqual(metrics['connection_closes'], 1)
+        self.assertEqual(metrics['pool_size'], 3)
+        self.assertEqual(metrics['connections'], 1)
+        self.assertEqual(metrics['connections_open'], 1)
+        self.assertEqual(metrics['cache_size'], 400)
+        self.assertTrue(metrics['cache_objects'] >= 1)
+
+    def test_without_activity_monitor(self):
+        self.db.setActivityMonitor(None)
+        label, metrics = self._callFUT(self.databases)[0]
+        self.assertEqual(metrics['stores'], 0)
+        self.assertEqual(metrics['connections_open'], 0)
+
+    def test_sorted_by_label(self):
+        databases = {'': DummyDB(), 'b': DummyDB(), 'a': DummyDB()}
+        result = self._callFUT(databases)
+        self.assertEqual([label for label, metrics in result],
+                         ['a', 'b', 'primary'])
+
+    def test_with_limiter(self):
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        limiter = ConnectionLimiter(5)
+        limiter.acquire()
+        result = self._callFUT({'': DummyDB(), 'a': DummyDB()}, limiter=limiter)
+        self.assertFalse('pool_limit' in result[0][1])
+        metrics = result[1][1]
+        self.assertEqual(metrics['pool_limit'], 5)
+        self.assertEqual(metrics['pool_in_use'], 1)
+        self.assertEqual(metrics['pool_wait_seconds'], 0.0)
+
+    def test_with_shared_caches(self):
+        from pyramid_zodbconn.sharedcache import SharedStateCache
+        caches = {'a': SharedStateCache(1000)}
+        result = self._callFUT({'': DummyDB(), 'a': DummyDB()},
+                               shared_caches=caches)
+        self.assertEqual(result[0][1]['shared_cache_bytes'], 0)
+        self.assertFalse('shared_cache_bytes' in result[1][1])
+
+    def test_with_readahead(self):
+        from pyramid_zodbconn.readahead import ReadAhead
+        readahead = ReadAhead(None)
+        readahead.predicted = 10
+        readahead.used = 7
+        result = self._callFUT({'': DummyDB(), 'a': DummyDB()},
+                               readahead=readahead)
+        self.assertFalse('readahead_used' in result[0][1])
+        metrics = result[1][1]
+        self.assertEqual(metrics['readahead_requests'], 0)
+        self.assertEqual(metrics['readahead_predicted'], 10)
+        self.assertEqual(metrics['readahead_used'], 7)
+
+    def test_with_cleanup(self):
+        from pyramid_zodbconn.cleanup import CleanupExecutor
+        cleanup = CleanupExecutor()
+        cleanup.seconds = 1.5
+        result = self._callFUT({'': DummyDB(), 'a': DummyDB()},
+                               cleanup=cleanup)
+        self.assertFalse('cleanup_seconds' in result[0][1])
+        metrics = result[1][1]
+        self.assertEqual(metrics['cleanup_pending'], 0)
+        self.assertEqual(metrics['cleanup_seconds'], 1.5)
+
+    def test_skips_unloaded_lazy_databases(self):
+        lazy = DummyDB()
+        lazy.loaded = False
+        result = self._callFUT({'': DummyDB(), 'lazy': lazy})
+        self.assertEqual([label for label, metrics in result], ['primary'])
+
+class Test_render_prometheus(unittest.TestCase):
+    def _callFUT(self, collected):
+        from pyramid_zodbconn.metrics import render_prometheus
+        return render_prometheus(collected)
+
+    def test_it(self):
+        from pyramid_zodbconn.metrics import METRICS
+        metrics = dict((name, 1) for name, kind, help in METRICS)
+        result = self._callFUT([('primary', metrics), ('a"b', metrics)])
+        lines = result.splitlines()
+        self.assertEqual(lines[0], '# HELP zodb_loads Objects loaded from '
+                         'storage during the last interval.')
+        self.assertEqual(lines[1], '# TYPE zodb_loads gauge')
+        self.assertEqual(lines[2], 'zodb_loads{database="primary"} 1')
+        self.assertEqual(lines[3], 'zodb_loads{database="a\\"b"} 1')
+        self.assertEqual(len(lines), len(METRICS) * 4)
+        self.assertTrue(result.endswith('\n'))
+
+    def test_partial_metrics(self):
+        primary = {'pool_waiting': 2}
+        result = self._callFUT([('a', {}), ('primary', primary)])
+        self.assertEqual(result.splitlines(), [
+            '# HELP zodb_pool_waiting Requests currently waiting for a '
+            'connection.',
+            '# TYPE zodb_pool_waiting gauge',
+            'zodb_pool_waiting{database="primary"} 2',
+            ])
+
+    def test_counter(self):
+        primary = {'pool_wait_seconds': 1.5}
+        result = self._callFUT([('primary', primary)])
+        self.assertEqual(result.splitlines(), [
+            '# HELP zodb_pool_wait_seconds_total Total seconds requests '
+            'waited for a connection.',
+            '# TYPE zodb_pool_wait_seconds_total counter',
+            'zodb_pool_wait_seconds_total{database="primary"} 1.500000',
+            ])
+
+class Test_render_statsd(unittest.TestCase):
+    def test_it(self):
+        from pyramid_zodbconn.metrics import METRICS
+        from pyramid_zodbconn.metrics import render_statsd
+        metrics = dict((name, 2) for name, kind, help in METRICS)
+        result = render_statsd([('primary', metrics)], prefix='app')
+        self.assertEqual(len(result), 1)
+        lines = result[0].split('\n')
+        self.assertEqual(lines[0], 'app.primary.loads:2|g')
+        self.assertEqual(len(lines), len(METRICS))
+
+    def test_partial_metrics(self):
+        from pyramid_zodbconn.metrics import render_statsd
+        result = render_statsd([('primary', {'loads': 1, 'pool_waits': 2})])
+        self.assertEqual(result, ['zodb.primary.loads:1|g\n'
+                                  'zodb.primary.pool_waits:2|g'])
+
+class Test_metrics_view(MetricsTestBase):
+    def setUp(self):
+        MetricsTestBase.setUp(self)
+        testing.setUp(settings={})
+
+    def tearDown(self):
+        testing.tearDown()
+        MetricsTestBase.tearDown(self)
+
+    def test_it(self):
+        from pyramid_zodbconn.metrics import metrics_view
+        request = testing.DummyRequest()
+        request.registry._zodb_databases = self.databases
+        response = metrics_view(request)
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.assertTrue(b'zodb_pool_size{database="primary"} 3'
+                        in response.body)
+
+class TestStatsdPusher(MetricsTestBase):
+    def _makeOne(self, **kw):
+        from pyramid_zodbconn.metrics import StatsdPusher
+        return StatsdPusher(self.databases, ('localhost', 8125),
+                            socket=DummySocketModule(), **kw)
+
+    def test_push(self):
+        inst = self._makeOne()
+        inst.push()
+        self.assertEqual(len(inst.sock.sent), 1)
+        packet, address = inst.sock.sent[0]
+        self.assertEqual(address, ('localhost', 8125))
+        self.assertTrue(b'zodb.primary.pool_size:3|g' in packet)
+
+    def test_push_with_limiter(self):
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        inst = self._makeOne(limiter=ConnectionLimiter(4))
+        inst.push()
+        packet, address = inst.sock.sent[0]
+        self.assertTrue(b'zodb.primary.pool_limit:4|g' in packet)
+
+    def test_push_socket_error(self):
+        inst = self._makeOne()
+        inst.sock.error = True
+        inst.push()
+        self.assertEqual(inst.sock.sent, [])
+
+    def test_start_stop(self):
+        inst = self._makeOne(interval=0.01)
+        inst.start(None)
+        thread = inst._thread
+        inst.start(None)
+        self.assertTrue(inst._thread is thread)
+        inst.stop()
+        self.assertEqual(inst._thread, None)
+        self.assertFalse(thread.is_alive())
+
+class Test_parse_address(unittest.TestCase):
+    def _callFUT(self, value):
+        from pyramid_zodbconn.metrics import parse_address
+        return parse_address(value)
+
+    def test_host_and_port(self):
+        self.assertEqual(self._callFUT('127.0.0.1:9125'), ('127.0.0.1', 9125))
+
+    def test_host_only(self):
+        self.assertEqual(self._callFUT(' localhost '), ('localhost', 8125))
+
+class DummyDB(object):
+    def getActivityMonitor(self):
+        return None
+    def cacheDetailSize(self):
+        return []
+    def connectionDebugInfo(self):
+        return []
+    def getPoolSize(self):
+        return 7
+    def getCacheSize(self):
+        return 10000
+
+class DummySocket(object):
+    error = False
+    def __init__(self):
+        self.sent = []
+    def sendto(self, data, address):
+        import socket
+        if self.error:
+            raise socket.error('refused')
+        self.sent.append((data, address))
+
+class DummySocketModule(object):
+    AF_INET = SOCK_DGRAM = None
+    def socket(self, family, type):
+        return DummySocket()
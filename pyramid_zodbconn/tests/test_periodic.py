@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+class TestPeriodicThread(unittest.TestCase):
+    def _makeOne(self, func, interval=0.001, final=False):
+        from pyramid_zodbconn.periodic import PeriodicThread
+        inst = PeriodicThread('pyramid_zodbconn-test', func, interval, final)
+        self.addCleanup(inst.stop)
+        return inst
+
+    def test_calls_func_periodically(self):
+        called = threading.Event()
+        L = []
+        def func():
+            L.append(threading.current_thread())
+            if len(L) == 3:
+                called.set()
+        inst = self._makeOne(func)
+        self.assertTrue(inst.start())
+        self.assertTrue(called.wait(5))
+        thread = inst._thread
+        self.assertTrue(inst.stop())
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(thread.name, 'pyramid_zodbconn-test')
+        self.assertTrue(thread.daemon)
+        self.assertEqual(set(L), set([thread]))
+
+    def test_start_twice(self):
+        inst = self._makeOne(lambda: None, interval=60)
+        self.assertTrue(inst.start())
+        thread = inst._thread
+        self.assertFalse(inst.start())
+        self.assertTrue(inst._thread is thread)
+
+    def test_stop_not_started(self):
+        inst = self._makeOne(lambda: None)
+        self.assertFalse(inst.stop())
+        self.assertEqual(inst._thread, None)
+
+    def test_restart(self):
+        called = threading.Event()
+        inst = self._makeOne(called.set)
+        inst.start()
+        inst.stop()
+        called.clear()
+        self.assertTrue(inst.start())
+        self.assertTrue(called.wait(5))
+
+    def test_start_as_subscriber(self):
+        inst = self._makeOne(lambda: None, interval=60)
+        self.assertTrue(inst.start(object()))
+        self.assertTrue(inst._thread.is_alive())
+
+    def test_final(self):
+        L = []
+        inst = self._makeOne(lambda: L.append(1), interval=60, final=True)
+        inst.start()
+        self.assertEqual(L, [])
+        self.assertTrue(inst.stop())
+        self.assertEqual(L, [1])
+        self.assertFalse(inst.stop())
+        self.assertEqual(L, [1])
@@ -0,0 +1,76 @@
+import threading
+import unittest
+
+class TestConnectionLimiter(unittest.TestCase):
+    def _makeOne(self, size, timeout=None):
+        from pyramid_zodbconn.pool import ConnectionLimiter
+        return ConnectionLimiter(size, timeout=timeout, time=FakeTimeModule())
+
+    def test_acquire_release(self):
+        inst = self._makeOne(2)
+        inst.acquire()
+        inst.acquire()
+        self.assertEqual(inst.in_use, 2)
+        inst.release()
+        inst.release()
+        self.assertEqual(inst.in_use, 0)
+        self.assertEqual(inst.waits, 0)
+
+    def test_timeout(self):
+        from pyramid_zodbconn.pool import PoolTimeoutError
+        inst = self._makeOne(1, timeout=0)
+        inst.acquire()
+        self.assertRaises(PoolTimeoutError, inst.acquire)
+        self.assertEqual(inst.rejections, 1)
+        self.assertEqual(inst.waits, 1)
+        self.assertEqual(inst.wait_time, 0.5)
+        self.assertEqual(inst.in_use, 1)
+        self.assertEqual(len(inst._waiters), 0)
+
+    def test_timeout_is_service_unavailable(self):
+        from pyramid.httpexceptions import HTTPServiceUnavailable
+        from pyramid_zodbconn.pool import PoolTimeoutError
+        self.assertTrue(issubclass(PoolTimeoutError, HTTPServiceUnavailable))
+
+    def test_handover_is_fifo(self):
+        inst = self._makeOne(1)
+        inst.acquire()
+        order = []
+        def wait(name):
+            inst.acquire()
+            order.append(name)
+            inst.release()
+        threads = []
+        for name in ('first', 'second'):
+            thread = threading.Thread(target=wait, args=(name,))
+            thread.start()
+            threads.append(thread)
+            while len(inst._waiters) < len(threads):
+                threading.Event().wait(0.001)
+        inst.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['first', 'second'])
+        self.assertEqual(inst.in_use, 0)
+        self.assertEqual(inst.waits, 2)
+        self.assertEqual(inst.rejections, 0)
+
+    def test_stats(self):
+        inst = self._makeOne(3)
+        inst.acquire()
+        self.assertEqual(inst.stats(), dict(
+            pool_limit=3,
+            pool_in_use=1,
+            pool_waiting=0,
+            pool_waits=0,
+            pool_wait_seconds=0.0,
+            pool_rejections=0,
+            ))
+
+class FakeTimeModule(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        self.now += 0.5
+        return self.now
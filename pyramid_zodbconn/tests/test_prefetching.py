@@ -0,0 +1,256 @@
+import threading
+import unittest
+from pyramid import testing
+
+from pyramid_zodbconn.stats import Recorder
+
+class PrefetchTestBase(unittest.TestCase):
+    def setUp(self):
+        import transaction
+        from persistent.mapping import PersistentMapping
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.prefetch_threads': '2',
+            })
+        self.config.include('pyramid_zodbconn')
+        self.db = self.config.registry._zodb_databases['']
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        root = conn.root()
+        for i in range(5):
+            root[i] = PersistentMapping({'i': i})
+        tm.commit()
+        self.oids = [root[i]._p_oid for i in range(5)]
+        conn.close()
+
+    def tearDown(self):
+        pool = getattr(self.config.registry, '_zodb_prefetch_pool', None)
+        if pool is not None:
+            pool.terminate()
+        self.db.close()
+        testing.tearDown()
+
+    def _makeRequest(self):
+        import transaction
+        request = testing.DummyRequest()
+        request.tm = transaction.TransactionManager()
+        return request
+
+    def _open(self, request):
+        from pyramid_zodbconn import get_connection
+        conn = get_connection(request)
+        conn.cacheMinimize()
+        return conn
+
+class Test_prefetch(PrefetchTestBase):
+    def _callFUT(self, request, objects_or_oids, dbname=None):
+        from pyramid_zodbconn import prefetch
+        return prefetch(request, objects_or_oids, dbname)
+
+    def test_oids_with_thread_pool(self):
+        request = self._makeRequest()
+        conn = self._open(request)
+        loads_before = conn.getTransferCounts()[0]
+        result = self._callFUT(request, self.oids)
+        self.assertEqual([obj['i'] for obj in result], list(range(5)))
+        self.assertTrue(all(obj._p_changed is False for obj in result))
+        self.assertEqual(conn.getTransferCounts()[0] - loads_before, 5)
+        pool = self.config.registry._zodb_prefetch_pool
+        self.assertEqual(len(pool._pool), 2)
+        request.finished_callbacks[0](request)
+
+    def test_ghosts_with_thread_pool(self):
+        from pyramid_zodbconn.prefetching import fetch
+        request = self._makeRequest()
+        conn = self._open(request)
+        root = conn.root()
+        ghosts = [root[i] for i in range(5)]
+        self.assertTrue(all(obj._p_changed is None for obj in ghosts))
+        fetched = []
+        def recording_fetch(pool, conn, oids):
+            fetched.extend(oids)
+            return fetch(pool, conn, oids)
+        import pyramid_zodbconn.prefetching as module
+        module.fetch = recording_fetch
+        try:
+            result = self._callFUT(request, ghosts)
+        finally:
+            module.fetch = fetch
+        self.assertEqual(result, ghosts)
+        self.assertEqual(fetched, self.oids)
+        self.assertTrue(all(obj._p_changed is False for obj in result))
+        self.assertTrue(conn._storage is conn._normal_storage)
+        request.finished_callbacks[0](request)
+
+    def test_skips_loaded_objects(self):
+        request = self._makeRequest()
+        conn = self._open(request)
+        root = conn.root()
+        loaded = root[0]
+        loaded._p_activate()
+        storage = DummyPrefetchingStorage()
+        self.db.storage.prefetch = storage.prefetch
+        result = self._callFUT(request, [loaded, self.oids[0], root[1],
+                                         self.oids[2]])
+        self.assertEqual(storage.prefetched, [[self.oids[1], self.oids[2]]])
+        self.assertEqual(result[0], loaded)
+        self.assertTrue(result[1] is loaded)
+        self.assertEqual(result[3]['i'], 2)
+        request.finished_callbacks[0](request)
+
+    def test_storage_prefetch(self):
+        request = self._makeRequest()
+        self._open(request)
+        storage = DummyPrefetchingStorage()
+        self.db.storage.prefetch = storage.prefetch
+        result = self._callFUT(request, self.oids)
+        self.assertEqual(storage.prefetched, [self.oids])
+        self.assertEqual([obj['i'] for obj in result], list(range(5)))
+        self.assertEqual(
+            getattr(self.config.registry, '_zodb_prefetch_pool', None), None)
+        request.finished_callbacks[0](request)
+
+    def test_single_object_not_batched(self):
+        request = self._makeRequest()
+        self._open(request)
+        result = self._callFUT(request, self.oids[:1])
+        self.assertEqual(result[0]['i'], 0)
+        self.assertEqual(
+            getattr(self.config.registry, '_zodb_prefetch_pool', None), None)
+        request.finished_callbacks[0](request)
+
+    def test_unloadable_object_left_as_ghost(self):
+        from ZODB.POSException import POSKeyError
+        request = self._makeRequest()
+        conn = self._open(request)
+        root = conn.root()
+        ghosts = [root[0], root[1]]
+        storage = conn._storage
+        load = storage.load
+        def failing_load(oid):
+            if oid == self.oids[1]:
+                raise POSKeyError(oid)
+            return load(oid)
+        storage.load = failing_load
+        result = self._callFUT(request, ghosts)
+        self.assertEqual(result[0]._p_changed, False)
+        self.assertEqual(result[1]._p_changed, None)
+        del storage.load
+        request.finished_callbacks[0](request)
+
+    def test_savepoint_not_loaded_by_pool(self):
+        request = self._makeRequest()
+        conn = self._open(request)
+        root = conn.root()
+        root[0]['i'] = 10
+        request.tm.savepoint()
+        conn.cacheMinimize()
+        result = self._callFUT(request, self.oids)
+        self.assertEqual([obj['i'] for obj in result], [10, 1, 2, 3, 4])
+        self.assertEqual(
+            getattr(self.config.registry, '_zodb_prefetch_pool', None), None)
+        request.finished_callbacks[0](request)
+
+    def test_loads_recorded_by_request_thread(self):
+        from pyramid_zodbconn.stats import instrument
+        request = self._makeRequest()
+        conn = self._open(request)
+        root = conn.root()
+        ghosts = [root[i] for i in range(5)]
+        recorder = DummyRecorder()
+        instrumented = instrument(conn)
+        instrumented.add_recorder(recorder)
+        storage = instrumented.storage
+        result = self._callFUT(request, ghosts)
+        self.assertEqual([obj['i'] for obj in result], list(range(5)))
+        self.assertEqual([oid for oid, thread in recorder.loads], self.oids)
+        self.assertEqual(set(thread for oid, thread in recorder.loads),
+                         set([threading.current_thread()]))
+        self.assertTrue(instrumented.storage.storage is storage)
+        instrumented.remove_recorder(recorder)
+        request.finished_callbacks[0](request)
+
+class TestPrefetchedStorage(unittest.TestCase):
+    def test_load(self):
+        from pyramid_zodbconn.prefetching import PrefetchedStorage
+        storage = DummyStorage()
+        inst = PrefetchedStorage(storage, {b'1': (b'data', b'serial')})
+        self.assertEqual(inst.load(b'1'), (b'data', b'serial'))
+        self.assertEqual(inst.load(b'2'), (b'loaded', b'2'))
+        self.assertEqual(inst.sortKey, storage.sortKey)
+
+    def test_poll_invalidations_drops_records(self):
+        from pyramid_zodbconn.prefetching import PrefetchedStorage
+        records = {b'1': (b'data', b'serial')}
+        inst = PrefetchedStorage(DummyStorage(), records)
+        self.assertEqual(inst.poll_invalidations(), [b'1'])
+        # records stored by threads which are still loading are lost
+        records[b'2'] = (b'data', b'serial')
+        self.assertEqual(inst.load(b'1'), (b'loaded', b'1'))
+        self.assertEqual(inst.load(b'2'), (b'loaded', b'2'))
+
+class Test_prefetched_storage(PrefetchTestBase):
+    def _callFUT(self, conn):
+        from pyramid_zodbconn.prefetching import prefetched_storage
+        return prefetched_storage(conn)
+
+    def test_installed_once(self):
+        from pyramid_zodbconn.prefetching import PrefetchedStorage
+        request = self._makeRequest()
+        conn = self._open(request)
+        normal = conn._normal_storage
+        inst = self._callFUT(conn)
+        self.assertTrue(isinstance(inst, PrefetchedStorage))
+        self.assertTrue(inst.storage is normal)
+        self.assertTrue(conn._storage is inst)
+        self.assertTrue(conn._normal_storage is inst)
+        self.assertTrue(self._callFUT(conn) is inst)
+        request.finished_callbacks[0](request)
+
+    def test_below_instrumentation(self):
+        from pyramid_zodbconn.stats import instrument
+        request = self._makeRequest()
+        conn = self._open(request)
+        instrumented = instrument(conn)
+        normal = instrumented.storage
+        inst = self._callFUT(conn)
+        self.assertTrue(instrumented.storage is inst)
+        self.assertTrue(inst.storage is normal)
+        self.assertTrue(conn._normal_storage is instrumented)
+        self.assertTrue(self._callFUT(conn) is inst)
+        request.finished_callbacks[0](request)
+
+    def test_savepoint_storage_kept(self):
+        request = self._makeRequest()
+        conn = self._open(request)
+        conn.root()['a'] = 1
+        request.tm.savepoint()
+        tmpstore = conn._storage
+        inst = self._callFUT(conn)
+        self.assertTrue(conn._storage is tmpstore)
+        self.assertTrue(conn._normal_storage is inst)
+        request.finished_callbacks[0](request)
+
+class DummyStorage(object):
+    def load(self, oid):
+        return b'loaded', oid
+
+    def poll_invalidations(self):
+        return [b'1']
+
+    def sortKey(self): # pragma: no cover
+        pass
+
+class DummyPrefetchingStorage(object):
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, oids, tid):
+        self.prefetched.append(list(oids))
+
+class DummyRecorder(Recorder):
+    def __init__(self):
+        self.loads = []
+
+    def record_load(self, oid, data, elapsed):
+        self.loads.append((oid, threading.current_thread()))
@@ -0,0 +1,250 @@
+import unittest
+from pyramid import testing
+from ZODB.utils import z64
+
+class TestRouteModel(unittest.TestCase):
+    def _makeOne(self, size=1000):
+        from pyramid_zodbconn.readahead import RouteModel
+        return RouteModel(size)
+
+    def test_predict_needs_requests(self):
+        inst = self._makeOne()
+        for i in range(4):
+            inst.add([b'a'])
+        self.assertEqual(inst.predict(0.5, 10), [])
+        inst.add([b'a'])
+        self.assertEqual(inst.predict(0.5, 10), [b'a'])
+
+    def test_predict_min_support_and_limit(self):
+        inst = self._makeOne()
+        for i in range(10):
+            oids = [b'a']
+            if i % 2:
+                oids.append(b'b')
+            if i < 4:
+                oids.append(b'c')
+            if i < 8:
+                oids.append(b'd')
+            inst.add(oids)
+        self.assertEqual(inst.predict(0.5, 10), [b'a', b'd', b'b'])
+        inst._prediction = None
+        self.assertEqual(inst.predict(0.5, 2), [b'a', b'd'])
+
+    def test_prediction_refreshed(self):
+        inst = self._makeOne()
+        for i in range(5):
+            inst.add([b'a'])
+        self.assertEqual(inst.predict(0.5, 10), [b'a'])
+        for i in range(4):
+            inst.add([b'b'])
+        self.assertEqual(inst.predict(0.5, 10), [b'a'])
+        inst.add([b'b'])
+        self.assertEqual(inst.predict(0.5, 10), [b'a', b'b'])
+
+    def test_pruned(self):
+        inst = self._makeOne(size=2)
+        inst.add([b'a', b'b'])
+        inst.add([b'a', b'b', b'c', b'd'])
+        self.assertEqual(len(inst.counts), 4)
+        inst.add([b'a', b'e'])
+        self.assertEqual(sorted(inst.counts), [b'a', b'b'])
+
+class TestReadAhead(unittest.TestCase):
+    def setUp(self):
+        import transaction
+        from persistent.mapping import PersistentMapping
+        self.config = testing.setUp(settings={
+            'zodbconn.uri': 'memory://',
+            'zodbconn.readahead': 'true',
+            'zodbconn.readahead_trigger': '1',
+            'zodbconn.readahead_max_routes': '1',
+            })
+        self.config.include('pyramid_zodbconn')
+        self.config.commit()
+        self.db = self.config.registry._zodb_databases['']
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        root = conn.root()
+        for i in range(5):
+            root[i] = PersistentMapping({'i': i})
+        tm.commit()
+        self.oids = [root[i]._p_oid for i in range(5)]
+        conn.close()
+        self.readahead = self.config.registry._zodb_readahead
+
+    def tearDown(self):
+        self.db.close()
+        testing.tearDown()
+
+    def _request(self, route='item', count=5):
+        import transaction
+        from pyramid_zodbconn import get_connection
+        request = testing.DummyRequest()
+        request.tm = transaction.TransactionManager()
+        if route is not None:
+            request.matched_route = DummyRoute(route)
+        conn = get_connection(request)
+        conn.cacheMinimize()
+        root = conn.root()
+        values = [root[i]['i'] for i in range(count)]
+        self.assertEqual(values, list(range(count)))
+        return request, conn
+
+    def _close(self, request):
+        request.finished_callbacks[0](request)
+
+    def _learn(self, route='item'):
+        for i in range(5):
+            request, conn = self._request(route)
+            self._close(request)
+
+    def test_learns_per_route(self):
+        self._learn()
+        model = self.readahead.models['item']
+        self.assertEqual(model.requests, 5)
+        # the root object is loaded once more after the first load
+        self.assertEqual(model.predict(0.5, 100), [z64] + self.oids)
+        self.assertEqual(self.readahead.stats(), {
+            'readahead_requests': 0,
+            'readahead_predicted': 0,
+            'readahead_used': 0,
+            })
+
+    def test_no_route(self):
+        request, conn = self._request(route=None)
+        self.assertFalse(hasattr(request, self.readahead.key))
+        self._close(request)
+        self.assertEqual(self.readahead.models, {})
+
+    def test_max_routes(self):
+        self._learn()
+        request, conn = self._request(route='other')
+        self.assertFalse(hasattr(request, self.readahead.key))
+        self._close(request)
+        self.assertEqual(list(self.readahead.models), ['item'])
+
+    def test_read_ahead_with_thread_pool(self):
+        from pyramid_zodbconn.prefetching import PrefetchedStorage
+        self._learn()
+        self.config.registry._zodb_prefetch_pool = DummyPool()
+        request, conn = self._request(count=3)
+        storage = conn._normal_storage.storage
+        self.assertTrue(isinstance(storage, PrefetchedStorage))
+        self.assertEqual(sorted(storage.records), sorted(self.oids))
+        self._close(request)
+        self.assertEqual(self.readahead.stats(), {
+            'readahead_requests': 1,
+            'readahead_predicted': 5,
+            'readahead_used': 3,
+            })
+
+    def test_read_ahead_cancelled(self):
+        self._learn()
+        pool = self.config.registry._zodb_prefetch_pool = DummyPool(
+            defer=True)
+        request, conn = self._request(count=0)
+        self.assertEqual(len(pool.deferred), 1)
+        storage = conn._normal_storage.storage
+        self._close(request)
+        pool.run()
+        self.assertEqual(storage.records, {})
+
+    def test_records_dropped_by_next_transaction(self):
+        self._learn()
+        self.config.registry._zodb_prefetch_pool = DummyPool()
+        request, conn = self._request(count=3)
+        storage = conn._normal_storage.storage
+        self._close(request)
+        request, conn2 = self._request(route=None, count=0)
+        self.assertTrue(conn2 is conn)
+        self.assertTrue(conn._normal_storage.storage is storage)
+        self.assertEqual(storage.records, {})
+        self._close(request)
+
+    def test_with_prefetch(self):
+        # the read-ahead is triggered by a load of prefetch()
+        import transaction
+        from pyramid_zodbconn import get_connection
+        from pyramid_zodbconn import prefetch
+        from pyramid_zodbconn.prefetching import PrefetchedStorage
+        self._learn()
+        self.config.registry._zodb_prefetch_pool = DummyPool()
+        request = testing.DummyRequest()
+        request.tm = transaction.TransactionManager()
+        request.matched_route = DummyRoute('item')
+        conn = get_connection(request)
+        conn.cacheMinimize()
+        objects = prefetch(request, self.oids)
+        self.assertEqual([obj['i'] for obj in objects], list(range(5)))
+        self.assertEqual(self.readahead.requests, 1)
+        self._close(request)
+        # a single layer of records, left in place
+        storage = conn._normal_storage.storage
+        self.assertTrue(isinstance(storage, PrefetchedStorage))
+        self.assertFalse(isinstance(storage.storage, PrefetchedStorage))
+        tm = transaction.TransactionManager()
+        other = self.db.open(tm)
+        other.root()[0]['i'] = 42
+        tm.commit()
+        other.close()
+        request, conn2 = self._request(route=None, count=0)
+        self.assertTrue(conn2 is conn)
+        self.assertEqual(conn.root()[0]['i'], 42)
+        self._close(request)
+
+    def test_read_ahead_with_storage_prefetch(self):
+        self._learn()
+        storage = DummyPrefetchingStorage()
+        self.db.storage.prefetch = storage.prefetch
+        request, conn = self._request()
+        self.assertEqual(storage.prefetched, [self.oids])
+        self._close(request)
+        self.assertEqual(self.readahead.stats(), {
+            'readahead_requests': 1,
+            'readahead_predicted': 5,
+            'readahead_used': 5,
+            })
+
+    def test_loaded_objects_not_read_ahead(self):
+        self._learn()
+        storage = DummyPrefetchingStorage()
+        self.db.storage.prefetch = storage.prefetch
+        import transaction
+        from pyramid_zodbconn import get_connection
+        request = testing.DummyRequest()
+        request.tm = transaction.TransactionManager()
+        request.matched_route = DummyRoute('item')
+        conn = get_connection(request)
+        conn.cacheMinimize()
+        conn.get(self.oids[0])._p_activate()
+        self.assertEqual(storage.prefetched, [[z64] + self.oids[1:]])
+        self._close(request)
+
+class DummyRoute(object):
+    def __init__(self, name):
+        self.name = name
+
+class DummyPool(object):
+    def __init__(self, defer=False):
+        self.defer = defer
+        self.deferred = []
+
+    def apply_async(self, func, args):
+        if self.defer:
+            self.deferred.append((func, args))
+        else:
+            func(*args)
+
+    def map(self, func, items):
+        return [func(item) for item in items]
+
+    def run(self):
+        for func, args in self.deferred:
+            func(*args)
+
+class DummyPrefetchingStorage(object):
+    def __init__(self):
+        self.prefetched = []
+
+    def prefetch(self, oids, tid):
+        self.prefetched.append(list(oids))
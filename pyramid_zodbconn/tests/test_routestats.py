@@ -0,0 +1,167 @@
+import unittest
+from pyramid import testing
+
+class TestLogHistogram(unittest.TestCase):
+    def _makeOne(self):
+        from pyramid_zodbconn.routestats import LogHistogram
+        return LogHistogram()
+
+    def test_empty(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.percentile(0.5), 0)
+        self.assertEqual(inst.summary()['mean'], 0)
+
+    def test_percentiles(self):
+        inst = self._makeOne()
+        for value in range(1, 101):
+            inst.add(value)
+        self.assertEqual(inst.count, 100)
+        self.assertEqual(inst.max, 100)
+        for fraction, exact in ((0.5, 50), (0.95, 95), (0.99, 99)):
+            value = inst.percentile(fraction)
+            self.assertTrue(exact <= value <= exact * inst.growth,
+                            (fraction, value))
+        self.assertEqual(inst.percentile(1.0), 100)
+
+    def test_zeros(self):
+        inst = self._makeOne()
+        for value in (0, 0, 0, 10):
+            inst.add(value)
+        self.assertEqual(inst.percentile(0.5), 0)
+        self.assertEqual(inst.percentile(0.99), 10)
+
+    def test_small_values(self):
+        inst = self._makeOne()
+        inst.add(0.001)
+        inst.add(0.002)
+        self.assertTrue(0.001 <= inst.percentile(0.5) <= 0.0011)
+
+    def test_bounded_buckets(self):
+        inst = self._makeOne()
+        for value in range(1, 100000):
+            inst.add(value)
+        self.assertTrue(len(inst.buckets) < 150)
+
+    def test_summary(self):
+        inst = self._makeOne()
+        inst.add(2)
+        inst.add(4)
+        summary = inst.summary()
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['mean'], 3.0)
+        self.assertEqual(summary['max'], 4)
+        self.assertEqual(summary['p99'], 4)
+
+class Test_endpoint(unittest.TestCase):
+    def _callFUT(self, request):
+        from pyramid_zodbconn.routestats import endpoint
+        return endpoint(request)
+
+    def test_route(self):
+        request = testing.DummyRequest()
+        request.matched_route = DummyRoute('home')
+        self.assertEqual(self._callFUT(request), 'home')
+
+    def test_traversal(self):
+        request = testing.DummyRequest()
+        request.context = DummyRoute('x')
+        request.view_name = 'edit'
+        self.assertEqual(self._callFUT(request),
+                         'pyramid_zodbconn.tests.test_routestats.'
+                         'DummyRoute:edit')
+
+    def test_unknown(self):
+        from pyramid_zodbconn.routestats import UNKNOWN
+        self.assertEqual(self._callFUT(testing.DummyRequest()), UNKNOWN)
+
+class TestRouteStats(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from pyramid_zodbconn.routestats import RouteStats
+        return RouteStats(**kw)
+
+    def test_request_cycle(self):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        inst = self._makeOne()
+        conn = DummyConnection()
+        request = testing.DummyRequest()
+        request.matched_route = DummyRoute('home')
+        event = ZODBConnectionOpened(conn, request)
+        inst.start(event, time=FakeTimeModule(10.0))
+        conn.transfer_counts = (5, 1)
+        inst.end(event, time=FakeTimeModule(10.5))
+        report = inst.report()
+        self.assertEqual(list(report), ['home'])
+        self.assertEqual(report['home']['requests'], 1)
+        self.assertEqual(report['home']['elapsed']['max'], 0.5)
+        self.assertEqual(report['home']['loads']['max'], 5)
+        self.assertEqual(report['home']['stores']['max'], 1)
+
+    def test_end_without_start(self):
+        from pyramid_zodbconn import ZODBConnectionWillClose
+        inst = self._makeOne()
+        event = ZODBConnectionWillClose(DummyConnection(),
+                                        testing.DummyRequest())
+        inst.end(event)
+        self.assertEqual(inst.report(), {})
+
+    def test_max_endpoints(self):
+        from pyramid_zodbconn.routestats import OTHER
+        inst = self._makeOne(max_endpoints=2)
+        for name in ('a', 'b', 'c', 'd', 'a'):
+            inst.add(name, 0.1, 1, 0)
+        report = inst.report()
+        self.assertEqual(sorted(report), [OTHER, 'a', 'b'])
+        self.assertEqual(report['a']['requests'], 2)
+        self.assertEqual(report[OTHER]['requests'], 2)
+
+    def test_writer(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'routes.json')
+        inst = self._makeOne(filename=filename, interval=60)
+        inst.add('home', 0.1, 1, 0)
+        inst.writer.start(None)
+        thread = inst.writer._thread
+        inst.writer.start(None)
+        self.assertTrue(inst.writer._thread is thread)
+        inst.writer.stop()
+        self.assertFalse(thread.is_alive())
+        with open(filename) as f:
+            self.assertEqual(json.load(f)['home']['requests'], 1)
+
+class Test_route_stats_view(unittest.TestCase):
+    def test_it(self):
+        import json
+        from pyramid_zodbconn.routestats import RouteStats
+        from pyramid_zodbconn.routestats import route_stats_view
+        request = testing.DummyRequest()
+        request.registry = DummyRegistry()
+        request.registry._zodb_route_stats = RouteStats()
+        request.registry._zodb_route_stats.add('home', 0.1, 1, 0)
+        response = route_stats_view(request)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(json.loads(response.text)['home']['requests'], 1)
+
+class DummyRegistry(object):
+    pass
+
+class DummyRoute(object):
+    def __init__(self, name):
+        self.name = name
+
+class DummyConnection(object):
+    transfer_counts = (0, 0)
+
+    def getTransferCounts(self):
+        return self.transfer_counts
+
+class FakeTimeModule(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
@@ -0,0 +1,217 @@
+import unittest
+
+from ZODB.utils import p64
+
+class TestSharedStateCache(unittest.TestCase):
+    def _makeOne(self, max_bytes=1000, max_record_size=None):
+        from pyramid_zodbconn.sharedcache import SharedStateCache
+        inst = SharedStateCache(max_bytes, max_record_size)
+        inst.reset(p64(10))
+        return inst
+
+    def test_miss(self):
+        inst = self._makeOne()
+        self.assertEqual(inst.lookup(p64(1), p64(11)), None)
+        self.assertEqual(inst.misses, 1)
+
+    def test_current(self):
+        inst = self._makeOne()
+        inst.store(p64(1), (b'data', p64(5), None), inst.generation())
+        self.assertEqual(inst.lookup(p64(1), p64(11)), (b'data', p64(5), None))
+        # before the record was written
+        self.assertEqual(inst.lookup(p64(1), p64(5)), None)
+        # past the last transaction the cache knows about
+        self.assertEqual(inst.lookup(p64(1), p64(12)), None)
+        self.assertEqual(inst.hits, 1)
+        self.assertEqual(inst.misses, 2)
+
+    def test_current_invalidated_while_loading(self):
+        inst = self._makeOne()
+        generation = inst.generation()
+        inst.invalidate(p64(11), [p64(1)])
+        inst.store(p64(1), (b'data', p64(5), None), generation)
+        self.assertEqual(inst.lookup(p64(1), p64(11)), None)
+        self.assertEqual(inst.size, 0)
+
+    def test_historical_stored_after_invalidation(self):
+        inst = self._makeOne()
+        generation = inst.generation()
+        inst.invalidate(p64(11), [p64(1)])
+        inst.store(p64(1), (b'data', p64(5), p64(11)), generation)
+        self.assertEqual(inst.lookup(p64(1), p64(11)),
+                         (b'data', p64(5), p64(11)))
+
+    def test_invalidate(self):
+        inst = self._makeOne()
+        inst.store(p64(1), (b'data', p64(5), None), inst.generation())
+        inst.invalidate(p64(11), [p64(1), p64(2)])
+        # still valid for connections which don't see transaction 11
+        self.assertEqual(inst.lookup(p64(1), p64(11)),
+                         (b'data', p64(5), p64(11)))
+        self.assertEqual(inst.lookup(p64(1), p64(12)), None)
+
+    def test_invalidate_newer_record(self):
+        inst = self._makeOne()
+        inst.store(p64(1), (b'data', p64(11), None), inst.generation())
+        inst.invalidate(p64(11), [p64(1)])
+        self.assertEqual(inst.lookup(p64(1), p64(12)),
+                         (b'data', p64(11), None))
+
+    def test_keeps_latest_revision(self):
+        inst = self._makeOne()
+        inst.store(p64(1), (b'new', p64(8), None), inst.generation())
+        inst.store(p64(1), (b'old', p64(5), p64(8)), inst.generation())
+        self.assertEqual(inst.lookup(p64(1), p64(11)), (b'new', p64(8), None))
+        inst.invalidate(p64(11), [p64(1)])
+        inst.store(p64(1), (b'newer', p64(11), None), inst.generation())
+        self.assertEqual(inst.lookup(p64(1), p64(12)),
+                         (b'newer', p64(11), None))
+        self.assertEqual(inst.size, 5)
+        self.assertEqual(len(inst._entries), 1)
+
+    def test_lru_eviction(self):
+        inst = self._makeOne(max_bytes=20, max_record_size=10)
+        inst.store(p64(1), (b'x' * 10, p64(5), None), inst.generation())
+        inst.store(p64(2), (b'x' * 10, p64(5), None), inst.generation())
+        inst.lookup(p64(1), p64(11))
+        inst.store(p64(3), (b'x' * 10, p64(5), None), inst.generation())
+        self.assertEqual(inst.evictions, 1)
+        self.assertEqual(inst.size, 20)
+        self.assertEqual(inst.lookup(p64(2), p64(11)), None)
+        self.assertNotEqual(inst.lookup(p64(1), p64(11)), None)
+        self.assertNotEqual(inst.lookup(p64(3), p64(11)), None)
+
+    def test_large_records_not_cached(self):
+        inst = self._makeOne(max_bytes=100)
+        inst.store(p64(1), (b'x' * 11, p64(5), None), inst.generation())
+        self.assertEqual(inst.size, 0)
+
+    def test_reset(self):
+        inst = self._makeOne()
+        inst.store(p64(1), (b'data', p64(5), None), inst.generation())
+        inst.reset(p64(20))
+        self.assertEqual(inst.size, 0)
+        self.assertEqual(inst.lookup(p64(1), p64(11)), None)
+
+    def test_stats(self):
+        inst = self._makeOne()
+        inst.store(p64(1), (b'data', p64(5), None), inst.generation())
+        inst.lookup(p64(1), p64(11))
+        self.assertEqual(inst.stats(), {
+            'shared_cache_bytes': 4,
+            'shared_cache_records': 1,
+            'shared_cache_hits': 1,
+            'shared_cache_misses': 0,
+            'shared_cache_evictions': 0,
+            })
+
+class Test_install(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from pyramid_zodbconn.sharedcache import SharedStateCache
+        self.db = DB(MappingStorage())
+        self.cache = SharedStateCache(1024 * 1024)
+
+    def tearDown(self):
+        self.db.close()
+
+    def _callFUT(self, db, cache):
+        from pyramid_zodbconn.sharedcache import install
+        return install(db, cache)
+
+    def _populate(self):
+        from persistent.mapping import PersistentMapping
+        tm, conn = self._open()
+        conn.root()['a'] = PersistentMapping({'b': 1})
+        tm.commit()
+        conn.close()
+
+    def _open(self):
+        import transaction
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        conn.cacheMinimize()
+        return tm, conn
+
+    def test_not_mvcc_adapter(self):
+        db = DummyDB()
+        self.assertFalse(self._callFUT(db, self.cache))
+
+    def test_loads_shared_between_connections(self):
+        self.assertTrue(self._callFUT(self.db, self.cache))
+        self._populate()
+        tm1, conn1 = self._open()
+        tm2, conn2 = self._open()
+        self.assertTrue(conn1 is not conn2)
+        self.assertEqual(conn1.root()['a']['b'], 1)
+        misses = self.cache.misses
+        self.assertTrue(misses >= 2)
+        self.assertEqual(conn2.root()['a']['b'], 1)
+        self.assertEqual(self.cache.misses, misses)
+        self.assertTrue(self.cache.hits >= 2)
+        conn1.close()
+        conn2.close()
+
+    def test_invalidation(self):
+        self._callFUT(self.db, self.cache)
+        self._populate()
+        tm1, conn1 = self._open()
+        tm2, conn2 = self._open()
+        self.assertEqual(conn1.root()['a']['b'], 1)
+        self.assertEqual(conn2.root()['a']['b'], 1)
+        conn1.root()['a']['b'] = 2
+        tm1.commit()
+        # conn2 still sees the database as of before the commit
+        conn2.cacheMinimize()
+        self.assertEqual(conn2.root()['a']['b'], 1)
+        tm2.abort()
+        self.assertEqual(conn2.root()['a']['b'], 2)
+        conn2.cacheMinimize()
+        self.assertEqual(conn2.root()['a']['b'], 2)
+        conn1.close()
+        conn2.close()
+        tm3, conn3 = self._open()
+        self.assertEqual(conn3.root()['a']['b'], 2)
+        conn3.close()
+
+    def test_remote_invalidation_and_reset(self):
+        from ZODB.utils import p64
+        self._callFUT(self.db, self.cache)
+        self._populate()
+        tm1, conn1 = self._open()
+        conn1.root()['a']
+        self.assertTrue(self.cache.size > 0)
+        self.db._mvcc_storage.invalidate(p64(2 ** 60), [])
+        self.assertEqual(self.cache._horizon, p64(2 ** 60 + 1))
+        self.db._mvcc_storage.invalidateCache()
+        self.assertEqual(self.cache.size, 0)
+        conn1.close()
+
+class Test_shared_cache_factory(unittest.TestCase):
+    def test_it(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from pyramid_zodbconn.sharedcache import CachingStorage
+        from pyramid_zodbconn.sharedcache import shared_cache_factory
+        def db_from_uri(uri, dbname, dbmap):
+            return DB(MappingStorage(), databases=dbmap, database_name=dbname)
+        caches = {}
+        factory = shared_cache_factory(db_from_uri, 1000, caches)
+        db = factory('memory://', 'main', {})
+        self.addCleanup(db.close)
+        self.assertEqual(list(caches), ['main'])
+        self.assertEqual(caches['main'].max_bytes, 1000)
+        self.assertTrue(
+            isinstance(db._mvcc_storage._storage, CachingStorage))
+
+    def test_not_mvcc_adapter(self):
+        from pyramid_zodbconn.sharedcache import shared_cache_factory
+        caches = {}
+        factory = shared_cache_factory(
+            lambda uri, dbname, dbmap: DummyDB(), 1000, caches)
+        factory('uri', 'main', {})
+        self.assertEqual(caches, {})
+
+class DummyDB(object):
+    _mvcc_storage = None
@@ -0,0 +1,278 @@
+import unittest
+from pyramid import testing
+
+class TestConnectionStats(unittest.TestCase):
+    def _makeOne(self, dbname=''):
+        from pyramid_zodbconn.stats import ConnectionStats
+        return ConnectionStats(dbname)
+
+    def test_record(self):
+        inst = self._makeOne('foo')
+        inst.record_hit()
+        inst.record_load(b'\0' * 8, b'x' * 10, 0.5)
+        inst.record_load(b'\0' * 8, b'x' * 5, 0.25)
+        inst.record_invalidations(3)
+        self.assertEqual(inst.as_dict(), {
+            'dbname': 'foo',
+            'cache_hits': 1,
+            'cache_misses': 2,
+            'load_time': 0.75,
+            'bytes_loaded': 15,
+            'invalidations': 3,
+            'loads': 0,
+            'stores': 0,
+            'elapsed': 0.0,
+            })
+
+class TestInstrumentedStorage(unittest.TestCase):
+    def _makeOne(self, storage):
+        from pyramid_zodbconn.stats import InstrumentedStorage
+        return InstrumentedStorage(storage, time=FakeTimeModule())
+
+    def test_load_without_stats(self):
+        inst = self._makeOne(DummyStorage())
+        self.assertEqual(inst.load(b'oid'), (b'data', b'serial'))
+
+    def test_load_with_stats(self):
+        from pyramid_zodbconn.stats import ConnectionStats
+        inst = self._makeOne(DummyStorage())
+        stats = ConnectionStats()
+        inst.add_recorder(stats)
+        self.assertEqual(inst.load(b'oid'), (b'data', b'serial'))
+        self.assertEqual(stats.cache_misses, 1)
+        self.assertEqual(stats.bytes_loaded, 4)
+        self.assertEqual(stats.load_time, 1)
+
+    def test_loadBefore(self):
+        from pyramid_zodbconn.stats import ConnectionStats
+        inst = self._makeOne(DummyStorage())
+        self.assertEqual(inst.loadBefore(b'oid', b'tid'),
+                         (b'data', b'serial', None))
+        stats = ConnectionStats()
+        inst.add_recorder(stats)
+        inst.loadBefore(b'oid', b'tid')
+        self.assertEqual(stats.cache_misses, 1)
+        inst.storage.before = None
+        self.assertEqual(inst.loadBefore(b'oid', b'tid'), None)
+        self.assertEqual(stats.cache_misses, 1)
+
+    def test_poll_invalidations(self):
+        from pyramid_zodbconn.stats import ConnectionStats
+        inst = self._makeOne(DummyStorage())
+        self.assertEqual(inst.poll_invalidations(), [b'a', b'b'])
+        self.assertEqual(inst.pending_invalidations, 2)
+        stats = ConnectionStats()
+        inst.add_recorder(stats)
+        inst.poll_invalidations()
+        self.assertEqual(stats.invalidations, 2)
+        self.assertEqual(inst.pending_invalidations, 2)
+
+    def test_add_remove_recorder(self):
+        from pyramid_zodbconn.stats import ConnectionStats
+        inst = self._makeOne(DummyStorage())
+        first, second = ConnectionStats(), ConnectionStats()
+        inst.add_recorder(first)
+        inst.add_recorder(second)
+        inst.load(b'oid')
+        inst.record_hit()
+        inst.remove_recorder(first)
+        inst.load(b'oid')
+        self.assertEqual(inst.recorders, (second,))
+        self.assertEqual(first.cache_misses, 1)
+        self.assertEqual(first.cache_hits, 1)
+        self.assertEqual(second.cache_misses, 2)
+
+    def test_delegates(self):
+        inst = self._makeOne(DummyStorage())
+        self.assertEqual(inst.release, inst.storage.release)
+
+class Test_instrument(unittest.TestCase):
+    def setUp(self):
+        import transaction
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        self.db = DB(MappingStorage())
+        self.tm = transaction.TransactionManager()
+        self.conn = self.db.open(self.tm)
+
+    def tearDown(self):
+        self.tm.abort()
+        self.conn.close()
+        self.db.close()
+
+    def _callFUT(self, conn):
+        from pyramid_zodbconn.stats import instrument
+        return instrument(conn)
+
+    def test_it(self):
+        from pyramid_zodbconn.stats import InstrumentedStorage
+        storage = self._callFUT(self.conn)
+        self.assertTrue(isinstance(storage, InstrumentedStorage))
+        self.assertTrue(self.conn._storage is storage)
+        self.assertTrue(self.conn._normal_storage is storage)
+        self.assertTrue(self._callFUT(self.conn) is storage)
+
+    def test_after_savepoint(self):
+        import transaction
+        root = self.conn.root()
+        root['a'] = 1
+        self.tm.savepoint()
+        tmpstore = self.conn._storage
+        storage = self._callFUT(self.conn)
+        self.assertTrue(self.conn._storage is tmpstore)
+        self.assertTrue(self.conn._normal_storage is storage)
+        root['b'] = 2
+        self.tm.commit()
+        self.assertTrue(self.conn._storage is storage)
+        conn = self.db.open(transaction.TransactionManager())
+        self.assertEqual(sorted(conn.root().items()), [('a', 1), ('b', 2)])
+        conn.close()
+
+class TestStatsCollector(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        import transaction
+        self.db = DB(MappingStorage())
+        self.tm = transaction.TransactionManager()
+        conn = self.db.open(self.tm)
+        from persistent.mapping import PersistentMapping
+        conn.root()['a'] = PersistentMapping({'b': PersistentMapping()})
+        self.tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _makeOne(self, stats_factory=None):
+        from pyramid_zodbconn.stats import StatsCollector
+        if stats_factory is None:
+            return StatsCollector()
+        return StatsCollector(stats_factory)
+
+    def _makeEvent(self, conn):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        return ZODBConnectionOpened(conn, testing.DummyRequest())
+
+    def test_request_cycle(self):
+        inst = self._makeOne()
+        conn = self.db.open(self.tm)
+        conn.cacheMinimize()
+        event = self._makeEvent(conn)
+        inst.start(event, time=FakeTimeModule())
+        stats = event.request.zodb_stats
+        root = conn.root()
+        root['a']['b'].keys()
+        root['a']['b'].keys()
+        inst.end(event, time=FakeTimeModule(2))
+        conn.close()
+        self.assertEqual(stats.dbname, 'unnamed')
+        self.assertEqual(stats.loads, 3)
+        self.assertTrue(stats.cache_misses >= 3)
+        self.assertTrue(stats.cache_hits >= 1)
+        self.assertTrue(stats.bytes_loaded > 0)
+        self.assertEqual(stats.elapsed, 2)
+        self.assertEqual(conn._normal_storage.recorders, ())
+
+    def test_instrumentation_installed_once(self):
+        from pyramid_zodbconn.stats import InstrumentedStorage
+        inst = self._makeOne()
+        conn = self.db.open(self.tm)
+        inst.start(self._makeEvent(conn))
+        storage = conn._normal_storage
+        self.assertTrue(isinstance(storage, InstrumentedStorage))
+        inst.start(self._makeEvent(conn))
+        self.assertTrue(conn._normal_storage is storage)
+        conn.close()
+
+    def test_pending_invalidations_reported_at_next_open(self):
+        inst = self._makeOne()
+        conn = self.db.open(self.tm)
+        inst.start(self._makeEvent(conn))
+        conn._normal_storage.pending_invalidations = 4
+        event = self._makeEvent(conn)
+        inst.start(event)
+        self.assertEqual(event.request.zodb_stats.invalidations, 4)
+        self.assertEqual(conn._normal_storage.pending_invalidations, 0)
+        conn.close()
+
+    def test_custom_factory(self):
+        inst = self._makeOne(DummyStats)
+        conn = self.db.open(self.tm)
+        event = self._makeEvent(conn)
+        inst.start(event)
+        inst.end(event)
+        conn.close()
+        self.assertTrue(isinstance(event.request.zodb_stats, DummyStats))
+
+    def test_secondary(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        other = DB(MappingStorage(), databases=self.db.databases,
+                   database_name='other')
+        self.addCleanup(other.close)
+        inst = self._makeOne()
+        conn = self.db.open(self.tm)
+        event = self._makeEvent(conn)
+        inst.start(event, time=FakeTimeModule())
+        secondary = conn.get_connection('other')
+        secondary_event = ZODBSecondaryConnectionOpened(
+            secondary, event.request, 'other')
+        inst.start_secondary(secondary_event, time=FakeTimeModule(1))
+        inst.start_secondary(secondary_event, time=FakeTimeModule(1))
+        secondary.cacheMinimize()
+        secondary.root()['x'] = 1
+        inst.end(event, time=FakeTimeModule(3))
+        self.tm.abort()
+        conn.close()
+        stats = event.request.zodb_database_stats
+        self.assertEqual(sorted(stats), ['other', 'unnamed'])
+        self.assertTrue(stats['unnamed'] is event.request.zodb_stats)
+        self.assertEqual(stats['other'].elapsed, 2)
+        self.assertEqual(stats['other'].loads, 1)
+        self.assertEqual(secondary._normal_storage.recorders, ())
+
+    def test_secondary_without_start(self):
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        inst = self._makeOne()
+        event = ZODBSecondaryConnectionOpened(
+            None, testing.DummyRequest(), 'other')
+        inst.start_secondary(event)
+        self.assertFalse(hasattr(event.request, 'zodb_database_stats'))
+
+    def test_end_without_start(self):
+        inst = self._makeOne()
+        conn = self.db.open(self.tm)
+        event = self._makeEvent(conn)
+        inst.end(event)
+        conn.close()
+        self.assertFalse(hasattr(event.request, 'zodb_stats'))
+
+class DummyStorage(object):
+    before = (b'data', b'serial', None)
+    def load(self, oid):
+        return b'data', b'serial'
+    def loadBefore(self, oid, tid):
+        return self.before
+    def poll_invalidations(self):
+        return [b'a', b'b']
+    def release(self):
+        pass
+
+class DummyStats(object):
+    def __init__(self, dbname):
+        self.dbname = dbname
+    def record_invalidations(self, count):
+        pass
+    def record_hit(self):
+        pass
+    def record_load(self, oid, data, elapsed):
+        pass
+
+class FakeTimeModule(object):
+    def __init__(self, when=0):
+        self.when = when
+    def time(self):
+        self.when += 1
+        return self.when - 1
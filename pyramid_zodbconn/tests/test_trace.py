@@ -0,0 +1,186 @@
+import unittest
+from pyramid import testing
+
+class Test_pickle_class(unittest.TestCase):
+    def _callFUT(self, data):
+        from pyramid_zodbconn.trace import pickle_class
+        return pickle_class(data)
+
+    def test_record(self):
+        from ZODB.serialize import ObjectWriter
+        from persistent.mapping import PersistentMapping
+        data = ObjectWriter().serialize(PersistentMapping())
+        self.assertEqual(
+            self._callFUT(data), 'persistent.mapping.PersistentMapping')
+
+    def test_garbage(self):
+        self.assertEqual(self._callFUT(b''), '?')
+
+class TestLoadTrace(unittest.TestCase):
+    def _makeOne(self, max_loads=10000):
+        from pyramid_zodbconn.trace import LoadTrace
+        return LoadTrace(max_loads, time=FakeTimeModule())
+
+    def test_add(self):
+        from ZODB.utils import p64
+        inst = self._makeOne(max_loads=1)
+        inst.add('', p64(1), b'', 0.5)
+        inst.add('', p64(2), b'', 0.5)
+        self.assertEqual(inst.loads, [(1, '', p64(1), '?', 0, 0.5)])
+        self.assertEqual(inst.truncated, 1)
+        self.assertEqual(inst.as_dict(), {
+            'truncated': 1,
+            'loads': [[1, '', '0x01', '?', 0, 0.5]],
+            })
+
+class TestLoadTracer(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from persistent.mapping import PersistentMapping
+        import transaction
+        self.db = DB(MappingStorage())
+        self.tm = transaction.TransactionManager()
+        conn = self.db.open(self.tm)
+        conn.root()['a'] = PersistentMapping({'b': PersistentMapping()})
+        self.tm.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.db.close()
+
+    def _makeOne(self, **kw):
+        import io
+        from pyramid_zodbconn.trace import LoadTracer
+        stream = io.StringIO() if str is not bytes else io.BytesIO()
+        return LoadTracer(stream, **kw)
+
+    def _makeEvent(self, conn, request=None):
+        from pyramid_zodbconn import ZODBConnectionOpened
+        if request is None:
+            request = testing.DummyRequest()
+        return ZODBConnectionOpened(conn, request)
+
+    def _run(self, inst, request=None):
+        conn = self.db.open(self.tm)
+        conn.cacheMinimize()
+        event = self._makeEvent(conn, request)
+        inst.start(event, time=FakeTimeModule())
+        conn.root()['a']['b'].keys()
+        inst.end(event, time=FakeTimeModule(5))
+        conn.close()
+        return event
+
+    def test_not_sampled(self):
+        inst = self._makeOne(sample_rate=0.5, random=lambda: 0.5)
+        event = self._run(inst)
+        self.assertFalse(hasattr(event.request, 'zodb_load_trace'))
+        self.assertEqual(inst.traced, 0)
+        self.assertEqual(inst.stream.getvalue(), '')
+
+    def test_sampled(self):
+        import json
+        inst = self._makeOne(sample_rate=0.5, random=lambda: 0.4)
+        event = self._run(inst)
+        trace = event.request.zodb_load_trace
+        self.assertEqual(inst.traced, 1)
+        self.assertEqual(inst.written, 1)
+        self.assertTrue(len(trace.loads) >= 3)
+        self.assertEqual(
+            [load[3] for load in trace.loads],
+            ['persistent.mapping.PersistentMapping'] * len(trace.loads))
+        self.assertEqual([load[0] for load in trace.loads],
+                         sorted(load[0] for load in trace.loads))
+        self.assertEqual(trace.recorders, {})
+        record = json.loads(inst.stream.getvalue())
+        self.assertEqual(record['method'], 'GET')
+        self.assertEqual(record['elapsed'], 5)
+        self.assertEqual(record['truncated'], 0)
+        self.assertEqual(record['loads'][0][1:4],
+                         ['unnamed', '0x00', 'persistent.mapping.PersistentMapping'])
+
+    def test_below_threshold(self):
+        inst = self._makeOne(threshold=10, sample_rate=1.0)
+        event = self._run(inst)
+        self.assertTrue(len(event.request.zodb_load_trace.loads) >= 3)
+        self.assertEqual(inst.written, 0)
+        self.assertEqual(inst.stream.getvalue(), '')
+
+    def test_trace_loads_before_open(self):
+        from pyramid_zodbconn.trace import trace_loads
+        inst = self._makeOne()
+        request = testing.DummyRequest()
+        request.registry._zodb_load_tracer = inst
+        trace_loads(request)
+        event = self._run(inst, request)
+        self.assertTrue(len(event.request.zodb_load_trace.loads) >= 3)
+        self.assertEqual(inst.written, 1)
+
+    def test_trace_loads_after_open(self):
+        from pyramid_zodbconn.trace import trace_loads
+        inst = self._makeOne()
+        request = testing.DummyRequest()
+        request.registry._zodb_load_tracer = inst
+        conn = self.db.open(self.tm)
+        conn.cacheMinimize()
+        event = self._makeEvent(conn, request)
+        inst.start(event)
+        self.assertFalse(hasattr(request, 'zodb_load_trace'))
+        request._primary_zodb_conn = conn
+        trace_loads(request)
+        trace = request.zodb_load_trace
+        trace_loads(request)
+        self.assertTrue(request.zodb_load_trace is trace)
+        conn.root()['a'].keys()
+        inst.end(event)
+        conn.close()
+        self.assertTrue(len(trace.loads) >= 2)
+        self.assertEqual(inst.traced, 1)
+
+    def test_trace_loads_not_configured(self):
+        from pyramid_zodbconn.trace import trace_loads
+        request = testing.DummyRequest()
+        trace_loads(request)
+        self.assertFalse(hasattr(request, 'zodb_load_trace'))
+
+    def test_start_secondary(self):
+        from pyramid_zodbconn import ZODBSecondaryConnectionOpened
+        inst = self._makeOne(sample_rate=1.0)
+        conn = self.db.open(self.tm)
+        event = self._makeEvent(conn)
+        inst.start(event, time=FakeTimeModule())
+        other = DummyConnection()
+        inst.start_secondary(
+            ZODBSecondaryConnectionOpened(other, event.request, 'other'))
+        trace = event.request.zodb_load_trace
+        self.assertEqual(sorted(trace.recorders), ['other', 'unnamed'])
+        inst.end(event, time=FakeTimeModule(5))
+        conn.close()
+        self.assertEqual(other._normal_storage.recorders, ())
+
+class DummyStorage(object):
+    def load(self, oid): # pragma: no cover
+        pass
+
+class DummyCache(object):
+    pass
+
+class DummyReader(object):
+    def __init__(self):
+        self._cache = DummyCache()
+
+class DummyConnection(object):
+    def __init__(self):
+        self._storage = self._normal_storage = DummyStorage()
+        self._reader = DummyReader()
+        self._cache = DummyCache()
+
+    def get(self, oid): # pragma: no cover
+        pass
+
+class FakeTimeModule(object):
+    def __init__(self, when=0):
+        self.when = when
+    def time(self):
+        self.when += 1
+        return self.when - 1
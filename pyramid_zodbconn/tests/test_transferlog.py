@@ -0,0 +1,338 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+class TestFormats(unittest.TestCase):
+    args = (1404321994.5, 'GET', '/a?b=1', 1.25, 3, 1, [('other', 2, 0)])
+
+    def test_format_csv(self):
+        from pyramid_zodbconn.transferlog import format_csv
+        result = format_csv(*self.args)
+        self.assertTrue(
+            result.endswith(
+                '"GET", "/a?b=1", 1.25, 3, 1, "other", 2, 0\n'),
+            result)
+
+    def test_format_json(self):
+        import json
+        from pyramid_zodbconn.transferlog import format_json
+        result = format_json(*self.args)
+        self.assertTrue(result.endswith('\n'))
+        self.assertEqual(json.loads(result), {
+            'time': 1404321994.5,
+            'method': 'GET',
+            'url': '/a?b=1',
+            'elapsed': 1.25,
+            'loads': 3,
+            'stores': 1,
+            'databases': {'other': [2, 0]},
+            })
+
+    def test_format_json_no_secondaries(self):
+        import json
+        from pyramid_zodbconn.transferlog import format_json
+        args = self.args[:-1] + ([],)
+        self.assertFalse('databases' in json.loads(format_json(*args)))
+
+    def test_format_binary(self):
+        from pyramid_zodbconn.transferlog import format_binary
+        from pyramid_zodbconn.transferlog import read_binary
+        result = format_binary(*self.args)
+        self.assertTrue(isinstance(result, bytes))
+        records = list(read_binary(result))
+        self.assertEqual(len(records), 1)
+        record = records[0]
+        self.assertEqual(record.time, 1404321994.5)
+        self.assertEqual(record.method, 'GET')
+        self.assertEqual(record.url, '/a?b=1')
+        self.assertEqual(record.elapsed, 1.25)
+        self.assertEqual(record.loads, 3)
+        self.assertEqual(record.stores, 1)
+        self.assertEqual(record.databases, [('other', 2, 0)])
+
+class TestReadRecords(unittest.TestCase):
+    def _callFUT(self, buf, format=None):
+        from pyramid_zodbconn.transferlog import read_records
+        return list(read_records(buf, format))
+
+    def _log(self, formatter, *records):
+        return b''.join(
+            formatter(*record).encode('utf-8')
+            if not isinstance(formatter(*record), bytes)
+            else formatter(*record)
+            for record in records)
+
+    def test_csv(self):
+        from pyramid_zodbconn.transferlog import format_csv
+        buf = self._log(
+            format_csv,
+            (0, 'GET', '/a', 1.0, 2, 0, []),
+            (0, 'POST', '/b', 0.5, 1, 1, [('other', 4, 0)]),
+            )
+        records = self._callFUT(buf)
+        self.assertEqual([r.url for r in records], ['/a', '/b'])
+        self.assertEqual(records[1].method, 'POST')
+        self.assertEqual(records[1].elapsed, 0.5)
+        self.assertEqual(records[1].databases, [('other', 4, 0)])
+
+    def test_json(self):
+        from pyramid_zodbconn.transferlog import format_json
+        buf = self._log(
+            format_json,
+            (0, 'GET', '/a', 1.0, 2, 0, [('other', 4, 0)]),
+            )
+        records = self._callFUT(buf)
+        self.assertEqual(records[0].loads, 2)
+        self.assertEqual(records[0].databases, [('other', 4, 0)])
+
+    def test_binary_partial_last_record(self):
+        from pyramid_zodbconn.transferlog import format_binary
+        buf = self._log(
+            format_binary,
+            (0, 'GET', '/a', 1.0, 2, 0, []),
+            (0, 'GET', '/b', 1.0, 2, 0, []),
+            )
+        records = self._callFUT(buf[:-3])
+        self.assertEqual([r.url for r in records], ['/a'])
+
+    def test_partial_last_line(self):
+        from pyramid_zodbconn.transferlog import format_json
+        buf = self._log(
+            format_json,
+            (0, 'GET', '/a', 1.0, 2, 0, []),
+            (0, 'GET', '/b', 1.0, 2, 0, []),
+            )
+        records = self._callFUT(buf[:-3], 'json')
+        self.assertEqual([r.url for r in records], ['/a'])
+
+class TestBufferedTransferLogWriter(unittest.TestCase):
+    def _makeOne(self, stream=None, **kw):
+        from pyramid_zodbconn.transferlog import BufferedTransferLogWriter
+        if stream is None:
+            import io
+            stream = io.StringIO()
+        inst = BufferedTransferLogWriter(stream, **kw)
+        self.addCleanup(inst.close)
+        return inst
+
+    def test_bad_overflow_policy(self):
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_zodbconn.transferlog import BufferedTransferLogWriter
+        self.assertRaises(ConfigurationError, BufferedTransferLogWriter,
+                          None, overflow='explode')
+
+    def test_write_bytes(self):
+        import io
+        inst = self._makeOne(io.BytesIO(), flush_interval=60)
+        inst.write(b'a')
+        inst.write(b'b')
+        inst.close()
+        self.assertEqual(inst.stream.getvalue(), b'ab')
+
+    def test_write_is_buffered_until_close(self):
+        inst = self._makeOne(flush_interval=60)
+        inst.write(u'a\n')
+        inst.write(u'b\n')
+        inst.flush()
+        inst.close()
+        self.assertEqual(inst.stream.getvalue(), 'a\nb\n')
+
+    def test_flushes_on_batch_size(self):
+        stream = DummyFlushingStream()
+        inst = self._makeOne(stream, flush_lines=2, flush_interval=60)
+        inst.write(u'a\n')
+        inst.write(u'b\n')
+        self.assertTrue(stream.flushed.wait(5))
+        self.assertEqual(stream.written, ['a\nb\n'])
+
+    def test_flushes_on_interval(self):
+        stream = DummyFlushingStream()
+        inst = self._makeOne(stream, flush_interval=0.01)
+        inst.write(u'a\n')
+        self.assertTrue(stream.flushed.wait(5))
+        self.assertEqual(stream.written, ['a\n'])
+
+    def test_overflow_drop(self):
+        inst = self._makeOne(maxlines=1, flush_interval=60)
+        inst.write(u'a\n')
+        inst.write(u'b\n')
+        self.assertEqual(inst.dropped, 1)
+        inst.close()
+        self.assertEqual(inst.stream.getvalue(), 'a\n')
+
+    def test_overflow_block(self):
+        import threading
+        inst = self._makeOne(maxlines=1, flush_interval=0.01,
+                             overflow='block')
+        writer = threading.Thread(
+            target=lambda: [inst.write(u'%d\n' % i) for i in range(5)])
+        writer.start()
+        writer.join(5)
+        self.assertFalse(writer.is_alive())
+        inst.close()
+        self.assertEqual(inst.dropped, 0)
+        self.assertEqual(inst.stream.getvalue(), '0\n1\n2\n3\n4\n')
+
+    def test_thread_started_by_first_write(self):
+        inst = self._makeOne()
+        self.assertEqual(inst._thread, None)
+        inst.write(u'a\n')
+        self.assertTrue(inst._thread.is_alive())
+        inst.close()
+        self.assertEqual(inst.stream.getvalue(), 'a\n')
+
+    def test_close_without_write(self):
+        inst = self._makeOne()
+        inst.close()
+        self.assertEqual(inst._thread, None)
+
+    def test_stream_error(self):
+        import io
+        import sys
+        stream = DummyFailingStream()
+        inst = self._makeOne(stream, flush_lines=1, flush_interval=60)
+        stderr = sys.stderr
+        sys.stderr = io.StringIO() if str is not bytes else io.BytesIO()
+        try:
+            inst.write(u'a\n')
+            self.assertTrue(stream.failed.wait(5))
+            inst.write(u'b\n')
+            inst.close()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertTrue('IOError' in output or 'OSError' in output)
+        self.assertEqual(inst.errors, 1)
+        self.assertEqual(stream.written, ['b\n'])
+
+    def test_overflow_block_dead_thread(self):
+        inst = self._makeOne(maxlines=1, flush_interval=0.01,
+                             overflow='block')
+        inst._thread = DummyThread()
+        inst.write(u'a\n')
+        inst.write(u'b\n')
+        self.assertEqual(inst.dropped, 1)
+        inst.closed = True
+
+    def test_write_after_close_is_ignored(self):
+        inst = self._makeOne()
+        inst.close()
+        inst.write(u'a\n')
+        inst.close()
+        self.assertEqual(inst.stream.getvalue(), '')
+
+class TestAnalyzer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _makeOne(self, **kw):
+        from pyramid_zodbconn.transferlog import Analyzer
+        return Analyzer(**kw)
+
+    def _write(self, name, format, *records):
+        from pyramid_zodbconn.transferlog import FORMATS
+        formatter, binary = FORMATS[format]
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'wb') as f:
+            for record in records:
+                value = formatter(*record)
+                if not binary:
+                    value = value.encode('utf-8')
+                f.write(value)
+        return filename
+
+    def test_add(self):
+        from pyramid_zodbconn.transferlog import Record
+        inst = self._makeOne()
+        inst.add(Record(0, 'GET', '/a?x=1', 1.0, 2, 1, [('other', 3, 1)]))
+        inst.add(Record(0, 'GET', '/a?x=2', 0.5, 1, 0))
+        self.assertEqual(inst.records, 2)
+        stats = inst.urls['/a']
+        self.assertEqual(stats.requests, 2)
+        self.assertEqual(stats.loads, 6)
+        self.assertEqual(stats.stores, 2)
+        self.assertEqual(stats.elapsed, 1.5)
+
+    def test_add_keep_query(self):
+        from pyramid_zodbconn.transferlog import Record
+        inst = self._makeOne(keep_query=True)
+        inst.add(Record(0, 'GET', '/a?x=1', 1.0, 2, 1))
+        inst.add(Record(0, 'GET', '/a?x=2', 0.5, 1, 0))
+        self.assertEqual(sorted(inst.urls), ['/a?x=1', '/a?x=2'])
+
+    def test_add_file(self):
+        inst = self._makeOne()
+        for format in ('csv', 'json', 'binary'):
+            filename = self._write(
+                format, format, (0, 'GET', '/a', 1.0, 2, 1, []))
+            inst.add_file(filename)
+        self.assertEqual(inst.records, 3)
+        self.assertEqual(inst.urls['/a'].loads, 6)
+
+    def test_add_file_empty(self):
+        inst = self._makeOne()
+        inst.add_file(self._write('empty', 'csv'))
+        self.assertEqual(inst.records, 0)
+
+    def test_top(self):
+        from pyramid_zodbconn.transferlog import Record
+        inst = self._makeOne()
+        inst.add(Record(0, 'GET', '/a', 3.0, 1, 5))
+        inst.add(Record(0, 'GET', '/b', 1.0, 9, 0))
+        inst.add(Record(0, 'GET', '/c', 2.0, 5, 1))
+        self.assertEqual(
+            [url for url, stats in inst.top('loads')], ['/b', '/c', '/a'])
+        self.assertEqual(
+            [url for url, stats in inst.top('elapsed', 2)], ['/a', '/c'])
+
+    def test_main(self):
+        from pyramid_zodbconn.transferlog import main
+        filename = self._write(
+            'log', 'binary',
+            (0, 'GET', '/a', 3.0, 1, 5, []),
+            (0, 'GET', '/b', 1.0, 9, 0, []),
+            )
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        self.assertEqual(main([filename, '--top', '1'], out=out), 0)
+        result = out.getvalue()
+        self.assertTrue(result.startswith('2 requests, 2 URLs\n'), result)
+        self.assertTrue('Top URLs by loads:' in result)
+        lines = result.splitlines()
+        index = lines.index('Top URLs by loads:')
+        self.assertTrue(lines[index + 2].endswith('/b'), lines)
+        index = lines.index('Top URLs by elapsed:')
+        self.assertTrue(lines[index + 2].endswith('/a'), lines)
+
+class DummyFailingStream(object):
+    def __init__(self):
+        import threading
+        self.failed = threading.Event()
+        self.written = []
+
+    def write(self, value):
+        if not self.failed.is_set():
+            self.failed.set()
+            raise IOError('disk full')
+        self.written.append(value)
+
+    def flush(self):
+        pass
+
+class DummyThread(object):
+    def is_alive(self):
+        return False
+
+class DummyFlushingStream(object):
+    def __init__(self):
+        import threading
+        self.written = []
+        self.flushed = threading.Event()
+    def write(self, value):
+        self.written.append(value)
+    def flush(self):
+        self.flushed.set()
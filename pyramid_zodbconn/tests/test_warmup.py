@@ -0,0 +1,157 @@
+import unittest
+
+from pyramid_zodbconn.tests import DummyLazyDB
+
+class WarmupTestBase(unittest.TestCase):
+    def setUp(self):
+        from ZODB import DB
+        from ZODB.MappingStorage import MappingStorage
+        from persistent.mapping import PersistentMapping
+        import transaction
+        self.db = DB(MappingStorage(), pool_size=3)
+        tm = transaction.TransactionManager()
+        conn = self.db.open(tm)
+        catalog = PersistentMapping()
+        conn.root()['app'] = PersistentMapping({'catalog': catalog})
+        tm.commit()
+        self.catalog_oid = catalog._p_oid
+        conn.close()
+        self.db.cacheMinimize()
+
+    def tearDown(self):
+        self.db.close()
+
+class Test_parse_entries(unittest.TestCase):
+    def _callFUT(self, lines):
+        from pyramid_zodbconn.warmup import parse_entries
+        return parse_entries(lines)
+
+    def test_it(self):
+        from ZODB.utils import p64
+        result = self._callFUT([
+            '# a comment',
+            '',
+            '0x2a 1234',
+            '/app/catalog',
+            '/',
+            ])
+        self.assertEqual(result, [p64(42), ('app', 'catalog'), ()])
+
+    def test_invalid_oid(self):
+        from pyramid.exceptions import ConfigurationError
+        try:
+            self._callFUT(['0x2a', 'app/catalog'])
+        except ConfigurationError as e:
+            message = str(e)
+        else: # pragma: no cover
+            self.fail('ConfigurationError not raised')
+        self.assertTrue("'app/catalog'" in message)
+        self.assertTrue('zodbconn.warmup' in message)
+
+    def test_oid_out_of_range(self):
+        from pyramid.exceptions import ConfigurationError
+        self.assertRaises(ConfigurationError, self._callFUT, ['-0x1'])
+        self.assertRaises(ConfigurationError, self._callFUT, ['0x' + 'f' * 17])
+
+class Test_read_entries(unittest.TestCase):
+    def test_it(self):
+        import io
+        from ZODB.utils import p64
+        from pyramid_zodbconn.warmup import read_entries
+        opened = []
+        def fake_open(filename):
+            opened.append(filename)
+            return io.StringIO(u'0x01\n/app\n')
+        result = read_entries('hot.txt', open=fake_open)
+        self.assertEqual(opened, ['hot.txt'])
+        self.assertEqual(result, [p64(1), ('app',)])
+
+    def test_invalid_entry_names_line(self):
+        import io
+        from pyramid.exceptions import ConfigurationError
+        from pyramid_zodbconn.warmup import read_entries
+        def fake_open(filename):
+            return io.StringIO(u'0x01\n# comment\nbogus 12\n')
+        try:
+            read_entries('hot.txt', open=fake_open)
+        except ConfigurationError as e:
+            message = str(e)
+        else: # pragma: no cover
+            self.fail('ConfigurationError not raised')
+        self.assertTrue("'bogus'" in message)
+        self.assertTrue('line 3 of hot.txt' in message)
+
+class Test_activate(WarmupTestBase):
+    def _callFUT(self, conn, entry):
+        from pyramid_zodbconn.warmup import activate
+        return activate(conn, entry)
+
+    def test_path(self):
+        conn = self.db.open()
+        try:
+            obj = self._callFUT(conn, ('app', 'catalog'))
+            self.assertEqual(obj._p_oid, self.catalog_oid)
+            self.assertEqual(obj._p_changed, False)
+        finally:
+            conn.close()
+
+    def test_oid(self):
+        conn = self.db.open()
+        try:
+            obj = self._callFUT(conn, self.catalog_oid)
+            self.assertEqual(obj._p_changed, False)
+        finally:
+            conn.close()
+
+    def test_missing(self):
+        from ZODB.utils import p64
+        conn = self.db.open()
+        try:
+            self.assertEqual(self._callFUT(conn, ('nope',)), None)
+            self.assertEqual(self._callFUT(conn, p64(12345)), None)
+        finally:
+            conn.close()
+
+class Test_warm(WarmupTestBase):
+    def _callFUT(self, db, entries, connections=None):
+        from pyramid_zodbconn.warmup import warm
+        return warm(db, entries, connections)
+
+    def test_warms_every_pooled_connection(self):
+        result = self._callFUT(self.db, [('app', 'catalog'), ('nope',)])
+        self.assertEqual(result, 3)
+        sizes = self.db.cacheDetailSize()
+        self.assertEqual(len(sizes), 3)
+        for size in sizes:
+            self.assertEqual(size['ngsize'], 3)
+        for info in self.db.connectionDebugInfo():
+            self.assertEqual(info['opened'], None)
+
+    def test_connections(self):
+        result = self._callFUT(self.db, [self.catalog_oid], connections=2)
+        self.assertEqual(result, 2)
+
+class TestCacheWarmer(WarmupTestBase):
+    def _makeOne(self, databases, background=False):
+        from pyramid_zodbconn.warmup import CacheWarmer
+        return CacheWarmer(databases, [self.catalog_oid], connections=1,
+                           background=background)
+
+    def test_start_inline(self):
+        inst = self._makeOne({'': self.db})
+        inst.start(None)
+        self.assertEqual(inst.activated, 1)
+
+    def test_start_background(self):
+        inst = self._makeOne({'': self.db}, background=True)
+        inst.start(None)
+        thread = inst._thread
+        inst.start(None)
+        self.assertTrue(inst._thread is thread)
+        thread.join(5)
+        self.assertEqual(inst.activated, 1)
+
+    def test_loads_lazy_database(self):
+        inst = self._makeOne({'': DummyLazyDB(self.db)})
+        inst.start(None)
+        self.assertEqual(inst.activated, 1)
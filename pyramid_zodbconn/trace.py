@@ -0,0 +1,189 @@
+""" Tracing of the objects loaded by individual requests.
+
+A traced request records every object its connections load from storage,
+in order.  Traces of requests which took at least the configured threshold
+are written out as a JSON object per line: the ``time`` the request ended
+(seconds since the epoch), its ``method``, ``url`` and ``elapsed`` seconds,
+``truncated`` (the number of loads left out because the trace was full)
+and ``loads``, a list of ``[offset, dbname, oid, class, size, seconds]``
+lists: the seconds since the connection was opened, the database name, the
+oid (as a hexadecimal string), the dotted name of the object's class, the
+size of its pickle and the seconds spent loading it.
+"""
+import json
+import random
+import threading
+import time
+
+from ZODB.utils import (
+    get_pickle_metadata,
+    oid_repr,
+    )
+
+from .stats import (
+    Recorder,
+    instrument,
+    )
+
+def pickle_class(data):
+    """ Return the dotted name of the class of the object in the database
+    record ``data``, without unpickling it. """
+    try:
+        module, name = get_pickle_metadata(data)
+    except Exception:
+        return '?'
+    if not name:
+        return module or '?'
+    return '%s.%s' % (module, name)
+
+class TraceRecorder(Recorder):
+    """ Adds the loads of the connection to one database to a
+    :class:`LoadTrace`. """
+    def __init__(self, trace, dbname):
+        self.trace = trace
+        self.dbname = dbname
+
+    def record_load(self, oid, data, elapsed):
+        self.trace.add(self.dbname, oid, data, elapsed)
+
+class LoadTrace(object):
+    """ The objects loaded by one request, in the order they were loaded,
+    as ``(offset, dbname, oid, class, size, seconds)`` tuples in
+    ``loads``.  At most ``max_loads`` are kept; further loads are only
+    counted in ``truncated``. """
+    def __init__(self, max_loads=10000, time=time):
+        # XXX time is parameterized only for testing
+        self.max_loads = max_loads
+        self.loads = []
+        self.truncated = 0
+        self.recorders = {}
+        self._time = time
+        self.started = time.time()
+
+    def add(self, dbname, oid, data, elapsed):
+        if len(self.loads) >= self.max_loads:
+            self.truncated += 1
+            return
+        self.loads.append((
+            self._time.time() - self.started,
+            dbname,
+            oid,
+            pickle_class(data),
+            len(data),
+            elapsed,
+            ))
+
+    def attach(self, dbname, conn):
+        """ Start tracing the loads of ``conn``, the connection to the
+        database ``dbname``. """
+        if dbname in self.recorders:
+            return
+        recorder = TraceRecorder(self, dbname)
+        instrument(conn).add_recorder(recorder)
+        self.recorders[dbname] = (conn, recorder)
+
+    def detach(self):
+        """ Stop tracing. """
+        for conn, recorder in self.recorders.values():
+            conn._normal_storage.remove_recorder(recorder)
+        self.recorders = {}
+
+    def as_dict(self):
+        return dict(
+            truncated=self.truncated,
+            loads=[
+                [round(offset, 6), dbname, oid_repr(oid), cls, size,
+                 round(elapsed, 6)]
+                for offset, dbname, oid, cls, size, elapsed in self.loads],
+            )
+
+class LoadTracer(object):
+    """ Traces the loads of ``sample_rate`` of the requests, and of those
+    for which :func:`trace_loads` is called, and writes the trace (see
+    :mod:`pyramid_zodbconn.trace`) of each of them which took at least
+    ``threshold`` seconds (all of them if ``threshold`` is ``None``) to
+    ``stream``.  The trace of the current request is available as
+    ``request.zodb_load_trace``.
+
+    :meth:`start`, :meth:`start_secondary` and :meth:`end` are subscribers
+    for the connection opened, secondary connection opened and will-close
+    events.  ``traced`` counts the traced requests and ``written`` the
+    traces written. """
+    key = '_pyramid_zodbconn_trace'
+
+    def __init__(self, stream, threshold=None, sample_rate=None,
+                 max_loads=10000, random=random.random):
+        # XXX random is parameterized only for testing
+        self.stream = stream
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_loads = max_loads
+        self.random = random
+        self.traced = 0
+        self.written = 0
+        self._lock = threading.Lock()
+
+    def start(self, event, time=time):
+        # XXX time is parameterized only for testing
+        request = event.request
+        if not getattr(request, self.key, False):
+            if not self.sample_rate or self.random() >= self.sample_rate:
+                return
+        self.trace(request, event.conn, time)
+
+    def trace(self, request, conn, time=time):
+        """ Start tracing the loads of the primary connection ``conn`` of
+        ``request`` and of the secondary connections attached to it. """
+        trace = LoadTrace(self.max_loads, time=time)
+        for dbname, c in sorted(conn.connections.items()):
+            trace.attach(dbname, c)
+        setattr(request, self.key, trace)
+        request.zodb_load_trace = trace
+        self.traced += 1
+        return trace
+
+    def start_secondary(self, event):
+        trace = getattr(event.request, self.key, None)
+        if isinstance(trace, LoadTrace):
+            trace.attach(event.dbname, event.conn)
+
+    def end(self, event, time=time):
+        # XXX time is parameterized only for testing
+        trace = getattr(event.request, self.key, None)
+        if not isinstance(trace, LoadTrace):
+            return
+        trace.detach()
+        now = time.time()
+        elapsed = now - trace.started
+        if self.threshold is not None and elapsed < self.threshold:
+            return
+        record = trace.as_dict()
+        record.update(
+            time=round(now, 3),
+            method=event.request.method,
+            url=event.request.path_qs,
+            elapsed=round(elapsed, 6),
+            )
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+            self.written += 1
+
+def trace_loads(request):
+    """ Trace the objects loaded by ``request``, which is written out if
+    the request takes at least ``zodbconn.load_trace_threshold`` seconds.
+    Loads are traced from the moment the request's connection is opened,
+    or from now on if it is already open.  Does nothing unless
+    ``zodbconn.load_trace`` is configured. """
+    tracer = getattr(request.registry, '_zodb_load_tracer', None)
+    if tracer is None:
+        return
+    if isinstance(getattr(request, tracer.key, None), LoadTrace):
+        return
+    conn = getattr(request, '_primary_zodb_conn', None)
+    if conn is None:
+        # picked up by LoadTracer.start when the connection is opened
+        setattr(request, tracer.key, True)
+    else:
+        tracer.trace(request, conn)
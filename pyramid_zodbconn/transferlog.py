@@ -0,0 +1,385 @@
+""" Transfer log formats, a buffered transfer log writer, and a command line
+tool which summarizes transfer logs.
+
+Every format writes one record per request: the time the request ended,
+its method and URL, the seconds it took, the objects it loaded from and
+stored to the primary database, and ``(dbname, loads, stores)`` for the
+secondary databases it used.
+
+``csv``
+  The original format: a line of comma-separated values, strings quoted.
+
+``json``
+  A JSON object per line, with the keys ``time`` (seconds since the epoch),
+  ``method``, ``url``, ``elapsed``, ``loads``, ``stores`` and, if secondary
+  databases were used, ``databases`` (mapping their names to ``[loads,
+  stores]``).
+
+``binary``
+  A compact record per request, prefixed with its length as a 4-byte
+  big-endian unsigned integer: the time and the elapsed seconds as
+  doubles, loads and stores as 4-byte unsigned integers, the lengths of
+  the method and the URL and the number of secondary databases, then the
+  UTF-8 encoded method and URL, then for each secondary database the
+  length of its name, its loads and stores and its name.  All integers are
+  big-endian.
+"""
+import argparse
+import collections
+import csv
+import datetime
+import json
+import mmap
+import struct
+import sys
+import threading
+import time
+import traceback
+
+from pyramid.exceptions import ConfigurationError
+
+from .compat import text_
+
+LENGTH = struct.Struct('>I')
+RECORD = struct.Struct('>ddIIBHB')
+DATABASE = struct.Struct('>BII')
+
+def format_csv(when, method, url, elapsed, loads, stores, databases):
+    ts = datetime.datetime.fromtimestamp(when).strftime('%Y-%m-%d %H:%M:%S')
+    value = '"%s", "%s", "%s", %.2f, %d, %d' % (
+        ts, method, url, elapsed, loads, stores)
+    for dbname, db_loads, db_stores in databases:
+        value += ', "%s", %d, %d' % (dbname, db_loads, db_stores)
+    return text_(value + '\n')
+
+def format_json(when, method, url, elapsed, loads, stores, databases):
+    record = {
+        'time': round(when, 3),
+        'method': method,
+        'url': url,
+        'elapsed': round(elapsed, 4),
+        'loads': loads,
+        'stores': stores,
+        }
+    if databases:
+        record['databases'] = dict(
+            (dbname, [db_loads, db_stores])
+            for dbname, db_loads, db_stores in databases)
+    return text_(json.dumps(record, separators=(',', ':')) + '\n')
+
+def _encode(value, limit):
+    # truncated rather than overflowing the length field
+    return value.encode('utf-8')[:limit]
+
+def format_binary(when, method, url, elapsed, loads, stores, databases):
+    method = _encode(method, 0xff)
+    url = _encode(url, 0xffff)
+    parts = [
+        RECORD.pack(when, elapsed, loads, stores,
+                    len(method), len(url), len(databases)),
+        method,
+        url,
+        ]
+    for dbname, db_loads, db_stores in databases:
+        dbname = _encode(dbname, 0xff)
+        parts.append(DATABASE.pack(len(dbname), db_loads, db_stores))
+        parts.append(dbname)
+    body = b''.join(parts)
+    return LENGTH.pack(len(body)) + body
+
+# format name -> (formatter, whether the log file is opened in binary mode)
+FORMATS = {
+    'csv': (format_csv, False),
+    'json': (format_json, False),
+    'binary': (format_binary, True),
+    }
+
+class BufferedTransferLogWriter(object):
+    """ A file-like sink for :class:`pyramid_zodbconn.TransferLog` which
+    never touches the underlying stream on the request thread.  ``write``
+    appends a line to a bounded in-memory ring and returns; a dedicated
+    writer thread drains the ring in batches, writing and flushing the
+    underlying stream when ``flush_lines`` lines are pending or
+    ``flush_interval`` seconds have passed, whichever comes first.  The thread is started by the first
+    write, so that it runs in the process which serves requests.
+
+    When the ring holds ``maxlines`` lines, the ``overflow`` policy decides
+    what happens to further writes: ``drop`` discards the line (and counts it
+    in ``dropped``), ``block`` makes the writer wait until the writer thread
+    has made room.
+
+    An error writing to the underlying stream is printed to ``sys.stderr``
+    and counted in ``errors``; the batch is lost, and the writer thread goes
+    on with the next one."""
+
+    OVERFLOW_POLICIES = ('drop', 'block')
+
+    def __init__(self, stream, maxlines=10000, flush_lines=100,
+                 flush_interval=1.0, overflow='drop'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ConfigurationError(
+                'Unknown transfer log overflow policy %r (expected one of %s)'
+                % (overflow, ', '.join(self.OVERFLOW_POLICIES)))
+        self.stream = stream
+        self.maxlines = maxlines
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.dropped = 0
+        self.errors = 0
+        self.closed = False
+        self._lines = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def write(self, value):
+        with self._cond:
+            if self.closed:
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='pyramid_zodbconn-transferlog')
+                self._thread.daemon = True
+                self._thread.start()
+            while len(self._lines) >= self.maxlines:
+                if self.overflow == 'drop' or not self._thread.is_alive():
+                    # a dead writer thread would never make room
+                    self.dropped += 1
+                    return
+                self._cond.wait(self.flush_interval)
+                if self.closed:
+                    return
+            self._lines.append(value)
+            if len(self._lines) >= self.flush_lines:
+                self._cond.notify_all()
+
+    def flush(self):
+        # the writer thread owns flushing the underlying stream
+        pass
+
+    def close(self, timeout=None):
+        """ Write out any pending lines and stop the writer thread. """
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _take(self):
+        with self._cond:
+            deadline = time.time() + self.flush_interval
+            while not self.closed and len(self._lines) < self.flush_lines:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = list(self._lines)
+            self._lines.clear()
+            self._cond.notify_all() # wake up writers blocked on a full ring
+            return batch, self.closed
+
+    def _run(self):
+        while True:
+            batch, closed = self._take()
+            if batch:
+                try:
+                    # the lines are bytes for the binary transfer log format
+                    self.stream.write(batch[0][:0].join(batch))
+                    self.stream.flush()
+                except Exception:
+                    # keep draining the ring, so that writers don't block
+                    self.errors += 1
+                    traceback.print_exc(file=sys.stderr)
+            if closed:
+                break
+
+class Record(object):
+    """ A transfer log record, as read by :func:`read_records`.  ``time``
+    is a timestamp string in logs of the ``csv`` format. """
+    def __init__(self, time, method, url, elapsed, loads, stores,
+                 databases=()):
+        self.time = time
+        self.method = method
+        self.url = url
+        self.elapsed = elapsed
+        self.loads = loads
+        self.stores = stores
+        self.databases = databases
+
+def _lines(buf):
+    start = 0
+    size = len(buf)
+    while start < size:
+        end = buf.find(b'\n', start)
+        if end < 0:
+            # a partial last line, still being written
+            return
+        line = buf[start:end]
+        start = end + 1
+        if line.strip():
+            yield line.decode('utf-8')
+
+def read_csv(buf):
+    for line in _lines(buf):
+        row = next(csv.reader([line], skipinitialspace=True))
+        databases = [
+            (row[i], int(row[i + 1]), int(row[i + 2]))
+            for i in range(6, len(row) - 2, 3)]
+        yield Record(row[0], row[1], row[2], float(row[3]),
+                     int(row[4]), int(row[5]), databases)
+
+def read_json(buf):
+    for line in _lines(buf):
+        data = json.loads(line)
+        databases = [
+            (dbname, db_loads, db_stores)
+            for dbname, (db_loads, db_stores)
+            in sorted(data.get('databases', {}).items())]
+        yield Record(data['time'], data['method'], data['url'],
+                     data['elapsed'], data['loads'], data['stores'],
+                     databases)
+
+def read_binary(buf):
+    pos = 0
+    size = len(buf)
+    while pos + LENGTH.size <= size:
+        length, = LENGTH.unpack_from(buf, pos)
+        pos += LENGTH.size
+        end = pos + length
+        if end > size:
+            # a partial last record, still being written
+            return
+        (when, elapsed, loads, stores, method_len, url_len,
+         count) = RECORD.unpack_from(buf, pos)
+        pos += RECORD.size
+        method = buf[pos:pos + method_len].decode('utf-8')
+        pos += method_len
+        url = buf[pos:pos + url_len].decode('utf-8', 'replace')
+        pos += url_len
+        databases = []
+        for i in range(count):
+            name_len, db_loads, db_stores = DATABASE.unpack_from(buf, pos)
+            pos += DATABASE.size
+            databases.append(
+                (buf[pos:pos + name_len].decode('utf-8'), db_loads, db_stores))
+            pos += name_len
+        pos = end
+        yield Record(when, method, url, elapsed, loads, stores, databases)
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+    'binary': read_binary,
+    }
+
+def guess_format(buf):
+    """ Return the name of the format of the log in ``buf``. """
+    first = buf[:1]
+    if first == b'"':
+        return 'csv'
+    if first == b'{':
+        return 'json'
+    return 'binary'
+
+def read_records(buf, format=None):
+    """ Yield the :class:`Record` objects in ``buf``, a buffer holding a
+    transfer log (such as a memory-mapped file).  The format is guessed if
+    ``format`` is ``None``.  A partially written last record is ignored. """
+    if format is None:
+        format = guess_format(buf)
+    return READERS[format](buf)
+
+class URLStats(object):
+    def __init__(self):
+        self.requests = 0
+        self.loads = 0
+        self.stores = 0
+        self.elapsed = 0.0
+
+class Analyzer(object):
+    """ Sums up the requests, loads, stores (of all databases) and elapsed
+    time per URL.  Query strings are left out of the URLs unless
+    ``keep_query`` is true. """
+    def __init__(self, keep_query=False):
+        self.keep_query = keep_query
+        self.urls = {}
+        self.records = 0
+
+    def add(self, record):
+        url = record.url
+        if not self.keep_query:
+            url = url.split('?', 1)[0]
+        stats = self.urls.get(url)
+        if stats is None:
+            stats = self.urls[url] = URLStats()
+        stats.requests += 1
+        stats.loads += record.loads
+        stats.stores += record.stores
+        stats.elapsed += record.elapsed
+        for dbname, loads, stores in record.databases:
+            stats.loads += loads
+            stats.stores += stores
+        self.records += 1
+
+    def add_file(self, filename, format=None, open=open):
+        """ Add the records of the log file ``filename``, which is mapped
+        into memory rather than read. """
+        with open(filename, 'rb') as f:
+            try:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # an empty file can't be mapped
+                return
+            try:
+                for record in read_records(buf, format):
+                    self.add(record)
+            finally:
+                buf.close()
+
+    def top(self, attr, n=10):
+        """ Return the ``n`` ``(url, stats)`` tuples with the largest
+        ``attr`` (``loads``, ``stores`` or ``elapsed``). """
+        items = sorted(
+            self.urls.items(),
+            key=lambda item: (-getattr(item[1], attr), item[0]))
+        return items[:n]
+
+    def report(self, out, n=10):
+        out.write('%d requests, %d URLs\n' % (self.records, len(self.urls)))
+        for attr in ('loads', 'stores', 'elapsed'):
+            out.write('\nTop URLs by %s:\n' % attr)
+            out.write('%10s %12s %12s %12s  %s\n' % (
+                'requests', 'loads', 'stores', 'elapsed', 'url'))
+            for url, stats in self.top(attr, n):
+                out.write('%10d %12d %12d %12.2f  %s\n' % (
+                    stats.requests, stats.loads, stats.stores,
+                    stats.elapsed, url))
+
+def main(argv=None, out=None):
+    """ The ``zodbconn-transferlog`` console script. """
+    if out is None:
+        out = sys.stdout
+    parser = argparse.ArgumentParser(
+        description='Report the URLs with the most ZODB loads, stores and '
+        'elapsed time in pyramid_zodbconn transfer logs.')
+    parser.add_argument('filenames', nargs='+', metavar='FILE')
+    parser.add_argument(
+        '--format', choices=sorted(READERS),
+        help='the format of the logs (guessed by default)')
+    parser.add_argument(
+        '--top', type=int, default=10,
+        help='the number of URLs to list (default: 10)')
+    parser.add_argument(
+        '--keep-query', action='store_true',
+        help='tell URLs with different query strings apart')
+    args = parser.parse_args(argv)
+    analyzer = Analyzer(keep_query=args.keep_query)
+    for filename in args.filenames:
+        analyzer.add_file(filename, args.format)
+    analyzer.report(out, args.top)
+    return 0
+
+if __name__ == '__main__': # pragma: no cover
+    sys.exit(main())
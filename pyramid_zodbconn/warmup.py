@@ -0,0 +1,115 @@
+import threading
+
+import transaction
+from pyramid.exceptions import ConfigurationError
+from ZODB.utils import p64
+from ZODB.utils import z64
+
+def parse_entries(lines, filename=None):
+    """ Parse cache warming entries, one per line.  An entry is either an
+    oid in hex (``0x2a``) or a traversal path from the root mapping of the
+    database (``/app_root/catalog``).  Only the first word of each line is
+    used, so a line may carry a comment or a count after the entry; blank
+    lines and lines starting with ``#`` are ignored.
+
+    An invalid entry raises ``pyramid.exceptions.ConfigurationError``,
+    naming the entry and the line of ``filename`` it was read from (or the
+    ``zodbconn.warmup`` setting if ``filename`` is ``None``)."""
+    entries = []
+    for number, line in enumerate(lines, 1):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        entry = words[0]
+        if entry.startswith('/'):
+            entries.append(tuple(name for name in entry.split('/') if name))
+            continue
+        try:
+            entries.append(p64(int(entry, 16)))
+        except ValueError:
+            if filename is None:
+                where = 'the zodbconn.warmup setting'
+            else:
+                where = 'line %d of %s' % (number, filename)
+            raise ConfigurationError(
+                'Invalid cache warming entry %r in %s: expected an oid in '
+                'hex or a path starting with "/"' % (entry, where))
+    return entries
+
+def read_entries(filename, open=open):
+    """ Read cache warming entries from ``filename``, in the format
+    understood by :func:`parse_entries`. """
+    with open(filename) as f:
+        return parse_entries(f, filename)
+
+def activate(conn, entry):
+    """ Load the object named by ``entry`` (an oid or a tuple of names to
+    traverse from the root mapping) and the objects along its path into the
+    cache of ``conn``.  Return the object, or ``None`` if it doesn't exist
+    (anymore). """
+    try:
+        if isinstance(entry, tuple):
+            obj = conn.get(z64)
+            for name in entry:
+                obj = obj[name]
+        else:
+            obj = conn.get(entry)
+        obj._p_activate()
+    except KeyError:
+        # includes POSKeyError
+        return None
+    return obj
+
+def warm(db, entries, connections=None):
+    """ Open ``connections`` connections to ``db`` at the same time (by
+    default, as many as the connection pool holds), activate every object in
+    ``entries`` in each of them, and return them to the pool.  Return the
+    total number of objects activated."""
+    if connections is None:
+        connections = db.getPoolSize()
+    opened = []
+    activated = 0
+    try:
+        for i in range(connections):
+            opened.append(db.open(transaction.TransactionManager()))
+        for conn in opened:
+            for entry in entries:
+                if activate(conn, entry) is not None:
+                    activated += 1
+    finally:
+        for conn in opened:
+            conn.transaction_manager.abort()
+            conn.close()
+    return activated
+
+class CacheWarmer(object):
+    """ Warms the connection caches of the primary database in
+    ``databases`` with ``entries`` when :meth:`start` is called, either
+    inline or (if ``background`` is true) from a daemon thread. """
+    def __init__(self, databases, entries, connections=None,
+                 background=False):
+        self.databases = databases
+        self.entries = entries
+        self.connections = connections
+        self.background = background
+        self.activated = None
+        self._thread = None
+
+    def run(self):
+        from pyramid_zodbconn import is_loaded
+        db = self.databases['']
+        if not is_loaded(db):
+            # warming up is an explicit request to open a lazy database
+            db = db.load()
+        self.activated = warm(db, self.entries, self.connections)
+
+    def start(self, event=None):
+        # usable as an ``ApplicationCreated`` subscriber, so that the caches
+        # of the process which serves requests are warmed
+        if not self.background:
+            self.run()
+        elif self._thread is None:
+            self._thread = threading.Thread(
+                target=self.run, name='pyramid_zodbconn-warmup')
+            self._thread.daemon = True
+            self._thread.start()
@@ -65,7 +65,11 @@ setup(name='pyramid_zodbconn',
       install_requires=install_requires,
       tests_require=install_requires,
       test_suite="pyramid_zodbconn",
-      entry_points='',
+      entry_points={
+          'console_scripts': [
+              'zodbconn-transferlog = pyramid_zodbconn.transferlog:main',
+          ],
+      },
       extras_require={
           'testing':testing_extras,
           'docs':docs_extras,